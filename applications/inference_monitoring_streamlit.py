@@ -1,8 +1,9 @@
 import streamlit as st
 import torch
-from uberduck_ml_dev.monitoring.generate import _get_inference
-from uberduck_ml_dev.models.tacotron2 import Tacotron2, DEFAULTS as TACOTRON2_DEFAULTS
-from uberduck_ml_dev.vocoders.hifigan import HiFiGanGenerator
+from uberduck_ml_dev.monitoring.generate import _get_inference, _load_tacotron2
+from uberduck_ml_dev.models.tacotron2 import DEFAULTS as TACOTRON2_DEFAULTS
+from uberduck_ml_dev.registry import load_hifigan
+from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
 import scipy
 from io import BytesIO
 import pandas as pd
@@ -224,25 +225,16 @@ def run():
             symbol_set = session_state.df["symbol_set"].iloc[i]
             model_format = session_state.df["model_format"].iloc[i]
 
-            hparams = TACOTRON2_DEFAULTS
+            hparams = HParams(**TACOTRON2_DEFAULTS.values())
             hparams.n_speakers = n_speakers
             hparams.gate_threshold = gate_threshold
             hparams.cudnn_enabled = cudnn_enabled
             if n_speakers > 1:
                 hparams.has_speaker_embedding = True
-            model = Tacotron2(hparams)
-
-            if model_format == "OD":
-                model.from_pretrained(model_dict=torch.load(model_path), device=device)
-            if model_format == "D":
-                model.from_pretrained(warm_start_path=model_path, device=device)
-            if cudnn_enabled:
-                model.cuda()
-            hifigan = HiFiGanGenerator(
-                config=vc_path,
-                checkpoint=vocoder_path,
-                cudnn_enabled=True,
-            )
+            # NOTE: the models are loaded through the registry, so reruns and rows that share a
+            # checkpoint reuse the loaded model.
+            model = _load_tacotron2(model_path, model_format, hparams, device)
+            hifigan = load_hifigan(vc_path, vocoder_path, cudnn_enabled=cudnn_enabled)
             texts = [text]
             speakers = torch.tensor(
                 np.repeat(speaker_id, 1), device=device, dtype=torch.long
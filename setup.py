@@ -60,6 +60,7 @@ if cfg.get("requirements"):
 if cfg.get("pip_requirements"):
     requirements += cfg.get("pip_requirements", "").split()
 dev_requirements = (cfg.get("dev_requirements") or "").split()
+onnx_requirements = (cfg.get("onnx_requirements") or "").split()
 
 long_description = open("README.md", encoding="utf-8").read()
 # ![png](docs/images/output_13_0.png)
@@ -105,7 +106,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     install_requires=requirements,
-    extras_require={"dev": dev_requirements},
+    extras_require={"dev": dev_requirements, "onnx": onnx_requirements},
     python_requires=">=" + cfg["min_python"],
     long_description=long_description,
     long_description_content_type="text/markdown",
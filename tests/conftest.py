@@ -14,6 +14,24 @@ from uberduck_ml_dev.trainer.tacotron2 import (
     DEFAULTS as TACOTRON2_TRAINER_DEFAULTS,
 )
 from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
+from uberduck_ml_dev.vocoders.hifigan import (
+    AttrDict,
+    DEFAULTS as HIFIGAN_DEFAULTS,
+    Generator,
+)
+
+# NOTE: small enough to train and run inference on CPU in a few seconds.
+TINY_TACOTRON2_OVERRIDES = dict(
+    symbols_embedding_dim=32,
+    encoder_embedding_dim=32,
+    decoder_rnn_dim=64,
+    attention_rnn_dim=64,
+    prenet_dim=32,
+    attention_dim=16,
+    attention_location_n_filters=8,
+    postnet_embedding_dim=32,
+)
+
 
 # NOTE (Sam): move to Tacotron2 model and remove from Uberduck repo.
 def _load_tacotron_uninitialized(overrides=None):
@@ -24,6 +42,26 @@ def _load_tacotron_uninitialized(overrides=None):
     return Tacotron2(hparams)
 
 
+@pytest.fixture
+def tiny_tacotron2_hparams():
+    defaults = dict(**TACOTRON2_DEFAULTS.values())
+    defaults.update(TINY_TACOTRON2_OVERRIDES)
+    return HParams(**defaults)
+
+
+@pytest.fixture
+def tiny_hifigan(tmp_path):
+    """Config and checkpoint path of a randomly initialized HiFi-GAN generator
+    small enough to vocode on CPU in tests."""
+    h = AttrDict(HIFIGAN_DEFAULTS)
+    h.upsample_initial_channel = 32
+    checkpoint = str(tmp_path / "generator.pt")
+    with torch.random.fork_rng():
+        torch.manual_seed(1234)
+        torch.save(dict(generator=Generator(h).state_dict()), checkpoint)
+    return h, checkpoint
+
+
 @pytest.fixture(scope="session")
 def lj_speech_tacotron2_file():
     tf = tempfile.NamedTemporaryFile(suffix=".pt")
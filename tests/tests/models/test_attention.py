@@ -0,0 +1,63 @@
+import torch
+
+from uberduck_ml_dev.models.components.attention import Attention
+
+
+class TestAttention:
+    def test_windowed_attention_parity(self):
+        torch.manual_seed(1234)
+        attention = Attention(
+            attention_rnn_dim=16,
+            embedding_dim=8,
+            attention_dim=8,
+            attention_location_n_filters=4,
+            attention_location_kernel_size=31,
+            fp16_run=False,
+            window_size=3,
+        )
+        B, T = 3, 20
+        query = torch.randn(B, 16)
+        memory = torch.randn(B, T, 8)
+        processed_memory = attention.memory_layer(memory)
+        # NOTE: previous peaks near the start, in the middle and at the end of the input.
+        previous_weights = torch.softmax(torch.randn(B, T), dim=1)
+        previous_weights[0, 1] = previous_weights[1, 12] = previous_weights[2, 19] = 1.0
+        attention_weights_cat = torch.stack(
+            (previous_weights, previous_weights.cumsum(dim=1)), dim=1
+        )
+        mask = torch.zeros(B, T, dtype=torch.bool)
+        mask[2, 18:] = True
+
+        positions = attention.window_positions(attention_weights_cat)
+        assert positions[:, 0].tolist() == [0, 9, 13]
+        energies = attention.get_alignment_energies(
+            query, processed_memory, attention_weights_cat
+        )
+        windowed_energies = attention.get_windowed_alignment_energies(
+            query, processed_memory, attention_weights_cat, positions
+        )
+        assert torch.allclose(
+            windowed_energies, torch.gather(energies, 1, positions), atol=1e-6
+        )
+
+        context, weights = attention(
+            query, memory, processed_memory, attention_weights_cat, mask, None
+        )
+        outside = torch.ones(B, T, dtype=torch.bool).scatter_(1, positions, False)
+        expected_weights = torch.softmax(
+            energies.masked_fill(outside | mask, -float("inf")), dim=1
+        )
+        assert torch.allclose(weights, expected_weights, atol=1e-6)
+        assert torch.allclose(
+            context, torch.bmm(expected_weights.unsqueeze(1), memory).squeeze(1)
+        )
+
+        attention.window_size = None
+        _, full_weights = attention(
+            query, memory, processed_memory, attention_weights_cat, mask, None
+        )
+        assert torch.allclose(
+            full_weights,
+            torch.softmax(energies.masked_fill(mask, -float("inf")), dim=1),
+            atol=1e-6,
+        )
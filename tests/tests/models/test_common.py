@@ -1,4 +1,5 @@
-from uberduck_ml_dev.models.common import MelSTFT
+from uberduck_ml_dev.models.common import MelSTFT, STL
+from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
 import torch
 
 
@@ -8,3 +9,17 @@ class TestCommon:
         mel = mel_stft.mel_spectrogram(torch.clip(torch.randn(1, 1000), -1, 1))
         assert mel.shape[0] == 1
         assert mel.shape[1] == 80
+
+    def test_stl_cache_key_values(self):
+        hp = HParams(
+            token_num=10, token_embedding_size=32, num_heads=4, ref_enc_gru_size=16
+        )
+        stl = STL(hp).eval()
+        inputs = torch.randn(3, 16)
+        with torch.no_grad():
+            expected = stl(inputs)
+            stl.cache_key_values()
+            output = stl(inputs)
+        assert output.shape == (3, 1, 32)
+        assert torch.allclose(output, expected, atol=1e-6)
+        assert "cached_keys" not in stl.state_dict()
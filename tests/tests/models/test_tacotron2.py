@@ -1,4 +1,6 @@
 import json
+import subprocess
+import sys
 import random
 from collections import Counter
 
@@ -8,11 +10,22 @@ import torch
 import numpy as np
 
 from uberduck_ml_dev.data_loader import prepare_input_sequence
-from uberduck_ml_dev.models.tacotron2 import Tacotron2, INFERENCE, LEFT_TEACHER_FORCED
+from uberduck_ml_dev.models.tacotron2 import (
+    Tacotron2,
+    Tacotron2Inference,
+    INFERENCE,
+    LEFT_TEACHER_FORCED,
+    TEACHER_FORCED,
+)
+from uberduck_ml_dev.models.components.decoders.tacotron2 import (
+    DECODER_MAX_STEPS,
+    DECODER_STALLED,
+)
 from uberduck_ml_dev.trainer.tacotron2 import (
     Tacotron2Trainer,
     DEFAULTS as TACOTRON2_TRAINER_DEFAULTS,
 )
+from uberduck_ml_dev.monitoring.statistics import get_inference_agreement
 from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
 
 
@@ -227,3 +240,324 @@ class TestTacotron2Model:
         vectors = np.asarray([original_vector_beginning, tf_estimate_vector_beginning])
         rho_beginning = np.corrcoef(vectors)
         assert rho_beginning[0, 1] > 0.98
+
+    def test_activation_checkpointing(self, tiny_tacotron2_hparams):
+        def run(decoder_checkpoint_steps, postnet_checkpoint):
+            hparams = HParams(**tiny_tacotron2_hparams.values())
+            hparams.p_teacher_forcing = 0.5
+            hparams.decoder_checkpoint_steps = decoder_checkpoint_steps
+            hparams.postnet_checkpoint = postnet_checkpoint
+            torch.manual_seed(1234)
+            model = Tacotron2(hparams)
+            model.train()
+            input_text = torch.randint(1, 50, (2, 12))
+            input_lengths = torch.LongTensor([12, 9])
+            targets = torch.randn(2, hparams.n_mel_channels, 23)
+            output_lengths = torch.LongTensor([23, 17])
+
+            torch.manual_seed(1235)
+            np.random.seed(1235)
+            output = model(
+                input_text=input_text,
+                input_lengths=input_lengths,
+                speaker_ids=None,
+                targets=targets,
+                output_lengths=output_lengths,
+            )
+            loss = (
+                output["mel_outputs"].pow(2).mean()
+                + output["mel_outputs_postnet"].pow(2).mean()
+                + output["gate_predicted"].mean()
+            )
+            loss.backward()
+            return model, output
+
+        model, output = run(0, False)
+        # NOTE: 23 steps in segments of 5 leaves a shorter final segment.
+        checkpointed_model, checkpointed_output = run(5, True)
+
+        for key in ["mel_outputs", "mel_outputs_postnet", "gate_predicted"]:
+            assert torch.allclose(output[key], checkpointed_output[key])
+        for (name, p), (_, checkpointed_p) in zip(
+            model.named_parameters(), checkpointed_model.named_parameters()
+        ):
+            assert torch.allclose(
+                p.grad, checkpointed_p.grad, atol=1e-6
+            ), f"gradient mismatch for {name}"
+        for (name, b), (_, checkpointed_b) in zip(
+            model.named_buffers(), checkpointed_model.named_buffers()
+        ):
+            assert torch.allclose(
+                b.float(), checkpointed_b.float()
+            ), f"buffer mismatch for {name}"
+
+    def test_n_frames_per_step(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.n_frames_per_step_initial = 3
+        hparams.max_decoder_steps = 10
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.set_current_frames_per_step(2)
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+        targets = torch.randn(2, hparams.n_mel_channels, 24)
+
+        output = model(
+            input_text=input_text,
+            input_lengths=input_lengths,
+            speaker_ids=None,
+            targets=targets,
+            output_lengths=torch.LongTensor([24, 17]),
+        )
+        assert output["mel_outputs_postnet"].shape == (2, hparams.n_mel_channels, 24)
+        assert output["gate_predicted"].shape == (2, 24)
+        # NOTE: one attention step per 2 frames.
+        assert output["alignments"].shape == (2, 12, 12)
+
+        model.eval()
+        with torch.no_grad():
+            output = model(
+                input_text=input_text,
+                input_lengths=input_lengths,
+                speaker_ids=None,
+                mode=INFERENCE,
+            )
+        assert output["mel_outputs_postnet"].size(2) % 2 == 0
+        assert (output["output_lengths"] % 2 == 0).all()
+
+    def test_per_frame_gate_inference(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.n_frames_per_step_initial = 3
+        hparams.per_frame_gate = True
+        hparams.max_decoder_steps = 4
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        gate_layer = model.decoder.gate_layer.linear_layer
+        gate_layer.weight.data.zero_()
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+
+        def infer():
+            with torch.no_grad():
+                return model(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=None,
+                    mode=INFERENCE,
+                )
+
+        # NOTE: the gate fires on the second frame of the first chunk.
+        gate_layer.bias.data = torch.tensor([-10.0, 10.0, -10.0])
+        output = infer()
+        assert output["mel_outputs_postnet"].size(2) == 3
+        assert output["gate_predicted"].shape == (2, 3)
+        assert output["output_lengths"].tolist() == [1, 1]
+
+        gate_layer.bias.data = torch.tensor([-10.0, -10.0, -10.0])
+        output = infer()
+        assert output["mel_outputs_postnet"].size(2) == 12
+        assert output["output_lengths"].tolist() == [12, 12]
+
+    def test_decoder_runaway_detection(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_frames_per_token = 2
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        # NOTE: the gate never fires.
+        model.decoder.gate_layer.linear_layer.weight.data.zero_()
+        model.decoder.gate_layer.linear_layer.bias.data.fill_(-10.0)
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+
+        def infer():
+            with torch.no_grad():
+                return model(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=None,
+                    mode=INFERENCE,
+                )
+
+        output = infer()
+        assert output["output_lengths"].tolist() == [24, 18]
+        assert output["decoder_status"].tolist() == [
+            DECODER_MAX_STEPS,
+            DECODER_MAX_STEPS,
+        ]
+
+        # NOTE: uniform attention keeps the focus on the first encoder position.
+        model.decoder.attention_layer.v.linear_layer.weight.data.zero_()
+        model.decoder.max_attention_stall_frames = 5
+        output = infer()
+        assert output["output_lengths"].tolist() == [6, 6]
+        assert output["decoder_status"].tolist() == [DECODER_STALLED, DECODER_STALLED]
+
+    def test_inference_alignments(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_steps = 20
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+
+        def infer(inference_alignments):
+            model.decoder.inference_alignments = inference_alignments
+            torch.manual_seed(1235)
+            with torch.no_grad():
+                return model(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=None,
+                    mode=INFERENCE,
+                )
+
+        full = infer("full")
+        values, indices = full["alignments"].max(dim=2)
+        peaks = infer("max")["alignments"]
+        assert torch.equal(peaks["values"], values)
+        assert torch.equal(peaks["indices"], indices)
+
+        top = infer("topk")["alignments"]
+        assert top["values"].shape == (2, full["alignments"].size(1), 4)
+        assert torch.equal(
+            top["values"], torch.gather(full["alignments"], 2, top["indices"])
+        )
+
+        output = infer("none")
+        assert output["alignments"] is None
+        assert torch.equal(output["mel_outputs_postnet"], full["mel_outputs_postnet"])
+
+    def test_freeze_for_inference(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.n_speakers = 3
+        hparams.has_speaker_embedding = True
+        hparams.max_decoder_steps = 20
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        # NOTE: non-trivial running statistics so that folding is exercised.
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+        model.eval()
+        frozen = model.freeze_for_inference()
+        assert frozen.frozen and not model.frozen
+        assert not any(isinstance(m, torch.nn.BatchNorm1d) for m in frozen.modules())
+        assert not any(p.requires_grad for p in frozen.parameters())
+
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+        speaker_ids = torch.LongTensor([2, 0])
+        targets = torch.randn(2, hparams.n_mel_channels, 16)
+        output_lengths = torch.LongTensor([16, 13])
+
+        def run(m, mode):
+            torch.manual_seed(1235)
+            with torch.no_grad():
+                return m(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=speaker_ids,
+                    mode=mode,
+                    targets=targets,
+                    output_lengths=output_lengths,
+                )
+
+        for mode in [TEACHER_FORCED, INFERENCE]:
+            expected = run(model, mode)
+            output = run(frozen, mode)
+            assert torch.equal(output["output_lengths"], expected["output_lengths"])
+            for key in ["mel_outputs", "mel_outputs_postnet", "alignments"]:
+                assert torch.allclose(output[key], expected[key], atol=1e-5)
+
+    def test_quantized_inference(self, tiny_tacotron2_hparams):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_steps = 50
+        torch.manual_seed(1234)
+        state_dict = Tacotron2(hparams).state_dict()
+        model = Tacotron2(hparams)
+        model.from_pretrained(model_dict=state_dict)
+        model.eval()
+        quantized = model.freeze_for_inference(quantize=True)
+        modules = dict(quantized.named_modules())
+        for name in quantized.quantized_layers():
+            assert type(modules[name]).__module__.startswith(
+                "torch.ao.nn.quantized.dynamic"
+            ), name
+        frozen = model.freeze_for_inference()
+
+        with open("tests/fixtures/ljtest/list_small.txt") as f:
+            texts = [line.split("|")[1] for line in f]
+        input_text, input_lengths = prepare_input_sequence(texts, cpu_run=True)[:2]
+
+        def run(m):
+            torch.manual_seed(1235)
+            with torch.no_grad():
+                return m(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=None,
+                    mode=INFERENCE,
+                )
+
+        agreement = get_inference_agreement(run(frozen), run(quantized), input_lengths)
+        assert agreement["mel_l1"] < 0.05
+        assert (
+            agreement["diagonalness"] - agreement["reference_diagonalness"]
+        ).abs() < 0.05
+        assert agreement["gate_stop_agreement"] == 1.0
+
+    def test_torchscript_inference(self, tiny_tacotron2_hparams, tmp_path):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.n_speakers = 3
+        hparams.has_speaker_embedding = True
+        hparams.max_decoder_frames_per_token = 2
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        # NOTE: the gate never fires, so both stop on the step budget.
+        model.decoder.gate_layer.linear_layer.bias.data.fill_(-10.0)
+        scripted = torch.jit.script(Tacotron2Inference(model))
+        input_text = torch.randint(1, 50, (2, 12))
+        input_lengths = torch.LongTensor([12, 9])
+        speaker_ids = torch.LongTensor([2, 0])
+
+        torch.manual_seed(1235)
+        with torch.no_grad():
+            expected = model(
+                input_text=input_text,
+                input_lengths=input_lengths,
+                speaker_ids=speaker_ids,
+                mode=INFERENCE,
+            )
+        torch.manual_seed(1235)
+        with torch.no_grad():
+            mel, mel_lengths, decoder_status = scripted(
+                input_text, input_lengths, speaker_ids
+            )
+        assert mel_lengths.tolist() == [24, 18]
+        assert torch.equal(mel_lengths, expected["output_lengths"])
+        assert torch.equal(decoder_status, expected["decoder_status"])
+        for i, length in enumerate(mel_lengths.tolist()):
+            assert torch.allclose(
+                mel[i, :, :length],
+                expected["mel_outputs_postnet"][i, :, :length],
+                atol=1e-5,
+            )
+
+        path = tmp_path / "tacotron2.pt"
+        torch.jit.save(scripted, str(path))
+        # NOTE: loading and running the saved module must not need uberduck_ml_dev.
+        script = (
+            "import sys, torch\n"
+            f"model = torch.jit.load({str(path)!r})\n"
+            "mel, lengths, _ = model(torch.randint(1, 50, (1, 7)), torch.LongTensor([7]), torch.LongTensor([1]))\n"
+            "assert lengths.tolist() == [14] and mel.shape == (1, 80, 14)\n"
+            "assert 'uberduck_ml_dev' not in sys.modules\n"
+        )
+        subprocess.run([sys.executable, "-c", script], check=True, cwd=tmp_path)
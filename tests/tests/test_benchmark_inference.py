@@ -0,0 +1,46 @@
+from uberduck_ml_dev import e2e
+from uberduck_ml_dev.exec.benchmark_inference import (
+    STAGES,
+    benchmark,
+    compare,
+    random_models,
+)
+
+
+class TestBenchmarkInference:
+    def test_benchmark(self, tiny_tacotron2_hparams, tmp_path):
+        model, vocoder = random_models(
+            tiny_tacotron2_hparams,
+            dict(upsample_initial_channel=32),
+            directory=str(tmp_path),
+        )
+        corpus = ["Hello world.", "Hi there, how are you?"]
+        results = benchmark(
+            model,
+            vocoder,
+            corpus=corpus,
+            batch_sizes=[1, 2],
+            repeats=1,
+            denoiser_strength=10,
+        )
+        assert [r["batch_size"] for r in results] == [1, 2]
+        for result in results:
+            assert set(result["stages"]) == set(STAGES)
+            assert result["stages"]["decoder_step"] <= result["stages"]["decoder"]
+            assert result["stages"]["denoiser"] > 0
+            assert result["rtf"] > 0
+            assert result["peak_memory_mb"] > 0
+        # NOTE: 6 frames per token, decoded one line at a time.
+        n_tokens = [len("hello world."), len("hi there, how are you?")]
+        assert results[0]["decoder_steps"] == sum(6 * n for n in n_tokens)
+        # NOTE: the instrumented methods are restored.
+        assert "forward" not in vars(model.encoder)
+        assert e2e.prepare_input_sequence.__name__ == "prepare_input_sequence"
+
+        assert compare(results, results) == []
+        baseline = [dict(r, rtf=r["rtf"] / 2) for r in results]
+        regressions = compare(results, baseline, tolerance=0.5)
+        assert [(r["batch_size"], r["metric"]) for r in regressions] == [
+            (1, "rtf"),
+            (2, "rtf"),
+        ]
@@ -0,0 +1,51 @@
+import copy
+
+from uberduck_ml_dev.exec.benchmark_micro import compare, run, synthetic_data
+from uberduck_ml_dev.utils.utils import load_filepaths_and_text
+
+
+class TestBenchmarkMicro:
+    def test_synthetic_data(self, tmp_path):
+        first = load_filepaths_and_text(synthetic_data(str(tmp_path / "a")))
+        second = load_filepaths_and_text(synthetic_data(str(tmp_path / "b")))
+        assert len(first) == 8
+        assert [line[1:] for line in first] == [line[1:] for line in second]
+        with open(first[0][0], "rb") as f, open(second[0][0], "rb") as g:
+            assert f.read() == g.read()
+
+    def test_run_compare(self):
+        report = run(
+            names=["text_mel_collate", "compute_yin"],
+            sizes=["small"],
+            repeats=5,
+            min_sample_seconds=0.001,
+        )
+        assert [(r["benchmark"], r["size"]) for r in report["results"]] == [
+            ("text_mel_collate", "small"),
+            ("compute_yin", "small"),
+        ]
+        assert all(len(r["samples"]) == 5 for r in report["results"])
+
+        slower = copy.deepcopy(report)
+        result = slower["results"][1]
+        result["samples"] = [2 * s for s in result["samples"]]
+        result["median"] *= 2
+        rows = compare(report, slower)
+        assert [row["status"] for row in rows] == ["unchanged", "slower"]
+        assert rows[1]["change"] == 1.0
+        assert [row["status"] for row in compare(slower, report)] == [
+            "unchanged",
+            "faster",
+        ]
+
+    def test_fused_mrf_launches(self):
+        report = run(
+            names=["inference_generator", "inference_generator_fused"],
+            sizes=["small"],
+            repeats=1,
+            min_sample_seconds=0.001,
+        )
+        unfused, fused = [r["conv_launches"] for r in report["results"]]
+        # NOTE: the 3 ResBlocks of each of the 4 MRF stages share their dilations,
+        # so their 3 * 6 convolutions become 6 grouped ones.
+        assert unfused - fused == 4 * 2 * 6
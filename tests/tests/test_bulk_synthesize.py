@@ -0,0 +1,72 @@
+import json
+import os
+
+import torch
+
+from uberduck_ml_dev.exec.bulk_synthesize import run
+from uberduck_ml_dev.models.tacotron2 import Tacotron2
+
+
+class TestBulkSynthesize:
+    def test_resume(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        hparams = tiny_tacotron2_hparams
+        hparams.max_decoder_steps = 30
+        torch.manual_seed(1234)
+        checkpoint = str(tmp_path / "tacotron2.pt")
+        torch.save(Tacotron2(hparams).to_checkpoint(), checkpoint)
+        h, hifigan_checkpoint = tiny_hifigan
+        input_path = str(tmp_path / "lines.txt")
+        with open(input_path, "w") as f:
+            f.write(
+                "Hello world.\n"
+                "greeting|Hi there, how are you?\n"
+                "\n"
+                "A somewhat longer line of text.\n"
+                "b|Short.|0\n"
+                "Another line.\n"
+                "The last one.\n"
+            )
+
+        def synthesize(output_dir, **kwargs):
+            return run(
+                input_path,
+                str(output_dir),
+                checkpoint,
+                dict(h),
+                hifigan_checkpoint,
+                hparams=hparams,
+                window_size=3,
+                batch_size=2,
+                **kwargs,
+            )
+
+        report = synthesize(tmp_path / "full")
+        assert report["lines"] == 7
+        assert report["shards"] == 2
+        assert report["rtf"] > 0
+
+        resumed = tmp_path / "resumed"
+        assert synthesize(resumed, max_windows=1)["shards"] == 1
+        # NOTE: a job killed while writing its second shard.
+        with open(resumed / "shard-00001.tar.tmp", "w") as f:
+            f.write("partial")
+        with open(resumed / "index.jsonl", "a") as f:
+            f.write(json.dumps(dict(id="stale", shard_index=1)) + "\n")
+        assert synthesize(resumed)["lines_this_run"] == 3
+
+        with open(tmp_path / "full" / "index.jsonl") as f:
+            index = [json.loads(line) for line in f]
+        with open(resumed / "index.jsonl") as f:
+            assert [json.loads(line) for line in f] == index
+        assert [entry["id"] for entry in index] == [
+            "000000000",
+            "greeting",
+            "000000003",
+            "b",
+            "000000005",
+            "000000006",
+        ]
+        for shard in ("shard-00000.tar", "shard-00001.tar"):
+            with open(tmp_path / "full" / shard, "rb") as full:
+                with open(resumed / shard, "rb") as f:
+                    assert f.read() == full.read()
@@ -0,0 +1,87 @@
+import torch
+
+from uberduck_ml_dev.data_loader import prepare_input_sequence
+from uberduck_ml_dev.e2e import tts, tts_batch, tts_long, crossfade_concat
+from uberduck_ml_dev.text.util import chunk_text
+from uberduck_ml_dev.models.tacotron2 import Tacotron2, INFERENCE
+from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
+from uberduck_ml_dev.vocoders.hifigan import HiFiGanGenerator
+
+
+class TestTTS:
+    def test_batched_vocoding(self, tiny_tacotron2_hparams, tiny_hifigan):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_steps = 60
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        h, checkpoint = tiny_hifigan
+        vocoder = HiFiGanGenerator(dict(h), checkpoint)
+
+        lines = ["Hello world.", "A much longer line of text to synthesize.", "Hi."]
+        torch.manual_seed(1)
+        audios = tts_batch(
+            lines, model, "cpu", vocoder, speaker_ids=None, bucket_length=16
+        )
+        torch.manual_seed(1)
+        sequences, input_lengths = prepare_input_sequence(lines, cpu_run=True)
+        with torch.no_grad():
+            output = model(sequences, input_lengths, None, mode=INFERENCE)
+        assert len(audios) == len(lines)
+        for idx, audio in enumerate(audios):
+            length = output["output_lengths"][idx].item()
+            assert audio.shape == (length * 256,)
+            mel = output["mel_outputs_postnet"][idx : idx + 1, :, :length]
+            with torch.no_grad():
+                expected = vocoder.vocoder(mel)[0, 0].clamp(-1, 1) * 32768.0
+            # NOTE: padding only changes the frames within the receptive field of the end.
+            n = length // 2 * 256
+            assert torch.allclose(audio[:n], expected[:n], atol=1.0)
+
+        torch.manual_seed(1)
+        joined = tts(lines, model, "cpu", vocoder, silence_seconds=0.1)
+        silence = int(0.1 * h.sampling_rate)
+        assert joined.shape == (1, sum(a.numel() for a in audios) + 2 * silence)
+        # NOTE: by default the lines are joined without silence, as one (1, samples) tensor.
+        torch.manual_seed(1)
+        joined = tts(lines, model, "cpu", vocoder)
+        assert joined.shape == (1, sum(a.numel() for a in audios))
+
+    def test_crossfade_concat(self):
+        audios = [torch.ones(100), torch.ones(50), torch.ones(80)]
+        joined = crossfade_concat(audios, [0.0, 0.2], 100, crossfade_seconds=0.1)
+        # NOTE: the first join overlaps by the 10 sample fade, the second is a pause.
+        assert joined.shape == (100 + 50 - 10 + 20 - 10 + 80,)
+        fade_in = torch.arange(10) / 10
+        assert torch.allclose(joined[:130], torch.ones(130))
+        assert torch.allclose(joined[130:140], 1 - fade_in)
+        assert torch.allclose(joined[140:150], torch.zeros(10))
+        assert torch.allclose(joined[150:160], fade_in)
+        assert torch.allclose(joined[160:], torch.ones(70))
+
+    def test_tts_long(self, tiny_tacotron2_hparams, tiny_hifigan):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_steps = 40
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        h, checkpoint = tiny_hifigan
+        vocoder = HiFiGanGenerator(dict(h), checkpoint)
+
+        text = "Hello world. This is a much longer sentence, with a clause. Hi."
+        audio = tts_long(text, model, "cpu", vocoder, max_tokens=32, seed=1)
+        chunks = chunk_text(text, max_tokens=32)
+        assert len(chunks) == 4
+        # NOTE: the chunks are synthesized longest first and joined in text order.
+        order = sorted(range(len(chunks)), key=lambda idx: -len(chunks[idx][0]))
+        sorted_audios = tts_batch(
+            [chunks[idx][0] for idx in order], model, "cpu", vocoder, seed=1
+        )
+        audios = [None] * len(chunks)
+        for idx, chunk_audio in zip(order, sorted_audios):
+            audios[idx] = chunk_audio
+        expected = crossfade_concat(audios, [0.3, 0.1, 0.3], h.sampling_rate)
+        assert torch.equal(audio[0], expected)
+
+        for text in ["", "  \n "]:
+            assert tts_long(text, model, "cpu", vocoder).shape == (1, 0)
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+import torch
+
+from uberduck_ml_dev.models.tacotron2 import Tacotron2, INFERENCE
+from uberduck_ml_dev.models.components.decoders.tacotron2 import (
+    DECODER_FINISHED,
+    DECODER_MAX_STEPS,
+)
+from uberduck_ml_dev.onnx_inference import (
+    Tacotron2EncoderGraph,
+    export_tacotron2,
+    export_hifigan_generator,
+    OnnxTacotron2,
+    OnnxHiFiGan,
+)
+from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
+from uberduck_ml_dev.vocoders.hifigan import Generator, AttrDict, DEFAULTS
+
+ort = pytest.importorskip("onnxruntime")
+
+
+class TestOnnxInference:
+    def test_tacotron2(self, tiny_tacotron2_hparams, tmp_path):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.n_speakers = 3
+        hparams.has_speaker_embedding = True
+        hparams.max_decoder_frames_per_token = 2
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        # NOTE: deterministic decoding that stops on the step budget.
+        model.decoder.gate_layer.linear_layer.bias.data.fill_(-10.0)
+        model.decoder.prenet.dropout_rate = 0.0
+        export_tacotron2(model, str(tmp_path))
+        onnx_model = OnnxTacotron2(str(tmp_path))
+
+        for input_lengths, speaker_ids in [([12, 9], [2, 0]), ([7], [1])]:
+            input_lengths = torch.LongTensor(input_lengths)
+            speaker_ids = torch.LongTensor(speaker_ids)
+            input_text = torch.randint(1, 50, (len(input_lengths), max(input_lengths)))
+            with torch.no_grad():
+                expected = model(
+                    input_text=input_text,
+                    input_lengths=input_lengths,
+                    speaker_ids=speaker_ids,
+                    mode=INFERENCE,
+                )
+                graph = Tacotron2EncoderGraph(model)
+                memory, _, _ = graph(input_text, input_lengths, speaker_ids)
+                embedded = model.embedding(input_text).transpose(1, 2)
+                expected_memory = model.encoder(embedded, input_lengths)
+                expected_memory += model.spkr_lin(model.speaker_embedding(speaker_ids))[
+                    :, None
+                ]
+            assert torch.allclose(memory, expected_memory, atol=1e-5)
+
+            mel, mel_lengths, decoder_status = onnx_model(
+                input_text.numpy(), input_lengths.numpy(), speaker_ids.numpy()
+            )
+            assert mel_lengths.tolist() == expected["output_lengths"].tolist()
+            assert decoder_status.tolist() == expected["decoder_status"].tolist()
+            for i, length in enumerate(mel_lengths.tolist()):
+                np.testing.assert_allclose(
+                    mel[i, :, :length],
+                    expected["mel_outputs_postnet"][i, :, :length].numpy(),
+                    atol=1e-5,
+                )
+
+    def test_tacotron2_gate(self, tiny_tacotron2_hparams, tmp_path):
+        hparams = HParams(**tiny_tacotron2_hparams.values())
+        hparams.max_decoder_frames_per_token = 2
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        model.eval()
+        # NOTE: a gate energy that rises steadily with the decoder steps, so the
+        # gate fires after a few steps for the first sequence while the second
+        # one runs into its step budget.
+        model.decoder.gate_layer.linear_layer.weight.data *= 100.0
+        model.decoder.gate_layer.linear_layer.bias.data.fill_(0.78)
+        model.decoder.prenet.dropout_rate = 0.0
+        input_lengths = torch.LongTensor([12, 9])
+        speaker_ids = torch.LongTensor([0, 0])
+        input_text = torch.randint(1, 50, (2, 12))
+        export_tacotron2(model, str(tmp_path))
+        onnx_model = OnnxTacotron2(str(tmp_path))
+
+        with torch.no_grad():
+            expected = model(
+                input_text=input_text,
+                input_lengths=input_lengths,
+                speaker_ids=speaker_ids,
+                mode=INFERENCE,
+            )
+        assert expected["decoder_status"].tolist() == [
+            DECODER_FINISHED,
+            DECODER_MAX_STEPS,
+        ]
+        assert 0 < expected["output_lengths"][0] < 2 * input_lengths[0]
+
+        mel, mel_lengths, decoder_status = onnx_model(
+            input_text.numpy(), input_lengths.numpy(), speaker_ids.numpy()
+        )
+        assert mel_lengths.tolist() == expected["output_lengths"].tolist()
+        assert decoder_status.tolist() == expected["decoder_status"].tolist()
+        np.testing.assert_allclose(
+            mel, expected["mel_outputs_postnet"].numpy(), atol=1e-5
+        )
+
+    def test_hifigan(self, tmp_path):
+        torch.manual_seed(1234)
+        h = AttrDict(DEFAULTS)
+        h.upsample_initial_channel = 32
+        generator = Generator(h)
+        path = str(tmp_path / "hifigan.onnx")
+        export_hifigan_generator(generator, path)
+
+        generator.remove_weight_norm()
+        generator.eval()
+        mel = torch.randn(2, 80, 20)
+        with torch.no_grad():
+            expected = generator(mel)
+        audio = OnnxHiFiGan(path)(mel.numpy())
+        assert audio.shape == (2, 20 * 256)
+        assert audio.dtype == np.int16
+        expected = (expected[:, 0] * 32768).clamp(-32768, 32767)
+        expected = expected.numpy().astype(np.int16)
+        assert np.abs(audio.astype(np.int32) - expected).max() <= 1
+
+        # NOTE: full scale audio saturates instead of wrapping around.
+        loud = OnnxHiFiGan(path)(mel.numpy(), max_wav_value=1e6)
+        peaks = np.abs(expected.astype(np.int32)) > 2000
+        assert (np.sign(loud[peaks]) == np.sign(expected[peaks])).all()
+        assert np.abs(loud[peaks].astype(np.int32)).min() >= 32767
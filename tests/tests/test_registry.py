@@ -0,0 +1,123 @@
+import threading
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from uberduck_ml_dev.models.tacotron2 import Tacotron2
+from uberduck_ml_dev.monitoring.generate import _get_inference, _load_tacotron2
+from uberduck_ml_dev.registry import ModelRegistry, load_hifigan, model_nbytes
+from uberduck_ml_dev.vocoders.hifigan import HiFiGanGenerator
+
+
+class TestModelRegistry:
+    def test_lru_eviction(self):
+        loads = []
+
+        def loader(name):
+            def load():
+                loads.append(name)
+                return nn.Linear(16, 16)
+
+            return load
+
+        nbytes = model_nbytes(nn.Linear(16, 16))
+        registry = ModelRegistry(memory_budget=2 * nbytes)
+        a = registry.get("a.pt", dict(n=1), loader("a"))
+        registry.get("b.pt", dict(n=1), loader("b"))
+        assert registry.get("a.pt", dict(n=1), loader("a")) is a
+        # NOTE: b is the least recently used model when c is loaded.
+        registry.get("c.pt", dict(n=1), loader("c"))
+        assert registry.get("a.pt", dict(n=1), loader("a")) is a
+        registry.get("b.pt", dict(n=1), loader("b"))
+        # NOTE: a different config is a different model.
+        registry.get("b.pt", dict(n=2), loader("b2"))
+        assert loads == ["a", "b", "c", "b", "b2"]
+
+        metrics = registry.metrics()
+        assert metrics["hits"] == 2
+        assert metrics["misses"] == 5
+        assert metrics["evictions"] == 3
+        assert metrics["resident"] == 2
+        assert metrics["resident_bytes"] <= registry.memory_budget
+
+    def test_concurrent_loads_deduplicate(self):
+        registry = ModelRegistry()
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.2)
+            return nn.Linear(4, 4)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(registry.get("a.pt", {}, loader))
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(loads) == 1
+        assert all(model is results[0] for model in results)
+        metrics = registry.metrics()
+        assert metrics["misses"] == 1
+        assert metrics["deduplicated"] == 3
+        assert metrics["load_seconds"] >= 0.2
+
+    def test_load_hifigan(self, tiny_hifigan):
+        h, checkpoint = tiny_hifigan
+        registry = ModelRegistry()
+        vocoder = load_hifigan(dict(h), checkpoint, registry=registry)
+        assert isinstance(vocoder, HiFiGanGenerator)
+        assert load_hifigan(dict(h), checkpoint, registry=registry) is vocoder
+        assert registry.metrics()["hits"] == 1
+
+    def test_monitoring_loads_through_registry(
+        self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path
+    ):
+        hparams = tiny_tacotron2_hparams
+        hparams.max_decoder_steps = 10
+        state_dict = Tacotron2(hparams).state_dict()
+        torch.save(state_dict, tmp_path / "od.pt")
+        torch.save(dict(model=state_dict), tmp_path / "d.pt")
+        registry = ModelRegistry()
+        models = {
+            model_format: _load_tacotron2(
+                str(tmp_path / f"{model_format.lower()}.pt"),
+                model_format,
+                hparams,
+                "cpu",
+                registry=registry,
+            )
+            for model_format in ["OD", "D"]
+        }
+        for model_format, model in models.items():
+            assert not model.training
+            assert torch.equal(
+                model.state_dict()["embedding.weight"], state_dict["embedding.weight"]
+            )
+            path = str(tmp_path / f"{model_format.lower()}.pt")
+            assert (
+                _load_tacotron2(path, model_format, hparams, "cpu", registry=registry)
+                is model
+            )
+        assert registry.metrics()["hits"] == 2
+
+        h, checkpoint = tiny_hifigan
+        vocoder = load_hifigan(dict(h), checkpoint, registry=registry)
+        audio = _get_inference(
+            models["D"],
+            vocoder,
+            ["Hello."],
+            torch.LongTensor([0]),
+            "nvidia_taco2",
+            False,
+            True,
+        )
+        assert audio.dtype == np.int16
+        assert audio.ndim == 1 and audio.size > 0
@@ -0,0 +1,222 @@
+import asyncio
+import io
+import json
+import os
+import signal
+import urllib.request
+
+import torch
+from scipy.io.wavfile import read
+
+from uberduck_ml_dev.exec import load_test
+from uberduck_ml_dev.exec.serve import DynamicBatcher, TTSServer
+from uberduck_ml_dev.models.tacotron2 import Tacotron2
+from uberduck_ml_dev.registry import ModelRegistry
+
+
+def _get(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+
+class TestDynamicBatcher:
+    def test_batching(self):
+        batches = []
+
+        def process_batch(key, items):
+            batches.append((key, items))
+            return [item * 2 for item in items]
+
+        async def main():
+            batcher = DynamicBatcher(process_batch, max_batch_size=4, max_wait=0.05)
+            results = await asyncio.gather(
+                *[batcher.submit("a", i) for i in range(5)],
+                *[batcher.submit("b", i) for i in range(2)],
+            )
+            await batcher.drain()
+            await batcher.close()
+            return results
+
+        results = asyncio.run(main())
+        assert results == [0, 2, 4, 6, 8, 0, 2]
+        assert sorted((key, len(items)) for key, items in batches) == [
+            ("a", 1),
+            ("a", 4),
+            ("b", 2),
+        ]
+
+
+def _voices(hparams, tmp_path, tiny_hifigan):
+    hparams.max_decoder_steps = 30
+    torch.manual_seed(1234)
+    checkpoint = str(tmp_path / "tacotron2.pt")
+    torch.save(Tacotron2(hparams).to_checkpoint(), checkpoint)
+    h, hifigan_checkpoint = tiny_hifigan
+    return dict(
+        test=dict(
+            checkpoint=checkpoint,
+            hparams=hparams,
+            hifigan_config=dict(h),
+            hifigan_checkpoint=hifigan_checkpoint,
+        )
+    )
+
+
+class TestTTSServer:
+    def test_serve(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        voices = _voices(tiny_tacotron2_hparams, tmp_path, tiny_hifigan)
+        server = TTSServer(
+            voices, max_batch_size=4, max_wait=0.5, registry=ModelRegistry()
+        )
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            port = await server.start(port=0)
+            url = f"http://127.0.0.1:{port}"
+            health = await loop.run_in_executor(None, _get, f"{url}/health")
+            report = await loop.run_in_executor(
+                None,
+                lambda: load_test.run(
+                    url, ["test"], ["Hello world."], concurrency=4, n_requests=4
+                ),
+            )
+            metrics = await loop.run_in_executor(None, _get, f"{url}/metrics")
+            drain = urllib.request.Request(f"{url}/drain", method="POST")
+            await loop.run_in_executor(None, urllib.request.urlopen, drain)
+            await server.wait_stopped()
+            return health, report, metrics
+
+        health, report, metrics = asyncio.run(main())
+        assert health == dict(status="ok", voices=["test"])
+        assert report["errors"] == 0
+        assert report["audio_seconds_per_second"] > 0
+        assert metrics["requests"] == 4
+        # NOTE: concurrent requests for the same voice are synthesized together.
+        assert metrics["batches"] < 4
+        assert metrics["registry"]["misses"] == 2
+        assert server.draining
+
+    def test_full_scale(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        voices = _voices(tiny_tacotron2_hparams, tmp_path, tiny_hifigan)
+        # NOTE: a large conv_post bias saturates the tanh, so every sample is full scale.
+        checkpoint = torch.load(voices["test"]["hifigan_checkpoint"])
+        checkpoint["generator"]["conv_post.bias"].fill_(100.0)
+        voices["test"]["hifigan_checkpoint"] = str(tmp_path / "saturated.pt")
+        torch.save(checkpoint, voices["test"]["hifigan_checkpoint"])
+        server = TTSServer(voices, registry=ModelRegistry())
+
+        def synthesize(url):
+            request = urllib.request.Request(
+                f"{url}/synthesize",
+                data=json.dumps(dict(voice="test", text="Hello world.")).encode(),
+            )
+            with urllib.request.urlopen(request) as response:
+                return read(io.BytesIO(response.read()))[1]
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            url = f"http://127.0.0.1:{await server.start(port=0)}"
+            audio = await loop.run_in_executor(None, synthesize, url)
+            await server.drain()
+            await server.wait_stopped()
+            return audio
+
+        audio = asyncio.run(main())
+        assert len(audio) > 0
+        assert (audio == 32767).all()
+
+    def test_serve_workers(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        voices = _voices(tiny_tacotron2_hparams, tmp_path, tiny_hifigan)
+        server = TTSServer(
+            voices,
+            max_batch_size=2,
+            max_wait=0.2,
+            registry=ModelRegistry(),
+            workers=2,
+            num_threads=1,
+        )
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            url = f"http://127.0.0.1:{await server.start(port=0)}"
+            report = await loop.run_in_executor(
+                None,
+                lambda: load_test.run(
+                    url, ["test"], ["Hello world."], concurrency=4, n_requests=8
+                ),
+            )
+            metrics = await loop.run_in_executor(None, _get, f"{url}/metrics")
+            await server.drain()
+            await server.wait_stopped()
+            return report, metrics
+
+        report, metrics = asyncio.run(main())
+        assert report["errors"] == 0
+        workers = metrics["workers"]
+        assert len(workers) == 2
+        assert sum(w["batches"] for w in workers) == metrics["batches"]
+        assert all(w["rss_mb"] > 0 for w in workers)
+        assert not server.pool.workers
+
+    def test_worker_restart(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        voices = _voices(tiny_tacotron2_hparams, tmp_path, tiny_hifigan)
+        server = TTSServer(voices, registry=ModelRegistry(), workers=1, num_threads=1)
+        pid = server.pool.workers[0]["process"].pid
+        os.kill(pid, signal.SIGKILL)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            url = f"http://127.0.0.1:{await server.start(port=0)}"
+            reports = []
+            for _ in range(2):
+                reports.append(
+                    await loop.run_in_executor(
+                        None,
+                        lambda: load_test.run(
+                            url, ["test"], ["Hello."], concurrency=1, n_requests=1
+                        ),
+                    )
+                )
+            metrics = await loop.run_in_executor(None, _get, f"{url}/metrics")
+            await server.drain()
+            await server.wait_stopped()
+            return reports, metrics
+
+        reports, metrics = asyncio.run(main())
+        # NOTE: the batch sent to the dead worker fails, the next one runs on its replacement.
+        assert [report["errors"] for report in reports] == [1, 0]
+        (worker,) = metrics["workers"]
+        assert worker["restarts"] == 1
+        assert worker["pid"] != pid
+
+    def test_max_body_bytes(self):
+        server = TTSServer({}, registry=ModelRegistry(), max_body_bytes=64)
+
+        async def request(content_length, body=b""):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(
+                (
+                    "POST /synthesize HTTP/1.1\r\n"
+                    f"Content-Length: {content_length}\r\n\r\n"
+                ).encode()
+                + body
+            )
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response.split(b"\r\n", 1)[0]
+
+        async def main():
+            nonlocal port
+            port = await server.start(port=0)
+            # NOTE: the oversized body is never sent, the server answers from the headers.
+            too_large = await request(1 << 30)
+            small = await request(2, b"{}")
+            await server.drain()
+            await server.wait_stopped()
+            return too_large, small
+
+        port = None
+        too_large, small = asyncio.run(main())
+        assert too_large == b"HTTP/1.1 413 Request Entity Too Large"
+        assert small == b"HTTP/1.1 400 Bad Request"
@@ -0,0 +1,100 @@
+import torch
+
+from uberduck_ml_dev.e2e import tts_batch
+from uberduck_ml_dev.models.tacotron2 import Tacotron2
+from uberduck_ml_dev.synthesis_cache import SynthesisCache
+from uberduck_ml_dev.vocoders.hifigan import (
+    AttrDict,
+    DEFAULTS,
+    Generator,
+    HiFiGanGenerator,
+)
+
+
+class TestSynthesisCache:
+    def test_tiers(self, tmp_path):
+        audio = torch.arange(100, dtype=torch.int16)
+        cache = SynthesisCache(
+            cache_dir=str(tmp_path), memory_budget=250, disk_budget=2000
+        )
+        cache.put("a", audio)
+        cache.put("b", audio)
+        # NOTE: a is evicted from memory but still on disk.
+        assert torch.equal(cache.get("b"), audio)
+        assert torch.equal(cache.get("a"), audio)
+        assert cache.get("c") is None
+        metrics = cache.metrics()
+        assert metrics["memory_hits"] == 1
+        assert metrics["disk_hits"] == 1
+        assert metrics["misses"] == 1
+        assert metrics["bytes_saved"] == 2 * audio.nbytes
+
+        reopened = SynthesisCache(cache_dir=str(tmp_path), disk_budget=2000)
+        assert torch.equal(reopened.get("b"), audio)
+        for key in "cdefgh":
+            reopened.put(key, audio)
+        assert reopened.metrics()["disk_bytes"] <= 2000
+        assert reopened.metrics()["disk_evictions"] > 0
+        assert reopened.get("a") is None
+
+    def test_key_settings(self, tiny_tacotron2_hparams):
+        model = Tacotron2(tiny_tacotron2_hparams).eval()
+        vocoder = Generator(AttrDict(DEFAULTS))
+
+        def key(**params):
+            return SynthesisCache.key(
+                "Hello.", 0, model, vocoder, "nvidia_taco2", **params
+            )
+
+        keys = {key(bucket_length=64), key(bucket_length=16)}
+        model.decoder.attention_layer.window_size = 8
+        keys.add(key(bucket_length=64))
+        model.decoder.set_current_frames_per_step(2)
+        keys.add(key(bucket_length=64))
+        model.decoder.max_attention_stall_frames = 100
+        keys.add(key(bucket_length=64))
+        assert len(keys) == 5
+
+    def test_tts(self, tiny_tacotron2_hparams, tiny_hifigan, tmp_path):
+        hparams = tiny_tacotron2_hparams
+        hparams.max_decoder_steps = 30
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams).eval()
+        h, checkpoint = tiny_hifigan
+        vocoder = HiFiGanGenerator(dict(h), checkpoint)
+
+        cache = SynthesisCache(cache_dir=str(tmp_path / "cache"))
+        lines = ["Hello world.", "Hi."]
+        audios = tts_batch(lines, model, "cpu", vocoder, cache=cache, seed=1)
+        assert cache.metrics()["misses"] == 2
+        # NOTE: the cleaned text is the same, so the line is a hit.
+        cached = tts_batch(
+            ["hello   WORLD.", "Hi."], model, "cpu", vocoder, cache=cache, seed=1
+        )
+        assert cache.metrics()["hits"] == 2
+        for audio, expected in zip(cached, audios):
+            assert torch.equal(audio, expected)
+        tts_batch(lines, model, "cpu", vocoder, cache=cache, seed=2)
+        assert cache.metrics()["misses"] == 4
+
+        # NOTE: without a seed prenet dropout makes the audio nondeterministic.
+        tts_batch(lines, model, "cpu", vocoder, cache=cache)
+        assert cache.metrics()["uncacheable"] == 2
+
+    def test_seed_per_line(self, tiny_tacotron2_hparams, tiny_hifigan):
+        hparams = tiny_tacotron2_hparams
+        hparams.max_decoder_steps = 30
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams).eval()
+        h, checkpoint = tiny_hifigan
+        vocoder = HiFiGanGenerator(dict(h), checkpoint)
+
+        lines = ["A somewhat longer line of text.", "Hello world.", "Hi."]
+        batched = tts_batch(lines, model, "cpu", vocoder, seed=1)
+        # NOTE: a partly warm cache synthesizes the line alone.
+        alone = tts_batch(["Hello world."], model, "cpu", vocoder, seed=1)
+        assert torch.allclose(alone[0], batched[1], atol=1.0)
+        assert not torch.allclose(
+            tts_batch(["Hello world."], model, "cpu", vocoder, seed=2)[0][:100],
+            alone[0][:100],
+        )
@@ -1,4 +1,5 @@
 from uberduck_ml_dev.text.util import (
+    chunk_text,
     cleaned_text_to_sequence,
     text_to_sequence,
     DEFAULT_SYMBOLS,
@@ -107,3 +108,30 @@ class TestTextUtils:
             86,
             86,
         ]
+
+    def test_chunk_text(self):
+        text = (
+            "Dr. Smith arrived on Tuesday! He was late, tired, and hungry; nobody "
+            "seemed to mind, because the meeting was mostly a formality. Was it?"
+        )
+        chunks = chunk_text(text, max_tokens=40)
+        assert chunks[0] == ("doctor smith arrived on tuesday!", "sentence")
+        assert [boundary for _, boundary in chunks] == [
+            "sentence",
+            "clause",
+            "clause",
+            "word",
+            "sentence",
+            "sentence",
+        ]
+        assert all(len(text_to_sequence(c, [])) <= 40 for c, _ in chunks)
+        assert " ".join(c for c, _ in chunks) == (
+            "doctor smith arrived on tuesday! he was late, tired, and hungry; nobody "
+            "seemed to mind, because the meeting was mostly a formality. was it?"
+        )
+        words = chunk_text("one two three four five six", max_tokens=10)
+        assert words == [
+            ("one two", "word"),
+            ("three four", "word"),
+            ("five six", "sentence"),
+        ]
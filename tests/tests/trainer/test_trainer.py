@@ -1,8 +1,78 @@
 from uberduck_ml_dev.trainer.base import TTSTrainer
+import os
+import tempfile
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import math
+import pytest
 from uberduck_ml_dev.vendor.tfcompat.hparam import HParams
 from uberduck_ml_dev.trainer.base import DEFAULTS as TRAINER_DEFAULTS
+from uberduck_ml_dev.trainer.tacotron2 import (
+    Tacotron2Trainer,
+    DEFAULTS as TACOTRON2_TRAINER_DEFAULTS,
+)
+from uberduck_ml_dev.models.tacotron2 import Tacotron2
+from uberduck_ml_dev.losses import Tacotron2Loss
+from uberduck_ml_dev.data_loader import TextMelDataset
+from uberduck_ml_dev.utils.utils import reduce_tensor
+from tests.conftest import TINY_TACOTRON2_OVERRIDES
+
+
+def _run_distributed_worker(rank, world_size, init_method, log_dir, results_path):
+    config = TACOTRON2_TRAINER_DEFAULTS.values()
+    config.update(TINY_TACOTRON2_OVERRIDES)
+    config.update(
+        dict(
+            training_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+            val_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+            checkpoint_name="test",
+            checkpoint_path=log_dir,
+            log_dir=log_dir,
+            epochs=1,
+            debug=False,
+            batch_size=2,
+            p_arpabet=0.0,
+            is_validate=False,
+            steps_per_sample=1000,
+            distributed_run=True,
+            distributed_backend="gloo",
+            distributed_init_method=init_method,
+        )
+    )
+    hparams = HParams(**config)
+    trainer = Tacotron2Trainer(hparams, rank=rank, world_size=world_size)
+    trainer.init_distributed()
+    train_set, _, train_loader, sampler, _ = trainer.initialize_loader()
+    model = Tacotron2(hparams)
+    parallel_model = trainer.wrap_distributed(model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-2)
+    batch = next(iter(train_loader))
+    output = parallel_model(
+        input_text=batch["text_int_padded"],
+        input_lengths=batch["input_lengths"],
+        speaker_ids=batch["speaker_ids"],
+        targets=batch["mel_padded"],
+        output_lengths=batch["output_lengths"],
+    )
+    mel_loss, gate_loss, _, _ = Tacotron2Loss(pos_weight=None)(
+        model_output=output, target=batch.subset(["gate_target", "mel_padded"])
+    )
+    (mel_loss + gate_loss).backward()
+    optimizer.step()
+    flat_params = torch.cat([p.detach().flatten() for p in model.parameters()])
+    gathered = [torch.zeros_like(flat_params) for _ in range(world_size)]
+    dist.all_gather(gathered, flat_params)
+    reduced_loss = reduce_tensor(mel_loss.detach(), world_size)
+    torch.save(
+        dict(
+            indices=list(sampler),
+            params_match=all(torch.allclose(g, flat_params) for g in gathered),
+            reduced_loss=reduced_loss.item(),
+        ),
+        os.path.join(results_path, f"rank{rank}.pt"),
+    )
+    trainer.cleanup_distributed()
 
 
 class TestTrainer:
@@ -49,3 +119,227 @@ class TestTacotron2Trainer:
         assert math.isclose(
             lj_trainer.loss[2], train_loss_4_datapoints_2_iteration, abs_tol=5e-4
         )
+
+    def test_distributed_cpu(self):
+        world_size = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            init_method = f"file://{os.path.join(tmp_dir, 'rendezvous')}"
+            mp.spawn(
+                _run_distributed_worker,
+                (world_size, init_method, tmp_dir, tmp_dir),
+                nprocs=world_size,
+            )
+            results = [
+                torch.load(os.path.join(tmp_dir, f"rank{rank}.pt"))
+                for rank in range(world_size)
+            ]
+
+        # NOTE: each rank sees a disjoint shard of the 4 training files.
+        assert len(results[0]["indices"]) == 2
+        assert not set(results[0]["indices"]) & set(results[1]["indices"])
+        assert all(r["params_match"] for r in results)
+        assert results[0]["reduced_loss"] == results[1]["reduced_loss"]
+
+    def test_grad_accumulation_steps(self):
+        config = TACOTRON2_TRAINER_DEFAULTS.values()
+        config.update(TINY_TACOTRON2_OVERRIDES)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config.update(
+                dict(
+                    training_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                    val_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                    checkpoint_name="test",
+                    checkpoint_path=tmp_dir,
+                    log_dir=tmp_dir,
+                    epochs=1,
+                    batch_size=1,
+                    grad_accumulation_steps=3,
+                    p_arpabet=0.0,
+                    is_validate=False,
+                    steps_per_sample=1000,
+                )
+            )
+            trainer = Tacotron2Trainer(HParams(**config), rank=0, world_size=1)
+            trainer.train()
+
+        # NOTE: 4 micro-batches of size 1 accumulate into an optimizer step of 3 and a remainder step of 1.
+        assert trainer.global_step == 2
+
+    def test_grad_accumulation_matches_combined_batch(self, tmp_path, monkeypatch):
+        # NOTE: the micro-batches only add up to the combined batch if the model and
+        # loss treat the clips independently. Batch norm statistics and the loss
+        # averaged over padded frames do not, unless the clips are identical, and
+        # dropout draws different masks for different batch shapes.
+        monkeypatch.setattr(
+            torch.nn.functional, "dropout", lambda input, *args, **kwargs: input
+        )
+        filelist = str(tmp_path / "list.txt")
+        with open(filelist, "w") as f:
+            f.write(
+                "tests/fixtures/ljtest/wavs/LJ001-0002.wav|in being comparatively modern.|0\n"
+                * 4
+            )
+
+        def first_step_gradients(batch_size, grad_accumulation_steps):
+            config = TACOTRON2_TRAINER_DEFAULTS.values()
+            config.update(TINY_TACOTRON2_OVERRIDES)
+            log_dir = str(tmp_path / f"{batch_size}x{grad_accumulation_steps}")
+            config.update(
+                dict(
+                    training_audiopaths_and_text=filelist,
+                    val_audiopaths_and_text=filelist,
+                    checkpoint_name="test",
+                    checkpoint_path=log_dir,
+                    log_dir=log_dir,
+                    epochs=1,
+                    batch_size=batch_size,
+                    grad_accumulation_steps=grad_accumulation_steps,
+                    grad_clip_thresh=1e9,
+                    p_arpabet=0.0,
+                    is_validate=False,
+                    steps_per_sample=1000,
+                )
+            )
+            trainer = Tacotron2Trainer(HParams(**config), rank=0, world_size=1)
+            torch.manual_seed(1234)
+            trainer.train()
+            assert trainer.global_step == 1
+            # NOTE: after one Adam step, exp_avg is (1 - beta1) times the gradient.
+            optimizer = torch.load(os.path.join(log_dir, "test_0.pt"))["optimizer"]
+            return [state["exp_avg"] for state in optimizer["state"].values()]
+
+        accumulated = first_step_gradients(batch_size=1, grad_accumulation_steps=4)
+        combined = first_step_gradients(batch_size=4, grad_accumulation_steps=1)
+        assert len(accumulated) == len(combined) > 0
+        for a, c in zip(accumulated, combined):
+            assert torch.allclose(a, c, rtol=1e-3, atol=1e-7)
+
+    def test_reduction_window_schedule(self):
+        config = TACOTRON2_TRAINER_DEFAULTS.values()
+        config.update(TINY_TACOTRON2_OVERRIDES)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config.update(
+                dict(
+                    training_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                    val_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                    checkpoint_name="test",
+                    checkpoint_path=tmp_dir,
+                    log_dir=tmp_dir,
+                    epochs=2,
+                    n_frames_per_step_initial=3,
+                    reduction_window_schedule=[
+                        {"until_step": 2, "batch_size": 2, "n_frames_per_step": 3},
+                        {"until_step": None, "batch_size": 1, "n_frames_per_step": 1},
+                    ],
+                    p_arpabet=0.0,
+                    is_validate=False,
+                    steps_per_sample=1000,
+                )
+            )
+            trainer = Tacotron2Trainer(HParams(**config), rank=0, world_size=1)
+            assert trainer.reduction_window(0) == (2, 3)
+            assert trainer.reduction_window(2) == (1, 1)
+            trainer.train()
+
+        # NOTE: the first epoch takes 2 steps of 2 clips at r=3, the second 4 steps of 1 clip at r=1.
+        assert trainer.global_step == 6
+        assert trainer.batch_size == 1
+
+    def test_reduction_window_switch_mid_epoch(self, tmp_path, monkeypatch):
+        visited = []
+        getitem = TextMelDataset.__getitem__
+
+        def recording_getitem(self, idx):
+            visited.append(idx)
+            return getitem(self, idx)
+
+        monkeypatch.setattr(TextMelDataset, "__getitem__", recording_getitem)
+        config = TACOTRON2_TRAINER_DEFAULTS.values()
+        config.update(TINY_TACOTRON2_OVERRIDES)
+        config.update(
+            dict(
+                training_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                val_audiopaths_and_text="tests/fixtures/ljtest/list_small.txt",
+                checkpoint_name="test",
+                checkpoint_path=str(tmp_path),
+                log_dir=str(tmp_path),
+                epochs=2,
+                n_frames_per_step_initial=3,
+                reduction_window_schedule=[
+                    {"until_step": 1, "batch_size": 3, "n_frames_per_step": 3},
+                    {"until_step": None, "batch_size": 1, "n_frames_per_step": 1},
+                ],
+                p_arpabet=0.0,
+                is_validate=False,
+                steps_per_sample=1000,
+            )
+        )
+        trainer = Tacotron2Trainer(HParams(**config), rank=0, world_size=1)
+        trainer.train()
+
+        # NOTE: the first epoch takes 1 step of 3 clips at r=3, then continues with the remaining clip
+        # at r=1; the second takes 4 steps of 1 clip.
+        assert trainer.global_step == 6
+        assert sorted(visited[:4]) == [0, 1, 2, 3]
+        assert sorted(visited[4:]) == [0, 1, 2, 3]
+
+    def test_fp16_requires_cuda(self, tmp_path):
+        config = TACOTRON2_TRAINER_DEFAULTS.values()
+        config.update(TINY_TACOTRON2_OVERRIDES)
+        config.update(
+            dict(
+                checkpoint_name="test",
+                checkpoint_path=str(tmp_path),
+                log_dir=str(tmp_path),
+                precision="fp16",
+            )
+        )
+        with pytest.raises(ValueError):
+            TTSTrainer(HParams(**config), device="cpu")
+
+    def test_bf16_autocast(self):
+        config = TACOTRON2_TRAINER_DEFAULTS.values()
+        config.update(TINY_TACOTRON2_OVERRIDES)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config.update(
+                dict(
+                    checkpoint_name="test",
+                    checkpoint_path=tmp_dir,
+                    log_dir=tmp_dir,
+                    precision="bf16",
+                )
+            )
+            hparams = HParams(**config)
+            trainer = TTSTrainer(hparams)
+        torch.manual_seed(1234)
+        model = Tacotron2(hparams)
+        input_lengths = torch.LongTensor([12, 9])
+        text = torch.randint(1, 40, (2, 12))
+        mels = torch.randn(2, hparams.n_mel_channels, 20)
+        output_lengths = torch.LongTensor([20, 15])
+        gate_target = (torch.arange(20)[None] >= output_lengths[:, None] - 1).float()
+
+        with trainer.autocast():
+            model_output = model(
+                input_text=text,
+                input_lengths=input_lengths,
+                speaker_ids=torch.LongTensor([0, 0]),
+                targets=mels,
+                output_lengths=output_lengths,
+            )
+            mel_loss, gate_loss, _, _ = Tacotron2Loss(pos_weight=None)(
+                model_output=model_output,
+                target=dict(mel_padded=mels, gate_target=gate_target),
+            )
+        (mel_loss + gate_loss).backward()
+
+        # NOTE: the recurrent states and the attention softmax are fp32 islands.
+        assert model.decoder.decoder_cell.dtype == torch.float32
+        assert model.decoder.attention_weights_cum.dtype == torch.float32
+        assert model_output["alignments"].dtype == torch.float32
+        assert model.encoder.convolutions[0][0].conv.weight.grad.dtype == torch.float32
+        assert all(
+            torch.isfinite(p.grad).all()
+            for p in model.parameters()
+            if p.grad is not None
+        )
@@ -0,0 +1,34 @@
+import os
+
+import torch
+
+from uberduck_ml_dev.utils.denoiser import Denoiser
+from uberduck_ml_dev.vocoders.hifigan import HiFiGanGenerator
+
+
+class TestDenoiser:
+    def test_denoiser(self, tiny_hifigan):
+        torch.manual_seed(1234)
+        h, checkpoint = tiny_hifigan
+        hifigan = HiFiGanGenerator(dict(h), checkpoint)
+
+        denoiser = Denoiser(hifigan)
+        assert os.path.exists(checkpoint + ".denoiser_zeros.pt")
+        # NOTE: the cached bias spectrum is used without running the vocoder.
+        vocoder = hifigan.vocoder
+        hifigan.vocoder = None
+        cached = Denoiser(hifigan)
+        hifigan.vocoder = vocoder
+        assert torch.equal(cached.bias_spec, denoiser.bias_spec)
+
+        audio = torch.randn(2, 8192) * 0.1
+        lengths = torch.LongTensor([8192, 5120])
+        audio[1, 5120:] = 0.0
+        denoised = denoiser(audio, strength=10, lengths=lengths)
+        assert denoised.shape == (2, 1, 8192)
+        assert (denoised[1, 0, 5120:] == 0).all()
+        for i, length in enumerate(lengths.tolist()):
+            expected = denoiser(audio[i : i + 1, :length])
+            # NOTE: padding only changes the frames that overlap the end of the clip.
+            n = length - 1024
+            assert torch.allclose(denoised[i, 0, :n], expected[0, 0, :n], atol=1e-5)
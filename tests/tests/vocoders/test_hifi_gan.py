@@ -1,5 +1,28 @@
+import json
+import math
+
+import numpy as np
 from scipy.io.wavfile import read
+from uberduck_ml_dev.exec.quantize_hifigan import run as quantize_hifigan
 from uberduck_ml_dev.models.common import MelSTFT
+from uberduck_ml_dev.vocoders.avocodo import (
+    MultiCoMBDiscriminator,
+    MultiSubBandDiscriminator,
+    PQMF,
+    avocodo_discriminator_outputs,
+    discriminator_loss,
+    feature_loss,
+    generator_loss,
+)
+from uberduck_ml_dev.vocoders.hifigan import (
+    AttrDict,
+    DEFAULTS,
+    Generator,
+    HiFiGanGenerator,
+    InferenceGenerator,
+    MULTIBAND_DEFAULTS,
+)
+import pytest
 import torch
 
 
@@ -20,3 +43,129 @@ class TestHifiGan:
         assert mel.shape[0] == 1
         assert mel.shape[1] == 80
         assert mel.shape[2] == 566
+
+    @pytest.mark.parametrize(
+        "overrides",
+        [
+            {},
+            # NOTE: config_v3 style, where the ResBlocks have different dilations.
+            dict(
+                resblock="2",
+                resblock_dilation_sizes=[[1, 2], [2, 6], [1, 2]],
+            ),
+        ],
+    )
+    def test_inference_generator(self, overrides, tmp_path):
+        torch.manual_seed(1234)
+        h = AttrDict(DEFAULTS)
+        h.upsample_initial_channel = 32
+        h.update(overrides)
+        generator = Generator(h)
+        for p in generator.parameters():
+            p.data.add_(torch.randn_like(p) * 0.01)
+        generator.eval()
+        mel = torch.randn(2, 80, 20)
+        with torch.no_grad():
+            expected = generator(mel)
+
+        for channels_last in [False, True]:
+            for fuse_mrf in [False, True]:
+                model = InferenceGenerator(
+                    generator, channels_last=channels_last, fuse_mrf=fuse_mrf
+                )
+                with torch.no_grad():
+                    audio = model(mel)
+                assert audio.shape == expected.shape
+                assert torch.allclose(audio, expected, atol=1e-5)
+
+        checkpoint = str(tmp_path / "generator.pt")
+        torch.save(dict(generator=generator.state_dict()), checkpoint)
+        model = InferenceGenerator.from_checkpoint(dict(h), checkpoint)
+        audio = model.infer(mel)
+        assert audio.dtype == torch.int16
+        assert audio.shape == (2, 20 * 256)
+        reference = HiFiGanGenerator(dict(h), checkpoint).infer(mel)
+        assert (audio.int() - torch.from_numpy(reference).int()).abs().max() <= 1
+
+    def test_quantize_generator(self, tiny_hifigan, tmp_path):
+        torch.manual_seed(1234)
+        h, checkpoint = tiny_hifigan
+        config = str(tmp_path / "config.json")
+        with open(config, "w") as f:
+            json.dump(h, f)
+
+        _, data = read("tests/fixtures/wavs/stevejobs-1.wav")
+        mel = MelSTFT().mel_spectrogram(torch.FloatTensor(data / 32768.0)[None])
+        mel_dirname = tmp_path / "mels"
+        mel_dirname.mkdir()
+        for i in range(3):
+            np.save(mel_dirname / f"{i}.npy", mel[0, :, i * 40 : (i + 1) * 40].numpy())
+
+        output = str(tmp_path / "generator_int8.pt")
+        report = quantize_hifigan(config, checkpoint, str(mel_dirname), output)
+        assert report["samples"] == 3 * 40 * 256
+        assert np.isfinite(report["mrstft_distance"])
+        assert report["speedup"] > 0
+
+        vocoder = HiFiGanGenerator(config, output)
+        assert vocoder.quantized
+        modules = dict(vocoder.vocoder.named_modules())
+        assert type(modules["conv_post"]) is torch.nn.Conv2d
+        assert type(modules["ups.0"]).__module__.startswith("torch.ao.nn.quantized")
+        audio = vocoder.infer(mel[:, :, :40])
+        assert audio.dtype == np.int16
+        assert audio.shape == (40 * 256,)
+
+    def test_multiband_generator(self, tmp_path):
+        h = AttrDict(MULTIBAND_DEFAULTS)
+        pqmf = PQMF(h.subbands, h.pqmf_taps, h.pqmf_cutoff, h.pqmf_beta, centered=True)
+        t = torch.arange(4096) / h.sampling_rate
+        for frequency in [440, 3000, 7000]:
+            x = torch.sin(2 * math.pi * frequency * t)[None, None]
+            reconstruction = pqmf.synthesis(pqmf.analysis(x))
+            assert (reconstruction - x)[..., 100:-100].abs().max() < 1e-2
+
+        torch.manual_seed(1234)
+        h.upsample_initial_channel = 32
+        generator = Generator(h)
+        mel = torch.randn(2, 80, 8)
+        y_hat = generator(mel)
+        assert y_hat.shape == (2, 1, 8 * 256)
+
+        combd = MultiCoMBDiscriminator(
+            [[7, 11, 5], [11, 21, 5], [15, 41, 5]], [8, 16, 16], [1, 4, 1], [1, 4, 1]
+        )
+        sbd = MultiSubBandDiscriminator(
+            tkernels=[7, 5, 3],
+            fkernel=5,
+            tchannels=[8, 16],
+            fchannels=[8, 16],
+            tstrides=[[1, 3], [1, 3], [1, 3]],
+            fstride=[1, 3],
+            tdilations=[[[1, 2], [1, 2]]] * 3,
+            fdilations=[[1, 2], [1, 2]],
+            tsubband=[6, 11, 16],
+            n=16,
+            m=16,
+            freq_init_ch=8 * 256 // 16,
+        )
+        y = torch.randn_like(y_hat) * 0.1
+        y_d_rs, y_d_gs, _, _ = avocodo_discriminator_outputs(
+            combd, sbd, y, y_hat.detach()
+        )
+        discriminator_loss(y_d_rs, y_d_gs)[0].backward()
+        _, y_d_gs, fmap_rs, fmap_gs = avocodo_discriminator_outputs(
+            combd, sbd, y, y_hat
+        )
+        (generator_loss(y_d_gs)[0] + feature_loss(fmap_rs, fmap_gs)).backward()
+        assert generator.conv_post.weight_v.grad.abs().sum() > 0
+
+        generator.eval()
+        with torch.no_grad():
+            expected = generator(mel)
+            audio = InferenceGenerator(generator, channels_last=True)(mel)
+        assert torch.allclose(audio, expected, atol=1e-5)
+        checkpoint = str(tmp_path / "generator.pt")
+        torch.save(dict(generator=generator.state_dict()), checkpoint)
+        audio = HiFiGanGenerator(dict(h), checkpoint).infer(mel)
+        assert audio.shape == (2, 8 * 256)
@@ -1,20 +1,127 @@
-__all__ = ["tts", "rhythm_transfer"]
+__all__ = [
+    "tts",
+    "tts_batch",
+    "tts_long",
+    "crossfade_concat",
+    "vocode_batch",
+    "synthesize",
+    "rhythm_transfer",
+]
 
 
 import torch
 
 from .text.symbols import NVIDIA_TACO2_SYMBOLS
-from .text.util import text_to_sequence
+from .text.util import text_to_sequence, chunk_text, clean_text
 from .data_loader import prepare_input_sequence
 
 
-from typing import List
+import hashlib
+import math
+from typing import List, Optional
 
-from .models.tacotron2 import Tacotron2
-from .vocoders.hifigan import HiFiGanGenerator
+import numpy as np
+import torch.nn.functional as F
 
+from .models.tacotron2 import Tacotron2, INFERENCE
+from .vocoders.hifigan import HiFiGanGenerator, InferenceGenerator
+from .registry import load_tacotron2, load_hifigan
+from .synthesis_cache import SynthesisCache
 
-def tts(
+
+@torch.no_grad()
+def vocode_batch(
+    mels, mel_lengths, vocoder, bucket_length=64, pad_value=math.log(1e-5)
+):
+    """Vocode (B, n_mel_channels, T) mels with HiFi-GAN, one batch per length bucket.
+
+    Each mel is trimmed to its length, and mels whose lengths round up to the same
+    multiple of bucket_length frames are padded with pad_value (log of the mel clip
+    value, i.e. silence) to that length and vocoded together. Returns a list of
+    float audio in [-1, 1], trimmed to mel_length * hop_length samples.
+    """
+    if isinstance(vocoder, HiFiGanGenerator):
+        generator = vocoder.vocoder
+        if vocoder.quantized:
+            mels = mels.cpu()
+    else:
+        generator = vocoder
+    h = generator.h
+    hop_length = int(np.prod(h.upsample_rates)) * h.get("subbands", 1)
+    mel_lengths = [int(length) for length in mel_lengths]
+    buckets = {}
+    for idx, length in enumerate(mel_lengths):
+        # NOTE: a line whose gate fires on the first frame has no frames, but still
+        # needs a non-empty bucket; its audio is trimmed to nothing below.
+        bucket = max(math.ceil(length / bucket_length), 1)
+        buckets.setdefault(bucket, []).append(idx)
+    audios = [None] * len(mel_lengths)
+    for bucket, idxs in buckets.items():
+        batch = mels[idxs, :, : bucket * bucket_length]
+        batch = F.pad(
+            batch, (0, bucket * bucket_length - batch.size(2)), value=pad_value
+        )
+        for i, idx in enumerate(idxs):
+            batch[i, :, mel_lengths[idx] :] = pad_value
+        audio = generator(batch)[:, 0].clamp(-1, 1)
+        for i, idx in enumerate(idxs):
+            audios[idx] = audio[i, : mel_lengths[idx] * hop_length]
+    return audios
+
+
+def _line_generator(seed, line, speaker_id, device):
+    """Random generator for the prenet dropout of one line, seeded from seed, the
+    cleaned line and the speaker id."""
+    description = f"{seed}|{clean_text(line, ['english_cleaners'])}|{speaker_id}"
+    digest = hashlib.sha256(description.encode()).digest()
+    generator = torch.Generator(device=device)
+    return generator.manual_seed(int.from_bytes(digest[:8], "little"))
+
+
+def _synthesize(
+    lines,
+    model,
+    device,
+    vocoder,
+    arpabet,
+    symbol_set,
+    speaker_ids,
+    bucket_length,
+    seed=None,
+):
+    cpu_run = device == "cpu"
+    sequences, input_lengths = prepare_input_sequence(
+        lines, cpu_run=cpu_run, arpabet=arpabet, symbol_set=symbol_set
+    )
+    generators = None
+    if seed is not None:
+        generators = [
+            _line_generator(seed, line, speaker_id, device)
+            for line, speaker_id in zip(lines, speaker_ids.tolist())
+        ]
+    with torch.no_grad():
+        output = model(
+            input_text=sequences,
+            input_lengths=input_lengths,
+            speaker_ids=speaker_ids,
+            mode=INFERENCE,
+            prenet_generators=generators,
+        )
+    return vocode_batch(
+        output["mel_outputs_postnet"],
+        output["output_lengths"],
+        vocoder,
+        bucket_length=bucket_length,
+    )
+
+
+def _is_deterministic(model):
+    # NOTE: the Tacotron2 prenet applies dropout at inference too.
+    prenet = getattr(getattr(model, "decoder", None), "prenet", None)
+    return getattr(prenet, "dropout_rate", 0.0) == 0.0
+
+
+def tts_batch(
     lines: List[str],
     model,
     device: str,
@@ -23,30 +130,220 @@ def tts(
     symbol_set=NVIDIA_TACO2_SYMBOLS,
     max_wav_value=32768.0,
     speaker_ids=None,
+    bucket_length=64,
+    cache: Optional[SynthesisCache] = None,
+    seed=None,
 ):
+    """Synthesize lines with a Tacotron2 model and a HiFi-GAN vocoder, vocoding the
+    lines as length bucketed batches (see vocode_batch).
+
+    Returns a list with the audio (samples,) of each line, scaled by max_wav_value.
+
+    With a seed, the prenet dropout of each line is drawn from a generator seeded
+    from the seed, the cleaned line and its speaker id, so the audio of a line does
+    not depend on the other lines of the batch. With a cache, lines found in it are
+    not synthesized, and the others are added to it as int16 audio. Because of
+    prenet dropout, lines are only cached when a seed is given.
+    """
     assert isinstance(
         model, Tacotron2
     ), "Only Tacotron2 text-to-mel models are supported"
-    assert isinstance(vocoder, HiFiGanGenerator), "Only Hifi GAN vocoders are supported"
-    cpu_run = device == "cpu"
-    sequences, input_lengths = prepare_input_sequence(
-        lines, cpu_run=cpu_run, arpabet=arpabet, symbol_set=symbol_set
-    )
+    assert isinstance(
+        vocoder, (HiFiGanGenerator, InferenceGenerator)
+    ), "Only Hifi GAN vocoders are supported"
     if speaker_ids is None:
         speaker_ids = torch.zeros(len(lines), dtype=torch.long, device=device)
-    input_ = sequences, input_lengths, speaker_ids
-    _, mel_outputs_postnet, gate_outputs, alignment, lengths = model.inference(input_)
-    mels = mel_outputs_postnet
-    mel = mels[0, :, : lengths[0].item()]
-    for idx in range(1, mels.size(0)):
-        length = lengths[idx].item()
-        mel = torch.cat((mel, mels[idx, :, :length]), dim=-1)
-    tensor_cls = torch.FloatTensor if device == "cpu" else torch.cuda.FloatTensor
-    mel = mel[None, :]
-    y_g_hat = vocoder(tensor_cls(mel).to(device=device))
-    audio = y_g_hat.reshape(1, -1)
-    audio = audio * max_wav_value
-    return audio
+    keys = None
+    if cache is not None and (seed is not None or _is_deterministic(model)):
+        keys = [
+            cache.key(
+                line,
+                speaker_id,
+                model,
+                vocoder,
+                symbol_set,
+                arpabet=arpabet,
+                max_wav_value=max_wav_value,
+                bucket_length=bucket_length,
+                seed=seed,
+            )
+            for line, speaker_id in zip(lines, speaker_ids.tolist())
+        ]
+        audios = [cache.get(key) for key in keys]
+    else:
+        if cache is not None:
+            cache.skip(len(lines))
+        audios = [None] * len(lines)
+
+    missing = [idx for idx, audio in enumerate(audios) if audio is None]
+    if missing:
+        synthesized = _synthesize(
+            [lines[idx] for idx in missing],
+            model,
+            device,
+            vocoder,
+            arpabet,
+            symbol_set,
+            speaker_ids[missing],
+            bucket_length,
+            seed=seed,
+        )
+        for idx, audio in zip(missing, synthesized):
+            audio = audio * max_wav_value
+            if keys is not None:
+                audio = audio.round().clamp(-32768, 32767).short()
+                cache.put(keys[idx], audio)
+            audios[idx] = audio
+    if keys is not None:
+        audios = [audio.to(device).float() for audio in audios]
+    return audios
+
+
+def tts(
+    lines: List[str],
+    model,
+    device: str,
+    vocoder,
+    arpabet=False,
+    symbol_set=NVIDIA_TACO2_SYMBOLS,
+    max_wav_value=32768.0,
+    speaker_ids=None,
+    silence_seconds=0.0,
+    **kwargs,
+):
+    """Synthesize lines (see tts_batch) and join them, with silence_seconds of
+    silence between lines, into one (1, samples) tensor scaled by max_wav_value.
+    kwargs are passed to tts_batch."""
+    audios = tts_batch(
+        lines,
+        model,
+        device,
+        vocoder,
+        arpabet=arpabet,
+        symbol_set=symbol_set,
+        max_wav_value=max_wav_value,
+        speaker_ids=speaker_ids,
+        **kwargs,
+    )
+    h = vocoder.vocoder.h if isinstance(vocoder, HiFiGanGenerator) else vocoder.h
+    silence = audios[0].new_zeros(int(silence_seconds * h.sampling_rate))
+    joined = [audios[0]]
+    for audio in audios[1:]:
+        joined.extend([silence, audio])
+    return torch.cat(joined)[None]
+
+
+def crossfade_concat(audios, pauses, sampling_rate, crossfade_seconds=0.01):
+    """Join 1D audios with pauses[i] seconds between audios i and i + 1.
+
+    Each junction fades the end of one audio out and the start of the next in over
+    crossfade_seconds, overlapping them where the pause is shorter than the fade, so
+    that joins without a pause do not click.
+    """
+    crossfade = int(crossfade_seconds * sampling_rate)
+    starts = [0]
+    fades = []
+    for idx, pause in enumerate(pauses):
+        n = min(crossfade, audios[idx].numel(), audios[idx + 1].numel())
+        fades.append(n)
+        starts.append(starts[-1] + audios[idx].numel() + int(pause * sampling_rate) - n)
+    output = audios[0].new_zeros(starts[-1] + audios[-1].numel())
+    for idx, (audio, start) in enumerate(zip(audios, starts)):
+        audio = audio.clone()
+        if idx > 0 and fades[idx - 1]:
+            n = fades[idx - 1]
+            audio[:n] *= torch.arange(n, device=audio.device) / n
+        if idx < len(fades) and fades[idx]:
+            n = fades[idx]
+            audio[-n:] *= 1 - torch.arange(n, device=audio.device) / n
+        output[start : start + audio.numel()] += audio
+    return output
+
+
+def tts_long(
+    text: str,
+    model,
+    device: str,
+    vocoder,
+    max_tokens=150,
+    sentence_pause=0.3,
+    clause_pause=0.1,
+    crossfade_seconds=0.01,
+    batch_size=None,
+    speaker_id=0,
+    arpabet=False,
+    symbol_set=NVIDIA_TACO2_SYMBOLS,
+    max_wav_value=32768.0,
+    bucket_length=64,
+    cache: Optional[SynthesisCache] = None,
+    seed=None,
+):
+    """Synthesize a long text, e.g. a paragraph, as chunks of at most max_tokens
+    symbols split at sentence and clause boundaries (see chunk_text).
+
+    The chunks are synthesized together as batches of up to batch_size (by default
+    one batch), sorted by length so that each batch holds chunks of similar length,
+    so the latency approaches that of the longest chunk rather than the sum. The
+    chunk audio is then joined in the original order with sentence_pause or
+    clause_pause seconds of silence, crossfaded (see crossfade_concat).
+
+    Returns audio (1, samples) scaled by max_wav_value, (1, 0) for a text without
+    anything to say.
+    """
+    chunks = chunk_text(text, max_tokens=max_tokens, symbol_set=symbol_set)
+    if not chunks:
+        return torch.zeros(1, 0, device=device)
+    order = sorted(range(len(chunks)), key=lambda idx: -len(chunks[idx][0]))
+    batch_size = batch_size or len(chunks)
+    audios = [None] * len(chunks)
+    for start in range(0, len(order), batch_size):
+        idxs = order[start : start + batch_size]
+        speaker_ids = torch.full(
+            (len(idxs),), speaker_id, dtype=torch.long, device=device
+        )
+        batch_audios = tts_batch(
+            [chunks[idx][0] for idx in idxs],
+            model,
+            device,
+            vocoder,
+            arpabet=arpabet,
+            symbol_set=symbol_set,
+            max_wav_value=max_wav_value,
+            speaker_ids=speaker_ids,
+            bucket_length=bucket_length,
+            cache=cache,
+            seed=seed,
+        )
+        for idx, audio in zip(idxs, batch_audios):
+            audios[idx] = audio
+    pause_seconds = dict(sentence=sentence_pause, clause=clause_pause, word=0.0)
+    pauses = [pause_seconds[boundary] for _, boundary in chunks[:-1]]
+    h = vocoder.vocoder.h if isinstance(vocoder, HiFiGanGenerator) else vocoder.h
+    return crossfade_concat(
+        audios, pauses, h.sampling_rate, crossfade_seconds=crossfade_seconds
+    )[None]
+
+
+def synthesize(
+    lines: List[str],
+    checkpoint: str,
+    hifigan_config,
+    hifigan_checkpoint: str,
+    hparams=None,
+    device: str = "cpu",
+    registry=None,
+    **kwargs,
+):
+    """tts with the Tacotron2 and HiFi-GAN checkpoints loaded through the model
+    registry, so repeated calls for the same voice reuse the resident models."""
+    model = load_tacotron2(checkpoint, hparams, device=device, registry=registry)
+    vocoder = load_hifigan(
+        hifigan_config,
+        hifigan_checkpoint,
+        cudnn_enabled=device == "cuda",
+        registry=registry,
+    )
+    return tts(lines, model, device, vocoder, **kwargs)
 
 
 from typing import Optional
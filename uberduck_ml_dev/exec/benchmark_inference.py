@@ -0,0 +1,419 @@
+__all__ = [
+    "CORPUS",
+    "StageTimer",
+    "random_models",
+    "benchmark",
+    "compare",
+    "parse_args",
+]
+
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import torch
+
+from .. import e2e
+from ..models.tacotron2 import DEFAULTS as TACOTRON2_DEFAULTS, Tacotron2
+from ..registry import load_tacotron2, load_hifigan
+from ..text import util as text_util
+from ..text.symbols import NVIDIA_TACO2_SYMBOLS
+from ..text.util import utterances
+from ..utils.denoiser import Denoiser
+from ..vendor.tfcompat.hparam import HParams
+from ..vocoders.hifigan import (
+    AttrDict,
+    DEFAULTS as HIFIGAN_DEFAULTS,
+    Generator,
+    HiFiGanGenerator,
+)
+
+
+CORPUS = utterances[:16]
+
+STAGES = [
+    "text_cleaning",
+    "g2p",
+    "prepare_input_sequence",
+    "encoder",
+    "decoder",
+    "decoder_step",
+    "postnet",
+    "vocoder",
+    "denoiser",
+]
+
+
+class StageTimer:
+    """Wall time and call counts of named stages.
+
+    instrument replaces a method or function attribute of an object (a module's
+    forward, a function of a python module) with a wrapper that times its calls,
+    until restore. Stages nest: e.g. decoder_step calls are inside decoder. With
+    synchronize, CUDA work is waited on before each clock is read.
+    """
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.seconds = {}
+        self.calls = {}
+        self._patched = []
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + self._now() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def instrument(self, obj, attribute, name):
+        original = getattr(obj, attribute)
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return original(*args, **kwargs)
+
+        self._patched.append((obj, attribute, attribute in vars(obj), original))
+        setattr(obj, attribute, timed)
+
+    def restore(self):
+        while self._patched:
+            obj, attribute, own, original = self._patched.pop()
+            if own:
+                setattr(obj, attribute, original)
+            else:
+                delattr(obj, attribute)
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+
+
+def random_models(hparams=None, hifigan_config=None, directory=None, seed=1234):
+    """Randomly initialized Tacotron2 and HiFi-GAN models, for benchmarking without
+    checkpoints. The gate never fires and every line decodes for 6 frames per input
+    token, so the amount of work is a fixed function of the corpus."""
+    config = (hparams or TACOTRON2_DEFAULTS).values()
+    config.update(
+        gate_threshold=1.0,
+        max_decoder_frames_per_token=6,
+        max_attention_stall_frames=None,
+        max_frames_after_attention_end=None,
+    )
+    hparams = HParams(**config)
+    hparams.max_decoder_steps = max(hparams.max_decoder_steps, 3000)
+    h = AttrDict(HIFIGAN_DEFAULTS)
+    h.update(hifigan_config or {})
+    torch.manual_seed(seed)
+    model = Tacotron2(hparams).eval()
+    directory = directory or tempfile.mkdtemp()
+    checkpoint = os.path.join(directory, "generator.pt")
+    torch.save(dict(generator=Generator(h).state_dict()), checkpoint)
+    return model, HiFiGanGenerator(dict(h), checkpoint)
+
+
+def _reset_peak_memory(device):
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        return
+    # NOTE: resets VmHWM, the peak resident memory, on Linux.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_memory_mb(device):
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / (1 << 20)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # NOTE: the peak of the whole process, in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_corpus(
+    corpus, model, device, vocoder, batch_size, arpabet, symbol_set, seed, denoise
+):
+    audio_samples = 0
+    for start in range(0, len(corpus), batch_size):
+        audios = e2e.tts_batch(
+            corpus[start : start + batch_size],
+            model,
+            device,
+            vocoder,
+            arpabet=arpabet,
+            symbol_set=symbol_set,
+            seed=seed,
+        )
+        if denoise is not None:
+            lengths = torch.tensor([audio.numel() for audio in audios], device=device)
+            padded = torch.nn.utils.rnn.pad_sequence(audios, batch_first=True)
+            denoise(padded / 32768.0, lengths=lengths)
+        audio_samples += sum(audio.numel() for audio in audios)
+    return audio_samples
+
+
+def benchmark(
+    model,
+    vocoder,
+    corpus=CORPUS,
+    batch_sizes=(1, 4, 8),
+    thread_counts=(1,),
+    device="cpu",
+    repeats=3,
+    denoiser_strength=None,
+    arpabet=False,
+    symbol_set=NVIDIA_TACO2_SYMBOLS,
+    seed=1234,
+):
+    """Synthesize corpus with e2e.tts_batch at each batch size and thread count and time
+    every stage (see STAGES).
+
+    Each configuration runs the corpus once to warm up and then repeats times; the
+    median of each time is reported. prepare_input_sequence includes text_cleaning
+    and g2p, and decoder includes decoder_step. decoder_ms_per_step is the time of
+    the decoder loop per step, the real-time factor (rtf) is seconds of synthesis
+    per second of audio, and peak_memory_mb is the peak resident memory (CPU) or
+    allocated memory (CUDA) while the configuration ran.
+    """
+    timer = StageTimer(synchronize=device == "cuda")
+    generator = vocoder.vocoder if isinstance(vocoder, HiFiGanGenerator) else vocoder
+    denoise = None
+    if denoiser_strength:
+        denoiser = Denoiser(vocoder)
+
+        def denoise(audio, lengths):
+            return denoiser(audio, strength=denoiser_strength, lengths=lengths)
+
+    sampling_rate = generator.h.sampling_rate
+    num_threads = torch.get_num_threads()
+    corpus_hash = hashlib.sha1("\n".join(corpus).encode()).hexdigest()[:12]
+    results = []
+    try:
+        if denoise is not None:
+            timer.instrument(denoiser, "forward", "denoiser")
+        timer.instrument(text_util, "clean_text", "text_cleaning")
+        timer.instrument(text_util, "convert_to_arpabet", "g2p")
+        timer.instrument(e2e, "prepare_input_sequence", "prepare_input_sequence")
+        timer.instrument(model.encoder, "forward", "encoder")
+        timer.instrument(model.decoder, "inference", "decoder")
+        timer.instrument(model.decoder, "decode", "decoder_step")
+        timer.instrument(model.postnet, "forward", "postnet")
+        timer.instrument(generator, "forward", "vocoder")
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                run_corpus = functools.partial(
+                    _run_corpus,
+                    corpus,
+                    model,
+                    device,
+                    vocoder,
+                    batch_size,
+                    arpabet,
+                    symbol_set,
+                    seed,
+                    denoise,
+                )
+                run_corpus()
+                _reset_peak_memory(device)
+                runs = []
+                for _ in range(repeats):
+                    timer.reset()
+                    start = timer._now()
+                    audio_samples = run_corpus()
+                    runs.append(
+                        dict(
+                            timer.seconds,
+                            total=timer._now() - start,
+                            decoder_steps=timer.calls.get("decoder_step", 0),
+                        )
+                    )
+                audio_seconds = audio_samples / sampling_rate
+                median = {
+                    name: statistics.median(run.get(name, 0.0) for run in runs)
+                    for name in STAGES + ["total", "decoder_steps"]
+                }
+                steps = max(median["decoder_steps"], 1)
+                results.append(
+                    dict(
+                        corpus=corpus_hash,
+                        device=device,
+                        batch_size=batch_size,
+                        num_threads=threads,
+                        lines=len(corpus),
+                        stages={name: median[name] for name in STAGES},
+                        total_seconds=median["total"],
+                        decoder_steps=int(median["decoder_steps"]),
+                        decoder_ms_per_step=1000 * median["decoder"] / steps,
+                        audio_seconds=audio_seconds,
+                        rtf=median["total"] / max(audio_seconds, 1e-9),
+                        lines_per_second=len(corpus) / median["total"],
+                        peak_memory_mb=_peak_memory_mb(device),
+                    )
+                )
+    finally:
+        timer.restore()
+        torch.set_num_threads(num_threads)
+    return results
+
+
+def compare(results, baseline, tolerance=0.1, min_seconds=0.01):
+    """Regressions of results relative to baseline (results of an earlier run).
+
+    Configurations are matched by corpus (a hash of its lines), device, batch size
+    and thread count; configurations missing from the baseline are not compared. A
+    regression is a total time, rtf, decoder_ms_per_step or stage time more than
+    tolerance (a fraction) above the baseline; stages that took under min_seconds
+    in the baseline are ignored as noise. Returns a list of dicts with the
+    configuration, metric, baseline and current values and the relative change.
+    """
+
+    def config(r):
+        return r["corpus"], r["device"], r["batch_size"], r["num_threads"]
+
+    baseline = {config(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        if config(result) not in baseline:
+            continue
+        expected = baseline[config(result)]
+        metrics = [
+            (metric, expected[metric], result[metric])
+            for metric in ["total_seconds", "rtf", "decoder_ms_per_step"]
+        ]
+        metrics += [
+            (f"stages.{name}", expected["stages"][name], result["stages"][name])
+            for name in STAGES
+            if expected["stages"].get(name, 0.0) >= min_seconds
+        ]
+        for metric, before, after in metrics:
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append(
+                    dict(
+                        batch_size=result["batch_size"],
+                        num_threads=result["num_threads"],
+                        metric=metric,
+                        baseline=before,
+                        current=after,
+                        change=after / before - 1,
+                    )
+                )
+    return regressions
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint", help="Tacotron2 checkpoint; random weights if not given"
+    )
+    parser.add_argument("--config", help="Path to a JSON of Tacotron2 hparams")
+    parser.add_argument("--hifigan-config", help="Path to the HiFi-GAN JSON config")
+    parser.add_argument(
+        "--hifigan-checkpoint", help="HiFi-GAN checkpoint; random weights if not given"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--corpus", help="File of lines to synthesize")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--denoiser-strength",
+        type=float,
+        help="Also time the denoiser at this strength",
+    )
+    parser.add_argument("--arpabet", action="store_true")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--baseline", help="Results JSON of an earlier run to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Slowdown relative to the baseline flagged as a regression",
+    )
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    config = TACOTRON2_DEFAULTS.values()
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    hparams = HParams(**config)
+    hifigan_config = dict(HIFIGAN_DEFAULTS)
+    if args.hifigan_config:
+        with open(args.hifigan_config) as f:
+            hifigan_config.update(json.load(f))
+    if not (args.checkpoint and args.hifigan_checkpoint):
+        model, vocoder = random_models(hparams, hifigan_config)
+        model = model.to(args.device)
+    if args.checkpoint:
+        model = load_tacotron2(args.checkpoint, hparams, device=args.device)
+    if args.hifigan_checkpoint:
+        vocoder = load_hifigan(
+            hifigan_config,
+            args.hifigan_checkpoint,
+            cudnn_enabled=args.device == "cuda",
+        )
+    corpus = CORPUS
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    results = benchmark(
+        model,
+        vocoder,
+        corpus=corpus,
+        batch_sizes=args.batch_sizes,
+        thread_counts=args.threads,
+        device=args.device,
+        repeats=args.repeats,
+        denoiser_strength=args.denoiser_strength,
+        arpabet=args.arpabet,
+        symbol_set=hparams.symbol_set,
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), tolerance=args.tolerance)
+        for r in regressions:
+            print(
+                f"Regression: batch size {r['batch_size']}, {r['num_threads']} threads, "
+                f"{r['metric']} {r['baseline']:.4f} -> {r['current']:.4f} "
+                f"(+{100 * r['change']:.1f}%)"
+            )
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,436 @@
+__all__ = [
+    "BENCHMARKS",
+    "synthetic_audio",
+    "synthetic_data",
+    "time_callable",
+    "conv_launches",
+    "run",
+    "compare",
+    "parse_args",
+]
+
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from scipy.io.wavfile import write
+from scipy.stats import mannwhitneyu
+
+from ..data_loader import TextMelCollate, TextMelDataset
+from ..models.common import MelSTFT
+from ..models.components.attention import Attention
+from ..models.components.decoders.tacotron2 import Decoder
+from ..models.tacotron2 import DEFAULTS as TACOTRON2_DEFAULTS
+from ..text.util import text_to_sequence, utterances
+from ..utils.audio import compute_yin
+from ..vocoders.hifigan import (
+    AttrDict,
+    DEFAULTS as HIFIGAN_DEFAULTS,
+    Generator,
+    InferenceGenerator,
+)
+
+
+SAMPLING_RATE = 22050
+
+# NOTE: numbers and abbreviations exercise the number and abbreviation cleaners.
+_WORDS = " ".join(utterances).split() + ["Dr.", "Mr.", "$3.50", "1st", "42", "1,000"]
+
+
+def synthetic_audio(seconds, sampling_rate=SAMPLING_RATE, seed=0):
+    """Deterministic speech-like float audio in [-0.5, 0.5]: harmonics of a gliding
+    f0 between 100 and 250 Hz, with a syllable-rate envelope and a little noise."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sampling_rate)) / sampling_rate
+    f0 = 100 + 150 * (0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(0.2, 0.5) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sampling_rate
+    audio = sum(np.sin(k * phase) / k for k in range(1, 9))
+    audio *= 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 5) * t) ** 2
+    audio += 0.01 * rng.randn(len(t))
+    return (0.5 * audio / np.abs(audio).max()).astype(np.float32)
+
+
+def _transcript(n_words, rng):
+    return " ".join(_WORDS[i] for i in rng.randint(len(_WORDS), size=n_words)) + "."
+
+
+def synthetic_data(directory, n_utterances=8, sampling_rate=SAMPLING_RATE, seed=0):
+    """Write n_utterances synthetic wav files (1 to 4 seconds) and a filelist of
+    "path|transcript|speaker_id" lines to directory. Returns the filelist path."""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    lines = []
+    for idx in range(n_utterances):
+        seconds = rng.uniform(1, 4)
+        path = os.path.join(directory, f"{idx:04d}.wav")
+        audio = synthetic_audio(seconds, sampling_rate, seed=seed + idx)
+        write(path, sampling_rate, (audio * 32767).astype(np.int16))
+        n_words = max(int(seconds * 2.5), 1)
+        lines.append(f"{path}|{_transcript(n_words, rng)}|{idx % 2}\n")
+    filelist = os.path.join(directory, "filelist.txt")
+    with open(filelist, "w") as f:
+        f.writelines(lines)
+    return filelist
+
+
+def _text_to_sequence(data, words):
+    rng = np.random.RandomState(0)
+    transcripts = [_transcript(words, rng) for _ in range(8)]
+    cleaners = TACOTRON2_DEFAULTS.text_cleaners
+    return lambda: [text_to_sequence(t, cleaners) for t in transcripts]
+
+
+def _mel_spectrogram(data, seconds):
+    stft = MelSTFT()
+    audio = torch.from_numpy(synthetic_audio(seconds))[None]
+    return lambda: stft.mel_spectrogram(audio)
+
+
+def _text_mel_collate(data, batch_size):
+    hparams = TACOTRON2_DEFAULTS
+    dataset = TextMelDataset(
+        data["filelist"],
+        hparams.text_cleaners,
+        p_arpabet=0.0,
+        n_mel_channels=hparams.n_mel_channels,
+        sampling_rate=hparams.sampling_rate,
+        mel_fmin=hparams.mel_fmin,
+        mel_fmax=hparams.mel_fmax,
+        filter_length=hparams.filter_length,
+        hop_length=hparams.hop_length,
+        win_length=hparams.win_length,
+        symbol_set=hparams.symbol_set,
+    )
+    items = [dataset[idx] for idx in range(len(dataset))]
+    batch = [items[idx % len(items)] for idx in range(batch_size)]
+    collate = TextMelCollate()
+    return lambda: collate(batch)
+
+
+def _decoder_decode(data, batch_size, input_length=128):
+    hparams = TACOTRON2_DEFAULTS
+    torch.manual_seed(0)
+    decoder = Decoder(hparams).eval()
+    memory = torch.randn(batch_size, input_length, hparams.encoder_embedding_dim)
+    decoder.initialize_decoder_states(memory, mask=None)
+    decoder_input = decoder.prenet(decoder.get_go_frame(memory))
+    return lambda: decoder.decode(decoder_input, None)
+
+
+def _attention(data, input_length, batch_size=8):
+    hparams = TACOTRON2_DEFAULTS
+    torch.manual_seed(0)
+    attention = Attention(
+        hparams.attention_rnn_dim,
+        hparams.encoder_embedding_dim,
+        hparams.attention_dim,
+        hparams.attention_location_n_filters,
+        hparams.attention_location_kernel_size,
+        fp16_run=False,
+    ).eval()
+    query = torch.randn(batch_size, hparams.attention_rnn_dim)
+    memory = torch.randn(batch_size, input_length, hparams.encoder_embedding_dim)
+    processed_memory = attention.memory_layer(memory)
+    weights = torch.softmax(torch.randn(batch_size, input_length), dim=1)
+    weights_cat = torch.stack([weights, weights.cumsum(dim=1)], dim=1)
+    return lambda: attention(query, memory, processed_memory, weights_cat, None, None)
+
+
+def _compute_yin(data, seconds):
+    audio = synthetic_audio(seconds)
+    return lambda: compute_yin(audio, SAMPLING_RATE, 1024, 256, 80, 880, 0.25)
+
+
+def _hifigan_generator(data, frames):
+    torch.manual_seed(0)
+    generator = Generator(AttrDict(HIFIGAN_DEFAULTS)).eval()
+    generator.remove_weight_norm()
+    mel = torch.randn(1, 80, frames)
+    return lambda: generator(mel)
+
+
+def _inference_generator(data, frames, fuse_mrf=False):
+    torch.manual_seed(0)
+    generator = InferenceGenerator(
+        Generator(AttrDict(HIFIGAN_DEFAULTS)), fuse_mrf=fuse_mrf
+    )
+    mel = torch.randn(1, 80, frames)
+    return lambda: generator(mel)
+
+
+# NOTE: name -> (setup, sizes). setup(data, **params) returns the callable to time.
+BENCHMARKS = dict(
+    text_to_sequence=(
+        _text_to_sequence,
+        dict(small=dict(words=8), medium=dict(words=32), large=dict(words=128)),
+    ),
+    mel_spectrogram=(
+        _mel_spectrogram,
+        dict(small=dict(seconds=1), medium=dict(seconds=4), large=dict(seconds=16)),
+    ),
+    text_mel_collate=(
+        _text_mel_collate,
+        dict(
+            small=dict(batch_size=4),
+            medium=dict(batch_size=16),
+            large=dict(batch_size=64),
+        ),
+    ),
+    decoder_decode=(
+        _decoder_decode,
+        dict(
+            small=dict(batch_size=1),
+            medium=dict(batch_size=8),
+            large=dict(batch_size=32),
+        ),
+    ),
+    attention=(
+        _attention,
+        dict(
+            small=dict(input_length=64),
+            medium=dict(input_length=256),
+            large=dict(input_length=1024),
+        ),
+    ),
+    compute_yin=(
+        _compute_yin,
+        dict(small=dict(seconds=0.25), medium=dict(seconds=1), large=dict(seconds=4)),
+    ),
+    hifigan_generator=(
+        _hifigan_generator,
+        dict(small=dict(frames=16), medium=dict(frames=64), large=dict(frames=256)),
+    ),
+    inference_generator=(
+        _inference_generator,
+        dict(small=dict(frames=16), medium=dict(frames=64), large=dict(frames=256)),
+    ),
+    inference_generator_fused=(
+        _inference_generator,
+        dict(
+            small=dict(frames=16, fuse_mrf=True),
+            medium=dict(frames=64, fuse_mrf=True),
+            large=dict(frames=256, fuse_mrf=True),
+        ),
+    ),
+)
+
+
+def time_callable(fn, repeats=10, min_sample_seconds=0.05):
+    """Seconds per call of fn, as repeats samples.
+
+    After a warm up call, the number of calls per sample is doubled until a sample
+    takes at least min_sample_seconds, so that fast functions are not dominated by
+    timer resolution. Returns (samples, calls per sample).
+    """
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_sample_seconds:
+            break
+        number *= 2
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples, number
+
+
+def conv_launches(fn):
+    """Number of convolutions launched by one call of fn. On GPU each is at least
+    one kernel launch, so this tracks launch overhead independently of the device
+    the benchmark runs on."""
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU]
+    ) as prof:
+        fn()
+    return sum(
+        event.count for event in prof.key_averages() if event.key == "aten::convolution"
+    )
+
+
+def run(
+    names=None,
+    sizes=None,
+    repeats=10,
+    min_sample_seconds=0.05,
+    num_threads=1,
+    data_dir=None,
+):
+    """Time the benchmarks in names (default: all of BENCHMARKS) at sizes (default:
+    small, medium and large) on synthetic data written to data_dir (default: a
+    temporary directory).
+
+    Returns dict(meta, results): meta describes the machine and library versions,
+    and results has the benchmark, size, parameters, calls per sample, the samples
+    in seconds per call, their median and the convolutions launched per call (see
+    conv_launches) for each benchmark and size.
+    """
+    names = names or list(BENCHMARKS)
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = data_dir or tmp_dir
+            data = dict(filelist=synthetic_data(data_dir))
+            with torch.no_grad():
+                for name in names:
+                    setup, params = BENCHMARKS[name]
+                    for size in sizes or list(params):
+                        fn = setup(data, **params[size])
+                        samples, number = time_callable(
+                            fn, repeats=repeats, min_sample_seconds=min_sample_seconds
+                        )
+                        results.append(
+                            dict(
+                                benchmark=name,
+                                size=size,
+                                params=params[size],
+                                number=number,
+                                samples=samples,
+                                median=statistics.median(samples),
+                                conv_launches=conv_launches(fn),
+                            )
+                        )
+                        print(
+                            f"{name} {size}: {1000 * results[-1]['median']:.3f} ms, "
+                            f"{results[-1]['conv_launches']} convolutions",
+                            flush=True,
+                        )
+    finally:
+        torch.set_num_threads(previous_threads)
+    meta = dict(
+        python=platform.python_version(),
+        torch=torch.__version__,
+        numpy=np.__version__,
+        machine=platform.machine(),
+        processor=platform.processor(),
+        num_threads=num_threads,
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    return dict(meta=meta, results=results)
+
+
+def compare(baseline, current, alpha=0.01, min_change=0.05):
+    """Compare two run results benchmark by benchmark.
+
+    A benchmark is slower (or faster) when a one-sided Mann-Whitney U test of its
+    samples is significant at alpha and its median changed by more than min_change
+    (a fraction); otherwise it is unchanged. Benchmarks missing from either run
+    are skipped. Returns a list of dicts with the benchmark, size, both medians,
+    the relative change, the p-value and the status.
+    """
+    baseline = {(r["benchmark"], r["size"]): r for r in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        expected = baseline.get((result["benchmark"], result["size"]))
+        if expected is None:
+            continue
+        change = result["median"] / expected["median"] - 1
+        p_slower = mannwhitneyu(
+            result["samples"], expected["samples"], alternative="greater"
+        ).pvalue
+        p_faster = mannwhitneyu(
+            result["samples"], expected["samples"], alternative="less"
+        ).pvalue
+        status = "unchanged"
+        if p_slower < alpha and change > min_change:
+            status = "slower"
+        elif p_faster < alpha and change < -min_change:
+            status = "faster"
+        rows.append(
+            dict(
+                benchmark=result["benchmark"],
+                size=result["size"],
+                baseline_median=expected["median"],
+                current_median=result["median"],
+                change=change,
+                p_value=p_slower if change > 0 else p_faster,
+                status=status,
+            )
+        )
+    return rows
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--benchmarks", nargs="+", choices=list(BENCHMARKS), help="Default: all"
+    )
+    run_parser.add_argument(
+        "--sizes", nargs="+", choices=["small", "medium", "large"], help="Default: all"
+    )
+    run_parser.add_argument("--repeats", type=int, default=10)
+    run_parser.add_argument("--min-sample-seconds", type=float, default=0.05)
+    run_parser.add_argument("--threads", type=int, default=1)
+    run_parser.add_argument("--data-dir", help="Keep the synthetic data here")
+    run_parser.add_argument("-o", "--output", help="Write the results to this file")
+    compare_parser = subparsers.add_parser(
+        "compare", help="Flag significant slowdowns between two runs"
+    )
+    compare_parser.add_argument("baseline", help="Results of the earlier run")
+    compare_parser.add_argument("current", help="Results of the later run")
+    compare_parser.add_argument("--alpha", type=float, default=0.01)
+    compare_parser.add_argument(
+        "--min-change",
+        type=float,
+        default=0.05,
+        help="Smallest relative change of the median that is reported",
+    )
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    if args.command == "run":
+        report = run(
+            names=args.benchmarks,
+            sizes=args.sizes,
+            repeats=args.repeats,
+            min_sample_seconds=args.min_sample_seconds,
+            num_threads=args.threads,
+            data_dir=args.data_dir,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if baseline["meta"]["torch"] != current["meta"]["torch"]:
+            print("Warning: the runs used different torch versions")
+        rows = compare(baseline, current, alpha=args.alpha, min_change=args.min_change)
+        for row in rows:
+            print(
+                f"{row['benchmark']:>18} {row['size']:>6} "
+                f"{1000 * row['baseline_median']:10.3f} ms -> "
+                f"{1000 * row['current_median']:10.3f} ms "
+                f"{100 * row['change']:+7.1f}% p={row['p_value']:.4f} {row['status']}"
+            )
+        if any(row["status"] == "slower" for row in rows):
+            sys.exit(1)
@@ -0,0 +1,263 @@
+__all__ = ["read_lines", "load_progress", "run", "parse_args"]
+
+
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import time
+
+import torch
+
+from ..e2e import tts_batch
+from ..models.tacotron2 import DEFAULTS as TACOTRON2_DEFAULTS
+from ..registry import load_tacotron2, load_hifigan
+from ..text.util import text_to_sequence
+from ..utils.audio import audio_to_wav, saturate_int16
+from ..vendor.tfcompat.hparam import HParams
+
+
+def read_lines(path, start=0):
+    """Stream (line_number, id, text, speaker_id) from a file of "text", "id|text" or
+    "id|text|speaker_id" lines, skipping the first start lines. Blank lines are skipped
+    but still counted."""
+    with open(path) as f:
+        for line_number, line in enumerate(itertools.islice(f, start, None), start):
+            if not line.strip():
+                continue
+            fields = line.rstrip("\n").split("|")
+            if len(fields) == 1:
+                yield line_number, f"{line_number:09d}", fields[0], 0
+            elif len(fields) == 2:
+                yield line_number, fields[0], fields[1], 0
+            else:
+                yield line_number, fields[0], fields[1], int(fields[2])
+
+
+def _write_json(path, value):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def load_progress(output_dir):
+    """The progress of a job in output_dir: the number of input lines consumed and of
+    shards written. Both are 0 for a new job."""
+    path = os.path.join(output_dir, "progress.json")
+    if not os.path.exists(path):
+        return dict(lines=0, shards=0, audio_seconds=0.0, synthesis_seconds=0.0)
+    with open(path) as f:
+        return json.load(f)
+
+
+def _truncate_index(index_path, shards):
+    """Drop index entries of shards written after the last checkpoint."""
+    if not os.path.exists(index_path):
+        return
+    with open(index_path) as f:
+        entries = [line for line in f if json.loads(line)["shard_index"] < shards]
+    with open(f"{index_path}.tmp", "w") as f:
+        f.writelines(entries)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def _synthesize_window(
+    window, model, vocoder, device, batch_size, symbol_set, seed, bucket_length
+):
+    """Yield the (item, audio) pairs of each batch of window as it is synthesized."""
+
+    def n_tokens(item):
+        return len(
+            text_to_sequence(item[2], ["english_cleaners"], symbol_set=symbol_set)
+        )
+
+    # NOTE: sorting by token length keeps the padding of each batch small.
+    window = sorted(window, key=n_tokens, reverse=True)
+    for start in range(0, len(window), batch_size):
+        batch = window[start : start + batch_size]
+        audios = tts_batch(
+            [item[2] for item in batch],
+            model,
+            device,
+            vocoder,
+            symbol_set=symbol_set,
+            speaker_ids=torch.tensor(
+                [item[3] for item in batch], dtype=torch.long, device=device
+            ),
+            bucket_length=bucket_length,
+            seed=seed,
+        )
+        yield list(zip(batch, audios))
+
+
+def run(
+    input_path,
+    output_dir,
+    checkpoint,
+    hifigan_config,
+    hifigan_checkpoint,
+    hparams=None,
+    device="cpu",
+    window_size=4096,
+    batch_size=32,
+    seed=1234,
+    bucket_length=64,
+    max_windows=None,
+):
+    """Synthesize every line of input_path into output_dir, resuming a previous run.
+
+    Lines are read window_size at a time, sorted by token length and synthesized in
+    batches of batch_size. Each window is written as one tar shard of wav files
+    (shard-00000.tar, ...), in length order with each batch written as soon as it is
+    synthesized, so only one batch of audio is held at a time. The entries of the
+    shard are appended to index.jsonl in line order. progress.json is updated after
+    every shard, so a job that is killed resumes after the last complete shard and
+    writes the same audio as an uninterrupted job (every batch is synthesized with
+    the same seed). max_windows stops after that many windows.
+
+    Returns lines/sec and the real-time factor (synthesis seconds per audio second).
+    """
+    hparams = hparams or TACOTRON2_DEFAULTS
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, "index.jsonl")
+    progress_path = os.path.join(output_dir, "progress.json")
+    progress = load_progress(output_dir)
+    _truncate_index(index_path, progress["shards"])
+
+    model = load_tacotron2(checkpoint, hparams, device=device)
+    vocoder = load_hifigan(
+        hifigan_config, hifigan_checkpoint, cudnn_enabled=device == "cuda"
+    )
+    sampling_rate = vocoder.vocoder.h.sampling_rate
+
+    lines = read_lines(input_path, start=progress["lines"])
+    start_lines = progress["lines"]
+    start_time = time.perf_counter()
+    windows_done = 0
+    while max_windows is None or windows_done < max_windows:
+        window = list(itertools.islice(lines, window_size))
+        if not window:
+            break
+        shard = f"shard-{progress['shards']:05d}.tar"
+        shard_path = os.path.join(output_dir, shard)
+        entries = []
+        synthesis_seconds = 0.0
+        audio_seconds = 0.0
+        with tarfile.open(f"{shard_path}.tmp", "w") as tar:
+            batches = _synthesize_window(
+                window,
+                model,
+                vocoder,
+                device,
+                batch_size,
+                hparams.symbol_set,
+                seed,
+                bucket_length,
+            )
+            batch_start = time.perf_counter()
+            for results in batches:
+                synthesis_seconds += time.perf_counter() - batch_start
+                for (line_number, id_, text, speaker_id), audio in results:
+                    wav = audio_to_wav(saturate_int16(audio), sampling_rate)
+                    info = tarfile.TarInfo(f"{id_}.wav")
+                    info.size = len(wav)
+                    tar.addfile(info, io.BytesIO(wav))
+                    audio_seconds += audio.numel() / sampling_rate
+                    entries.append(
+                        dict(
+                            id=id_,
+                            shard=shard,
+                            shard_index=progress["shards"],
+                            member=info.name,
+                            line=line_number,
+                            text=text,
+                            speaker_id=speaker_id,
+                            seconds=audio.numel() / sampling_rate,
+                        )
+                    )
+                batch_start = time.perf_counter()
+        os.replace(f"{shard_path}.tmp", shard_path)
+        with open(index_path, "a") as f:
+            f.writelines(
+                json.dumps(entry) + "\n"
+                for entry in sorted(entries, key=lambda e: e["line"])
+            )
+        # NOTE: blank lines are skipped by read_lines but consumed all the same.
+        progress["lines"] = window[-1][0] + 1
+        progress["shards"] += 1
+        progress["audio_seconds"] += audio_seconds
+        progress["synthesis_seconds"] += synthesis_seconds
+        _write_json(progress_path, progress)
+        windows_done += 1
+        print(
+            f"{shard}: {len(entries)} lines, "
+            f"{len(entries) / synthesis_seconds:.2f} lines/sec, "
+            f"RTF {synthesis_seconds / max(audio_seconds, 1e-9):.3f}",
+            flush=True,
+        )
+
+    seconds = time.perf_counter() - start_time
+    return dict(
+        lines=progress["lines"],
+        shards=progress["shards"],
+        lines_this_run=progress["lines"] - start_lines,
+        lines_per_second=(progress["lines"] - start_lines) / seconds,
+        audio_seconds=progress["audio_seconds"],
+        rtf=progress["synthesis_seconds"] / max(progress["audio_seconds"], 1e-9),
+    )
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input", help='File of "text", "id|text" or "id|text|speaker_id" lines'
+    )
+    parser.add_argument(
+        "-o", "--output", help="Directory for the shards, index and progress"
+    )
+    parser.add_argument("--checkpoint", help="Path to the Tacotron2 checkpoint")
+    parser.add_argument("--config", help="Path to a JSON of Tacotron2 hparams")
+    parser.add_argument("--hifigan-config", help="Path to the HiFi-GAN JSON config")
+    parser.add_argument("--hifigan-checkpoint", help="Path to the HiFi-GAN checkpoint")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=4096,
+        help="Lines sorted by length together, and written as one shard",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--bucket-length", type=int, default=64)
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    config = TACOTRON2_DEFAULTS.values()
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    report = run(
+        args.input,
+        args.output,
+        args.checkpoint,
+        args.hifigan_config,
+        args.hifigan_checkpoint,
+        hparams=HParams(**config),
+        device=args.device,
+        window_size=args.window_size,
+        batch_size=args.batch_size,
+        seed=args.seed,
+        bucket_length=args.bucket_length,
+    )
+    print(json.dumps(report, indent=2))
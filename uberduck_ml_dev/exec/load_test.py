@@ -0,0 +1,193 @@
+__all__ = ["request_synthesis", "run", "scaling", "parse_args"]
+
+
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.io.wavfile import read
+
+
+DEFAULT_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Hello world.",
+    "Printing, in the only sense with which we are at present concerned.",
+    "It is a far, far better thing that I do, than I have ever done.",
+]
+
+
+def request_synthesis(url, voice, text, speaker_id=0, timeout=600):
+    """POST one request to a serve.py /synthesize endpoint -> (latency, audio seconds)."""
+    data = json.dumps(dict(voice=voice, text=text, speaker_id=speaker_id)).encode()
+    request = urllib.request.Request(
+        f"{url}/synthesize",
+        data=data,
+        headers={"Content-Type": "application/json"},
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+    latency = time.perf_counter() - start
+    sampling_rate, audio = read(io.BytesIO(body))
+    return latency, len(audio) / sampling_rate
+
+
+def run(url, voices, texts, concurrency=8, n_requests=64):
+    """Send n_requests synthesis requests to url from concurrency threads, cycling
+    through voices and texts, and report throughput and latency percentiles."""
+
+    def send(idx):
+        try:
+            return request_synthesis(
+                url, voices[idx % len(voices)], texts[idx % len(texts)]
+            )
+        except Exception as e:
+            print(f"Request {idx} failed: {e}")
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(n_requests)))
+    seconds = time.perf_counter() - start
+    completed = [r for r in results if r is not None]
+    latencies = np.array([r[0] for r in completed]) if completed else np.zeros(1)
+    audio_seconds = sum(r[1] for r in completed)
+    return dict(
+        requests=n_requests,
+        errors=n_requests - len(completed),
+        concurrency=concurrency,
+        seconds=seconds,
+        requests_per_second=len(completed) / seconds,
+        audio_seconds_per_second=audio_seconds / seconds,
+        latency_mean=float(latencies.mean()),
+        latency_p50=float(np.percentile(latencies, 50)),
+        latency_p99=float(np.percentile(latencies, 99)),
+    )
+
+
+def scaling(
+    voices,
+    worker_counts,
+    texts,
+    concurrency_per_worker=4,
+    requests_per_worker=8,
+    num_threads=None,
+    **server_kwargs,
+):
+    """Start a serve.TTSServer with that many workers for each worker count and
+    load test it.
+
+    Reports throughput, its speedup over the first worker count, latency, and the
+    mean resident, private and shared memory of the worker processes.
+    """
+    from .serve import TTSServer
+
+    async def measure(server, n_workers):
+        loop = asyncio.get_running_loop()
+        url = f"http://127.0.0.1:{await server.start(port=0)}"
+        # NOTE: warm up every worker before timing.
+        await loop.run_in_executor(
+            None, lambda: run(url, voices_list, texts, n_workers, n_workers)
+        )
+        report = await loop.run_in_executor(
+            None,
+            lambda: run(
+                url,
+                voices_list,
+                texts,
+                concurrency=concurrency_per_worker * n_workers,
+                n_requests=requests_per_worker * n_workers,
+            ),
+        )
+        workers = server.pool.metrics()
+        await server.drain()
+        await server.wait_stopped()
+        return report, workers
+
+    voices_list = sorted(voices)
+    reports = []
+    for n_workers in worker_counts:
+        server = TTSServer(
+            voices, workers=n_workers, num_threads=num_threads, **server_kwargs
+        )
+        report, workers = asyncio.run(measure(server, n_workers))
+        memory = {
+            key: float(np.mean([w.get(key, 0.0) for w in workers]))
+            for key in ("rss_mb", "anon_mb", "shared_mb")
+        }
+        reports.append(
+            dict(
+                workers=n_workers,
+                threads_per_worker=workers[0]["num_threads"],
+                requests_per_second=report["requests_per_second"],
+                audio_seconds_per_second=report["audio_seconds_per_second"],
+                speedup=report["requests_per_second"]
+                / reports[0]["requests_per_second"]
+                if reports
+                else 1.0,
+                latency_p50=report["latency_p50"],
+                latency_p99=report["latency_p99"],
+                errors=report["errors"],
+                **{f"worker_{key}": value for key, value in memory.items()},
+            )
+        )
+    return reports
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--voice", action="append", help="Voice to request, repeatable")
+    parser.add_argument("--texts", help="File with one text per line")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument(
+        "--scaling-voices",
+        help="Instead of load testing --url, start multi-worker servers for these voices (a serve.py voices JSON) and report scaling over --workers",
+    )
+    parser.add_argument(
+        "--workers",
+        default="1,2,4",
+        help="Comma separated worker counts for --scaling-voices",
+    )
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    texts = DEFAULT_TEXTS
+    if args.texts:
+        with open(args.texts) as f:
+            texts = [line.strip() for line in f if line.strip()]
+    if args.scaling_voices:
+        from .serve import load_voices
+
+        report = scaling(
+            load_voices(args.scaling_voices),
+            [int(n) for n in args.workers.split(",")],
+            texts,
+            num_threads=args.threads_per_worker,
+            max_batch_size=args.max_batch_size,
+        )
+    else:
+        report = run(
+            args.url,
+            args.voice,
+            texts,
+            concurrency=args.concurrency,
+            n_requests=args.requests,
+        )
+    print(json.dumps(report, indent=2))
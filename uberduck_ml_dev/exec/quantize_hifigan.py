@@ -0,0 +1,127 @@
+__all__ = ["load_mels", "run", "parse_args"]
+
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from ..monitoring.statistics import multi_resolution_stft_distance
+from ..vocoders.hifigan import HiFiGanGenerator, quantize_generator
+
+
+def load_mels(dirname):
+    """Load the (num_mels, T) or (1, num_mels, T) mels saved as .npy or .pt files in a directory."""
+    mels = []
+    for filename in sorted(os.listdir(dirname)):
+        path = os.path.join(dirname, filename)
+        if filename.endswith(".npy"):
+            mel = torch.from_numpy(np.load(path))
+        elif filename.endswith(".pt"):
+            mel = torch.load(path, map_location="cpu")
+        else:
+            continue
+        mel = mel.float()
+        if mel.dim() == 2:
+            mel = mel[None]
+        mels.append(mel)
+    return mels
+
+
+@torch.no_grad()
+def _vocode(vocoder, mels):
+    start = time.perf_counter()
+    audios = [vocoder(mel)[:, 0] for mel in mels]
+    return audios, time.perf_counter() - start
+
+
+def run(
+    config,
+    checkpoint,
+    mel_dirname,
+    output,
+    eval_dirname=None,
+    channels_last=True,
+    engine="fbgemm",
+):
+    """Quantize a HiFi-GAN checkpoint, calibrated on the mels in mel_dirname, and save
+    it to output. Returns the multi-resolution STFT distance to fp32 and the speedup,
+    measured on the mels in eval_dirname (by default the calibration mels)."""
+    fp32 = HiFiGanGenerator(config, checkpoint)
+    calibration = load_mels(mel_dirname)
+    if not calibration:
+        raise Exception(f"No .npy or .pt mels found in {mel_dirname}")
+    quantized = quantize_generator(
+        fp32.vocoder, calibration, channels_last=channels_last, engine=engine
+    )
+    torch.save(
+        dict(
+            generator=quantized.state_dict(),
+            quantization=dict(channels_last=channels_last, engine=engine),
+        ),
+        output,
+    )
+
+    int8 = HiFiGanGenerator(config, output)
+    mels = load_mels(eval_dirname) if eval_dirname else calibration
+    # NOTE: warm up both models before timing.
+    _vocode(fp32.vocoder, mels[:1])
+    _vocode(int8.vocoder, mels[:1])
+    references, fp32_seconds = _vocode(fp32.vocoder, mels)
+    audios, int8_seconds = _vocode(int8.vocoder, mels)
+    distances = [
+        multi_resolution_stft_distance(audio, reference).item()
+        for audio, reference in zip(audios, references)
+    ]
+    return dict(
+        mrstft_distance=float(np.mean(distances)),
+        mrstft_distance_max=float(np.max(distances)),
+        fp32_seconds=fp32_seconds,
+        int8_seconds=int8_seconds,
+        speedup=fp32_seconds / int8_seconds,
+        samples=sum(audio.numel() for audio in audios),
+    )
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Path to the HiFi-GAN JSON config")
+    parser.add_argument("--checkpoint", help="Path to the fp32 HiFi-GAN checkpoint")
+    parser.add_argument(
+        "--mels", help="Directory of .npy or .pt mels to calibrate activation ranges"
+    )
+    parser.add_argument(
+        "--eval-mels",
+        help="Directory of .npy or .pt mels to measure quality and speed on. Defaults to --mels.",
+    )
+    parser.add_argument("-o", "--output", help="Path to write the quantized checkpoint")
+    parser.add_argument("--engine", default="fbgemm")
+    parser.add_argument("--channels-last", dest="channels_last", action="store_true")
+    parser.add_argument(
+        "--no-channels-last", dest="channels_last", action="store_false"
+    )
+    parser.set_defaults(channels_last=True)
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    report = run(
+        args.config,
+        args.checkpoint,
+        args.mels,
+        args.output,
+        eval_dirname=args.eval_mels,
+        channels_last=args.channels_last,
+        engine=args.engine,
+    )
+    print(json.dumps(report, indent=2))
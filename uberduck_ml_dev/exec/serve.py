@@ -0,0 +1,635 @@
+__all__ = [
+    "DynamicBatcher",
+    "WorkerPool",
+    "TTSServer",
+    "load_voices",
+    "run",
+    "parse_args",
+]
+
+
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+import torch
+
+from ..e2e import tts_batch
+from ..models.tacotron2 import DEFAULTS as TACOTRON2_DEFAULTS
+from ..registry import get_registry, load_tacotron2, load_hifigan
+from ..utils.audio import audio_to_wav, saturate_int16
+from ..vendor.tfcompat.hparam import HParams
+
+
+class DynamicBatcher:
+    """Groups concurrently submitted items with the same key into batches.
+
+    A batch is dispatched once it holds max_batch_size items or its oldest item has
+    waited max_wait seconds, and process_batch(key, items) -> results is run on it in
+    the executor. Batches of different keys are queued independently.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait=0.01, executor=None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._queues = {}
+        self._ready = {}
+        self._workers = {}
+        self._pending = 0
+        self._idle = None
+        self.batch_sizes = []
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        if key not in self._queues:
+            self._queues[key] = deque()
+            self._ready[key] = asyncio.Event()
+            self._workers[key] = loop.create_task(self._worker(key))
+        future = loop.create_future()
+        self._pending += 1
+        self._idle.clear()
+        self._queues[key].append((item, future, loop.time()))
+        self._ready[key].set()
+        return await future
+
+    async def _worker(self, key):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[key]
+        ready = self._ready[key]
+        while True:
+            await ready.wait()
+            while len(queue) < self.max_batch_size:
+                timeout = queue[0][2] + self.max_wait - loop.time()
+                if timeout <= 0:
+                    break
+                ready.clear()
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = [
+                queue.popleft() for _ in range(min(len(queue), self.max_batch_size))
+            ]
+            if not queue:
+                ready.clear()
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.process_batch, key, [b[0] for b in batch]
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self._pending -= len(batch)
+            if self._pending == 0:
+                self._idle.set()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def drain(self):
+        """Wait until every submitted item has been processed."""
+        if self._pending:
+            await self._idle.wait()
+
+    async def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _memory_usage():
+    """Resident memory of this process in MB, split into anonymous (private) memory
+    and shared memory, from /proc/self/status. Empty where /proc is not available."""
+    fields = dict(VmRSS="rss_mb", RssAnon="anon_mb", RssShmem="shared_mb")
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    usage[fields[name]] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
+
+
+def _worker_main(conn, process_batch, num_threads, cores):
+    torch.set_num_threads(num_threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    conn.send(("ready", None, _memory_usage()))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            result = process_batch(*message)
+        except Exception as e:
+            conn.send(("error", repr(e), _memory_usage()))
+        else:
+            conn.send(("ok", result, _memory_usage()))
+    conn.close()
+
+
+class WorkerPool:
+    """Worker processes that each run process_batch(key, items).
+
+    The workers are started with forkserver (spawn where it is not available) rather
+    than forked from this process, whose torch and event loop threads a fork would
+    copy mid-flight. process_batch is pickled to each worker, so it must be picklable:
+    tensors placed in shared memory (Module.share_memory) beforehand are passed as
+    handles and mapped by every worker rather than copied. Each worker runs
+    num_threads intra-op threads pinned to its own slice of the available cores.
+    Batches are dispatched to the worker with the fewest batches in flight
+    ("least-loaded") or in turn ("round-robin"). A worker that dies fails the batch
+    it was running and is replaced by a new one.
+    """
+
+    def __init__(
+        self,
+        process_batch,
+        num_workers,
+        num_threads=None,
+        dispatch="least-loaded",
+        affinity=True,
+    ):
+        if dispatch not in ("least-loaded", "round-robin"):
+            raise Exception(f"Unknown dispatch policy: {dispatch}")
+        self.process_batch = process_batch
+        self.num_workers = num_workers
+        self.num_threads = num_threads or max(1, _available_cores() // num_workers)
+        self.dispatch = dispatch
+        self.affinity = affinity
+        self.workers = []
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        method = (
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self._context = torch.multiprocessing.get_context(method)
+
+    def __len__(self):
+        return self.num_workers
+
+    def _cores(self, idx):
+        if not self.affinity or not hasattr(os, "sched_getaffinity"):
+            return None
+        cores = sorted(os.sched_getaffinity(0))
+        start = idx * self.num_threads
+        return {cores[(start + i) % len(cores)] for i in range(self.num_threads)}
+
+    def _spawn(self, idx):
+        conn, child_conn = self._context.Pipe()
+        cores = self._cores(idx)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, self.process_batch, self.num_threads, cores),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        _, _, memory = conn.recv()
+        return dict(
+            process=process,
+            conn=conn,
+            cores=sorted(cores) if cores else None,
+            memory=memory,
+        )
+
+    def start(self):
+        for idx in range(self.num_workers):
+            self.workers.append(
+                dict(
+                    self._spawn(idx),
+                    idx=idx,
+                    lock=threading.Lock(),
+                    in_flight=0,
+                    batches=0,
+                    restarts=0,
+                )
+            )
+
+    def _choose(self):
+        with self._lock:
+            if self.dispatch == "round-robin":
+                worker = self.workers[next(self._turn) % len(self.workers)]
+            else:
+                worker = min(self.workers, key=lambda w: w["in_flight"])
+            worker["in_flight"] += 1
+            return worker
+
+    def __call__(self, key, items):
+        """Run process_batch(key, items) on a worker and return its result."""
+        worker = self._choose()
+        try:
+            with worker["lock"]:
+                try:
+                    worker["conn"].send((key, items))
+                    status, result, worker["memory"] = worker["conn"].recv()
+                except (EOFError, OSError):
+                    pid = worker["process"].pid
+                    worker["process"].join()
+                    status, result = "error", (
+                        f"exited with code {worker['process'].exitcode}"
+                    )
+                    worker["conn"].close()
+                    worker.update(self._spawn(worker["idx"]))
+                    worker["restarts"] += 1
+                else:
+                    pid = worker["process"].pid
+        finally:
+            with self._lock:
+                worker["in_flight"] -= 1
+                worker["batches"] += 1
+        if status == "error":
+            raise Exception(f"Worker {pid} failed: {result}")
+        return result
+
+    def metrics(self):
+        return [
+            dict(
+                pid=worker["process"].pid,
+                cores=worker["cores"],
+                num_threads=self.num_threads,
+                batches=worker["batches"],
+                in_flight=worker["in_flight"],
+                restarts=worker["restarts"],
+                **worker["memory"],
+            )
+            for worker in self.workers
+        ]
+
+    def close(self):
+        for worker in self.workers:
+            with worker["lock"]:
+                worker["conn"].send(None)
+            worker["process"].join()
+            worker["conn"].close()
+        self.workers = []
+
+
+def load_voices(path):
+    """Read a JSON file mapping voice names to dicts with the Tacotron2 checkpoint,
+    optional Tacotron2 hparams overrides, hifigan_config and hifigan_checkpoint."""
+    with open(path) as f:
+        voices = json.load(f)
+    for voice in voices.values():
+        config = TACOTRON2_DEFAULTS.values()
+        config.update(voice.get("hparams", {}))
+        voice["hparams"] = HParams(**config)
+    return voices
+
+
+def _synthesize_items(model, vocoder, symbol_set, device, items):
+    """items -> list of wav bytes."""
+    speaker_ids = torch.tensor(
+        [item.get("speaker_id", 0) for item in items],
+        dtype=torch.long,
+        device=device,
+    )
+    audios = tts_batch(
+        [item["text"] for item in items],
+        model,
+        device,
+        vocoder,
+        speaker_ids=speaker_ids,
+        symbol_set=symbol_set,
+    )
+    sampling_rate = vocoder.vocoder.h.sampling_rate
+    return [audio_to_wav(saturate_int16(audio), sampling_rate) for audio in audios]
+
+
+def _synthesize_voice_batch(models, device, voice, items):
+    """process_batch of the WorkerPool of a TTSServer, models maps each voice to
+    its (model, vocoder, symbol_set)."""
+    return _synthesize_items(*models[voice], device, items)
+
+
+class TTSServer:
+    """HTTP server that synthesizes concurrent requests for the same voice as batches.
+
+    POST /synthesize {"voice", "text", "speaker_id"} -> audio/wav
+    GET /health, GET /metrics
+    POST /drain stops accepting requests, finishes the queued ones and shuts down.
+    Request bodies over max_body_bytes are refused with 413 without being read.
+
+    With workers, every voice is loaded up front with its weights in shared memory,
+    and batches run in a WorkerPool of that many processes instead of a thread of
+    this one.
+    """
+
+    def __init__(
+        self,
+        voices,
+        device="cpu",
+        max_batch_size=8,
+        max_wait=0.01,
+        registry=None,
+        latency_window=10000,
+        workers=0,
+        num_threads=None,
+        dispatch="least-loaded",
+        max_body_bytes=1 << 20,
+    ):
+        self.voices = voices
+        self.device = device
+        self.max_body_bytes = max_body_bytes
+        self.registry = get_registry() if registry is None else registry
+        self.pool = None
+        if workers:
+            models = {}
+            for voice in voices:
+                model, vocoder = self.load(voice)
+                model.share_memory()
+                vocoder.share_memory()
+                models[voice] = (model, vocoder, voices[voice]["hparams"].symbol_set)
+            self.pool = WorkerPool(
+                functools.partial(_synthesize_voice_batch, models, device),
+                workers,
+                num_threads=num_threads,
+                dispatch=dispatch,
+            )
+            self.pool.start()
+        self.batcher = DynamicBatcher(
+            self.synthesize_batch if self.pool is None else self.pool,
+            max_batch_size=max_batch_size,
+            max_wait=max_wait,
+            executor=ThreadPoolExecutor(max_workers=workers) if workers else None,
+        )
+        self.draining = False
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.started = time.perf_counter()
+        self._server = None
+        self._stopped = None
+
+    def load(self, voice):
+        spec = self.voices[voice]
+        model = load_tacotron2(
+            spec["checkpoint"],
+            spec["hparams"],
+            device=self.device,
+            registry=self.registry,
+        )
+        vocoder = load_hifigan(
+            spec["hifigan_config"],
+            spec["hifigan_checkpoint"],
+            cudnn_enabled=self.device == "cuda",
+            registry=self.registry,
+        )
+        return model, vocoder
+
+    def synthesize_batch(self, voice, items):
+        """Run in the batcher's worker thread: items -> list of wav bytes."""
+        model, vocoder = self.load(voice)
+        return _synthesize_items(
+            model, vocoder, self.voices[voice]["hparams"].symbol_set, self.device, items
+        )
+
+    def metrics(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        batch_sizes = self.batcher.batch_sizes
+        return dict(
+            requests=self.requests,
+            errors=self.errors,
+            pending=self.batcher.pending,
+            batches=len(batch_sizes),
+            mean_batch_size=float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+            latency_p50=float(np.percentile(latencies, 50)),
+            latency_p99=float(np.percentile(latencies, 99)),
+            uptime=time.perf_counter() - self.started,
+            draining=self.draining,
+            registry=self.registry.metrics(),
+            workers=self.pool.metrics() if self.pool else [],
+        )
+
+    async def synthesize(self, request):
+        if self.draining:
+            return HTTPStatus.SERVICE_UNAVAILABLE, dict(error="draining")
+        if request.get("voice") not in self.voices or not request.get("text"):
+            return HTTPStatus.BAD_REQUEST, dict(error="voice and text are required")
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            wav = await self.batcher.submit(request["voice"], request)
+        except Exception as e:
+            self.errors += 1
+            return HTTPStatus.INTERNAL_SERVER_ERROR, dict(error=str(e))
+        self.latencies.append(time.perf_counter() - start)
+        return HTTPStatus.OK, wav
+
+    async def drain(self):
+        self.draining = True
+        await self.batcher.drain()
+        self._stopped.set()
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            status = "draining" if self.draining else "ok"
+            return HTTPStatus.OK, dict(status=status, voices=sorted(self.voices))
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, self.metrics()
+        if method == "POST" and path == "/synthesize":
+            try:
+                request = json.loads(body)
+            except ValueError:
+                return HTTPStatus.BAD_REQUEST, dict(error="invalid JSON")
+            return await self.synthesize(request)
+        if method == "POST" and path == "/drain":
+            await self.drain()
+            return HTTPStatus.OK, dict(status="drained")
+        return HTTPStatus.NOT_FOUND, dict(error="not found")
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            content_length = int(headers.get("content-length", 0))
+            if content_length < 0:
+                raise ValueError(f"Invalid Content-Length: {content_length}")
+            if content_length > self.max_body_bytes:
+                status, payload = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, dict(
+                    error=f"request body over {self.max_body_bytes} bytes"
+                )
+            else:
+                body = await reader.readexactly(content_length)
+                status, payload = await self.route(method, path.split("?")[0], body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, payload = HTTPStatus.BAD_REQUEST, dict(error="malformed request")
+        if isinstance(payload, bytes):
+            content_type = "audio/wav"
+        else:
+            content_type = "application/json"
+            payload = json.dumps(payload).encode()
+        writer.write(
+            (
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + payload
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self._stopped = asyncio.Event()
+        self._server = await asyncio.start_server(self.handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def wait_stopped(self):
+        """Serve until drained, then close the listening socket, the batcher and the
+        worker processes."""
+        await self._stopped.wait()
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.close()
+        if self.pool:
+            self.pool.close()
+
+
+async def _serve(server, host, port, preload):
+    loop = asyncio.get_running_loop()
+    for voice in preload:
+        await loop.run_in_executor(server.batcher.executor, server.load, voice)
+    port = await server.start(host, port)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: loop.create_task(server.drain()))
+    print(f"Serving {sorted(server.voices)} on http://{host}:{port}", flush=True)
+    await server.wait_stopped()
+
+
+def run(
+    voices,
+    host="127.0.0.1",
+    port=8000,
+    device="cpu",
+    max_batch_size=8,
+    max_wait=0.01,
+    preload=False,
+    workers=0,
+    num_threads=None,
+    dispatch="least-loaded",
+    max_body_bytes=1 << 20,
+):
+    server = TTSServer(
+        voices,
+        device=device,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait,
+        workers=workers,
+        num_threads=num_threads,
+        dispatch=dispatch,
+        max_body_bytes=max_body_bytes,
+    )
+    asyncio.run(_serve(server, host, port, sorted(voices) if preload else []))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--voices",
+        help="Path to a JSON file mapping voice names to checkpoint, hparams, hifigan_config and hifigan_checkpoint",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=10.0,
+        help="How long the oldest queued request waits for a batch to fill",
+    )
+    parser.add_argument(
+        "--preload", action="store_true", help="Load every voice before serving"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes sharing the model weights. 0 runs batches in this process.",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Intra-op threads per worker. Defaults to the cores divided among the workers.",
+    )
+    parser.add_argument(
+        "--dispatch", default="least-loaded", choices=["least-loaded", "round-robin"]
+    )
+    parser.add_argument(
+        "--max-body-bytes",
+        type=int,
+        default=1 << 20,
+        help="Largest request body accepted, larger ones get 413",
+    )
+    return parser.parse_args(args)
+
+
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    run(
+        load_voices(args.voices),
+        host=args.host,
+        port=args.port,
+        device=args.device,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        preload=args.preload,
+        workers=args.workers,
+        num_threads=args.threads_per_worker,
+        dispatch=args.dispatch,
+        max_body_bytes=args.max_body_bytes,
+    )
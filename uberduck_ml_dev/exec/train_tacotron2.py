@@ -40,7 +40,7 @@ if __name__ == "__main__" and not IN_NOTEBOOK:
     config.update(vars(args))
     hparams = HParams(**config)
     if hparams.distributed_run:
-        device_count = torch.cuda.device_count()
+        device_count = hparams.distributed_world_size or torch.cuda.device_count()
         mp.spawn(run, (device_count, hparams), device_count)
     else:
         run(None, None, hparams)
@@ -1,5 +1,6 @@
 __all__ = [
     "Conv1d",
+    "fold_batch_norm",
     "LinearNorm",
     "LocationLayer",
     "Attention",
@@ -22,6 +23,9 @@ __all__ = [
     "LRELU_SLOPE",
 ]
 
+import functools
+from typing import Optional, Tuple
+
 import numpy as np
 from numpy import finfo
 
@@ -32,6 +36,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch.nn.utils import remove_weight_norm, weight_norm
 from torch.nn import init
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from librosa.filters import mel as librosa_mel
 from librosa.util import pad_center, tiny
 
@@ -71,6 +76,18 @@ class Conv1d(nn.Module):
         return self.conv(signal)
 
 
+def fold_batch_norm(convolutions: nn.ModuleList):
+    """Fold each (Conv1d, BatchNorm1d) pair into a single convolution, in place.
+
+    Uses the BatchNorm running statistics, so the result only matches the
+    original module in eval mode.
+    """
+    for i, layer in enumerate(convolutions):
+        conv, batch_norm = layer
+        conv.conv = fuse_conv_bn_eval(conv.conv.eval(), batch_norm.eval())
+        convolutions[i] = nn.Sequential(conv, nn.Identity())
+
+
 class LinearNorm(torch.nn.Module):
     def __init__(self, in_dim, out_dim, bias=True, w_init_gain="linear"):
         super().__init__()
@@ -109,6 +126,42 @@ class LocationLayer(nn.Module):
 
 
 # NOTE (Sam): STFTs should get their own file in common folder
+@functools.lru_cache(maxsize=None)
+def _stft_bases(filter_length, hop_length, win_length, window):
+    """Windowed forward and inverse Fourier bases and the window of an STFT, on CPU,
+    computed once per configuration and process."""
+    scale = filter_length / hop_length
+    fourier_basis = np.fft.fft(np.eye(filter_length))
+
+    cutoff = int((filter_length / 2 + 1))
+    fourier_basis = np.vstack(
+        [np.real(fourier_basis[:cutoff, :]), np.imag(fourier_basis[:cutoff, :])]
+    )
+    # NOTE: the pseudo-inverse of scale * fourier_basis in closed form: the inverse
+    # real DFT, where the bins between DC and Nyquist count twice. np.linalg.pinv
+    # gives the same basis but takes about a second for filter_length 1024.
+    weights = np.full(cutoff, 2.0 / filter_length)
+    weights[0] = 1.0 / filter_length
+    if filter_length % 2 == 0:
+        weights[-1] = 1.0 / filter_length
+    inverse_basis = fourier_basis * np.concatenate([weights, weights])[:, None] / scale
+    forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
+    inverse_basis = torch.FloatTensor(inverse_basis[:, None, :].astype(np.float32))
+
+    fft_window = None
+    if window is not None:
+        assert filter_length >= win_length
+        # get window and zero center pad it to filter_length
+        fft_window = get_window(window, win_length, fftbins=True)
+        fft_window = pad_center(fft_window, filter_length)
+        fft_window = torch.from_numpy(fft_window).float()
+
+        # window the bases
+        forward_basis *= fft_window
+        inverse_basis *= fft_window
+    return forward_basis, inverse_basis, fft_window
+
+
 class STFT:
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
 
@@ -127,48 +180,21 @@ class STFT:
         self.win_length = win_length
         self.window = window
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
-
         self.padding = padding or (filter_length // 2)
 
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack(
-            [np.real(fourier_basis[:cutoff, :]), np.imag(fourier_basis[:cutoff, :])]
+        forward_basis, inverse_basis, fft_window = _stft_bases(
+            filter_length, hop_length, win_length, window
         )
-
         if device == "cuda":
-            dev = torch.device(f"cuda:{rank}")
-            forward_basis = torch.cuda.FloatTensor(
-                fourier_basis[:, None, :], device=dev
-            )
-            inverse_basis = torch.cuda.FloatTensor(
-                np.linalg.pinv(scale * fourier_basis).T[:, None, :].astype(np.float32),
-                device=dev,
-            )
-        else:
-            forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-            inverse_basis = torch.FloatTensor(
-                np.linalg.pinv(scale * fourier_basis).T[:, None, :].astype(np.float32)
-            )
-
-        if window is not None:
-            assert filter_length >= win_length
-            # get window and zero center pad it to filter_length
-            fft_window = get_window(window, win_length, fftbins=True)
-            fft_window = pad_center(fft_window, filter_length)
-            fft_window = torch.from_numpy(fft_window).float()
-
-            if device == "cuda":
-                fft_window = fft_window.cuda(rank)
-
-            # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
+            forward_basis = forward_basis.cuda(rank)
+            inverse_basis = inverse_basis.cuda(rank)
+            fft_window = None if fft_window is None else fft_window.cuda(rank)
+        if fft_window is not None:
             self.fft_window = fft_window
+            self.window_square = (fft_window**2)[None, None]
 
-        self.forward_basis = forward_basis.float()
-        self.inverse_basis = inverse_basis.float()
+        self.forward_basis = forward_basis
+        self.inverse_basis = inverse_basis
 
     def transform(self, input_data):
         num_batches = input_data.size(0)
@@ -220,25 +246,20 @@ class STFT:
         )
 
         if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window,
-                magnitude.size(-1),
-                hop_length=self.hop_length,
-                win_length=self.win_length,
-                n_fft=self.filter_length,
-                dtype=np.float32,
-            )
+            # NOTE: the sum-square envelope of the window (window_sumsquare), computed
+            # by overlap-adding the squared window on the device of magnitude.
+            window_sum = F.conv_transpose1d(
+                magnitude.new_ones(1, 1, magnitude.size(-1)),
+                self.window_square.to(magnitude.device),
+                stride=self.hop_length,
+            )[0, 0]
             # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0]
+            window_sum = torch.where(
+                window_sum > tiny(np.float32(0)),
+                window_sum,
+                torch.ones_like(window_sum),
             )
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False
-            )
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
-            inverse_transform[:, :, approx_nonzero_indices] /= window_sum[
-                approx_nonzero_indices
-            ]
+            inverse_transform = inverse_transform / window_sum
 
             # scale by hop ratio
             inverse_transform *= float(self.filter_length) / self.hop_length
@@ -422,10 +443,14 @@ class MultiHeadAttention(nn.Module):
             in_features=key_dim, out_features=num_units, bias=False
         )
 
-    def forward(self, query, key):
+    def forward(self, query, key, key_values: Optional[Tuple] = None):
         querys = self.W_query(query)  # [N, T_q, num_units]
-        keys = self.W_key(key)  # [N, T_k, num_units]
-        values = self.W_value(key)
+        if key_values is None:
+            keys = self.W_key(key)  # [N, T_k, num_units]
+            values = self.W_value(key)
+        else:
+            # NOTE: precomputed projections of a key shared by the batch, [1, T_k, num_units].
+            keys, values = key_values
 
         split_size = self.num_units // self.num_heads
         querys = torch.stack(
@@ -472,10 +497,24 @@ class STL(nn.Module):
         )
 
         init.normal_(self.embed, mean=0, std=0.5)
+        # NOTE: non-persistent so checkpoints are unaffected, but still moved by .to().
+        self.register_buffer("cached_keys", None, persistent=False)
+        self.register_buffer("cached_values", None, persistent=False)
+
+    def cache_key_values(self):
+        """Precompute the token key and value projections for inference."""
+        with torch.no_grad():
+            tokens = torch.tanh(self.embed).unsqueeze(0)
+            self.cached_keys = self.attention.W_key(tokens)
+            self.cached_values = self.attention.W_value(tokens)
 
     def forward(self, inputs):
         N = inputs.size(0)
         query = inputs.unsqueeze(1)
+        if self.cached_keys is not None:
+            return self.attention(
+                query, None, key_values=(self.cached_keys, self.cached_values)
+            )
         keys = (
             torch.tanh(self.embed).unsqueeze(0).expand(N, -1, -1)
         )  # [N, token_num, token_embedding_size // num_heads]
@@ -16,8 +16,12 @@ class Attention(nn.Module):
         attention_location_n_filters,
         attention_location_kernel_size,
         fp16_run,
+        window_size: Optional[int] = None,
     ):
         super(Attention, self).__init__()
+        # NOTE: when set, energies are only computed within window_size encoder positions
+        # of the previous attention peak. Can be changed on a trained model.
+        self.window_size = window_size
         self.query_layer = LinearNorm(
             attention_rnn_dim, attention_dim, bias=False, w_init_gain="tanh"
         )
@@ -55,6 +59,61 @@ class Attention(nn.Module):
         energies = energies.squeeze(-1)
         return energies
 
+    def get_windowed_alignment_energies(
+        self, query, processed_memory, attention_weights_cat, positions
+    ):
+        """Alignment energies at a window of encoder positions
+        PARAMS
+        ------
+        query: decoder output (batch, n_mel_channels * n_frames_per_step)
+        processed_memory: processed encoder outputs (B, T_in, attention_dim)
+        attention_weights_cat: cumulative and prev. att weights (B, 2, max_time)
+        positions: contiguous encoder positions (B, window)
+
+        RETURNS
+        -------
+        alignment (batch, window), equal to get_alignment_energies at positions
+        """
+        conv = self.location_layer.location_conv.conv
+        padding = conv.padding[0]
+        # NOTE: the location conv only needs its receptive field around the window.
+        location_positions = positions[:, :1] + torch.arange(
+            positions.size(1) + 2 * padding, device=positions.device
+        )
+        location_input = torch.gather(
+            F.pad(attention_weights_cat, (padding, padding)),
+            2,
+            location_positions[:, None].expand(-1, attention_weights_cat.size(1), -1),
+        )
+        processed_attention = F.conv1d(location_input, conv.weight, conv.bias)
+        processed_attention = self.location_layer.location_dense(
+            processed_attention.transpose(1, 2)
+        )
+        processed_memory = torch.gather(
+            processed_memory,
+            1,
+            positions[..., None].expand(-1, -1, processed_memory.size(2)),
+        )
+        processed_query = self.query_layer(query.unsqueeze(1))
+        energies = self.v(
+            torch.tanh(processed_query + processed_attention + processed_memory)
+        )
+
+        energies = energies.squeeze(-1)
+        return energies
+
+    def window_positions(self, attention_weights_cat):
+        """Encoder positions within window_size of the previous attention peak,
+        shifted to stay inside the encoder outputs. (B, 2 * window_size + 1)"""
+        window = 2 * self.window_size + 1
+        focus = attention_weights_cat[:, 0].argmax(dim=1)
+        window_start = (focus - self.window_size).clamp(
+            min=0, max=attention_weights_cat.size(2) - window
+        )
+        return window_start[:, None] + torch.arange(
+            window, device=attention_weights_cat.device
+        )
+
     def forward(
         self,
         attention_hidden_state,
@@ -73,15 +132,44 @@ class Attention(nn.Module):
         attention_weights_cat: previous and cummulative attention weights
         mask: binary mask for padded data
         """
+        if (
+            attention_weights is None
+            and self.window_size is not None
+            and memory.size(1) > 2 * self.window_size + 1
+        ):
+            positions = self.window_positions(attention_weights_cat)
+            alignment = self.get_windowed_alignment_energies(
+                attention_hidden_state,
+                processed_memory,
+                attention_weights_cat,
+                positions,
+            )
+            if mask is not None:
+                alignment = alignment.masked_fill(
+                    torch.gather(mask, 1, positions), self.score_mask_value
+                )
+            window_weights = F.softmax(alignment.float(), dim=1)
+            # NOTE: weights outside the window are zero, so attention_weights_cum stays a running sum of full-length weights.
+            attention_weights = window_weights.new_zeros(
+                memory.size(0), memory.size(1)
+            ).scatter_(1, positions, window_weights)
+            memory = torch.gather(
+                memory, 1, positions[..., None].expand(-1, -1, memory.size(2))
+            )
+            attention_context = torch.bmm(window_weights.unsqueeze(1), memory)
+            attention_context = attention_context.squeeze(1)
+            return attention_context, attention_weights
+
         if attention_weights is None:
             alignment = self.get_alignment_energies(
                 attention_hidden_state, processed_memory, attention_weights_cat
             )
 
             if mask is not None:
-                alignment.data.masked_fill_(mask, self.score_mask_value)
+                alignment = alignment.masked_fill(mask, self.score_mask_value)
 
-            attention_weights = F.softmax(alignment, dim=1)
+            # NOTE: softmax over the encoder axis is kept in fp32 under autocast.
+            attention_weights = F.softmax(alignment.float(), dim=1)
         attention_context = torch.bmm(attention_weights.unsqueeze(1), memory)
         attention_context = attention_context.squeeze(1)
 
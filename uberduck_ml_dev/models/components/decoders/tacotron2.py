@@ -1,8 +1,8 @@
 from torch import nn
 import torch
 from torch.nn import functional as F
-from typing import Optional, List
-from torch.cuda.amp import autocast
+from torch.utils.checkpoint import checkpoint
+from typing import Optional, List, Tuple
 import numpy as np
 
 from ...common import LinearNorm
@@ -11,6 +11,121 @@ from ..prenet import Prenet
 from ....utils.utils import get_mask_from_lengths
 from einops import rearrange
 
+# NOTE: per-sequence status returned by Decoder.inference.
+DECODER_FINISHED = 0  # the gate fired
+DECODER_MAX_STEPS = 1  # ran out of decoder steps
+DECODER_STALLED = 2  # attention focus stopped advancing
+DECODER_OVERRAN = 3  # attention stayed at the end without the gate firing
+
+# NOTE: what Decoder.inference keeps of the attention weights.
+# full: (B, T_out, T_in) weights.
+# max: dict(values=(B, T_out), indices=(B, T_out)), the per-step attention peak.
+# topk: dict(values=(B, T_out, k), indices=(B, T_out, k)) with k = inference_alignments_topk.
+# none: None.
+# Bytes kept at T_out=800 steps, T_in=200: full 640 kB per item (2.5x the 80-channel mel),
+# max 9.6 kB, topk with k=4 38.4 kB. At batch size 1 / 16 / 64 that is
+# full 0.64 / 10.2 / 41 MB, max 0.01 / 0.15 / 0.61 MB, topk 0.04 / 0.61 / 2.5 MB.
+INFERENCE_ALIGNMENTS = ["full", "max", "topk", "none"]
+
+
+def decoder_step_budget(
+    input_lengths,
+    max_decoder_steps: int,
+    max_decoder_frames_per_token: Optional[float],
+    n_frames_per_step: int,
+):
+    """Maximum number of decoder steps for each sequence, from its input length."""
+    budget = torch.full_like(input_lengths, max_decoder_steps)
+    if max_decoder_frames_per_token is not None:
+        budget = torch.minimum(
+            budget,
+            torch.ceil(
+                input_lengths.float() * max_decoder_frames_per_token / n_frames_per_step
+            ).long(),
+        )
+    return budget
+
+
+def update_stop_state(
+    gate_output,
+    attention_weights,
+    input_lengths,
+    budget,
+    steps: int,
+    not_finished,
+    mel_lengths,
+    decoder_status,
+    furthest_focus,
+    steps_since_advance,
+    steps_at_end,
+    gate_threshold: float,
+    max_attention_stall_frames: Optional[int],
+    max_frames_after_attention_end: Optional[int],
+) -> Tuple[
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+]:
+    """Decide which sequences stop after decoder step steps.
+
+    Shared by Decoder.inference, Tacotron2Inference and OnnxTacotron2, so it is
+    written for TorchScript with the decoding state passed in and returned.
+
+    gate_output: (B, r) gate energies of the r frames of the step
+    attention_weights: (B, T_in) attention weights of the step
+    budget: (B,) step budgets from decoder_step_budget
+    not_finished: (B,) bool, sequences still decoding before the step
+    mel_lengths, decoder_status: (B,) int32, as returned by Decoder.inference
+    furthest_focus, steps_since_advance, steps_at_end: (B,) long, the furthest
+    attention focus (argmax over encoder positions), the steps since it last
+    advanced and the steps since it reached the last encoder position; -1, 0 and 0
+    before the first step
+
+    returns: (not_finished, mel_lengths, decoder_status, furthest_focus,
+    steps_since_advance, steps_at_end) after the step
+    """
+    r = gate_output.size(1)
+    # NOTE: the gate is checked once per step. A sequence stops at the first frame
+    # of the chunk whose gate fires and the frames before it count towards its length.
+    stop = torch.sigmoid(gate_output) > gate_threshold
+    stopped = stop.any(dim=1)
+    frames = stop.to(torch.int32).argmax(dim=1).masked_fill(~stopped, r)
+    mel_lengths = mel_lengths + not_finished.to(torch.int32) * frames.to(torch.int32)
+
+    focus = attention_weights.argmax(dim=1)
+    advanced = (focus > furthest_focus) & not_finished
+    furthest_focus = torch.where(advanced, focus, furthest_focus)
+    steps_since_advance = (steps_since_advance + not_finished.long()).masked_fill(
+        advanced, 0
+    )
+    steps_at_end = (
+        steps_at_end + ((furthest_focus >= input_lengths - 1) & not_finished).long()
+    )
+    not_finished = not_finished & ~stopped
+
+    # NOTE: TorchScript cannot read module level globals, the status values are
+    # DECODER_FINISHED, DECODER_MAX_STEPS, DECODER_STALLED and DECODER_OVERRAN.
+    status = torch.zeros_like(decoder_status)
+    status.masked_fill_(budget <= steps, 1)
+    if max_attention_stall_frames is not None:
+        status.masked_fill_(steps_since_advance * r >= max_attention_stall_frames, 2)
+    if max_frames_after_attention_end is not None:
+        status.masked_fill_(steps_at_end * r > max_frames_after_attention_end, 3)
+    runaway = (status != 0) & not_finished
+    decoder_status = torch.where(runaway, status, decoder_status)
+    not_finished = not_finished & ~runaway
+    return (
+        not_finished,
+        mel_lengths,
+        decoder_status,
+        furthest_focus,
+        steps_since_advance,
+        steps_at_end,
+    )
+
 
 class Decoder(nn.Module):
     def __init__(self, hparams):
@@ -23,11 +138,22 @@ class Decoder(nn.Module):
         self.decoder_rnn_dim = hparams.decoder_rnn_dim
         self.prenet_dim = hparams.prenet_dim
         self.max_decoder_steps = hparams.max_decoder_steps
+        self.max_decoder_frames_per_token = hparams.max_decoder_frames_per_token
+        self.max_attention_stall_frames = hparams.max_attention_stall_frames
+        self.max_frames_after_attention_end = hparams.max_frames_after_attention_end
+        self.inference_alignments = hparams.inference_alignments
+        self.inference_alignments_topk = hparams.inference_alignments_topk
+        if self.inference_alignments not in INFERENCE_ALIGNMENTS:
+            raise Exception(
+                f"inference_alignments must be one of {INFERENCE_ALIGNMENTS}, got {self.inference_alignments}"
+            )
         self.gate_threshold = hparams.gate_threshold
+        self.per_frame_gate = hparams.per_frame_gate
         self.p_attention_dropout = hparams.p_attention_dropout
         self.p_decoder_dropout = hparams.p_decoder_dropout
         self.p_teacher_forcing = hparams.p_teacher_forcing
         self.cudnn_enabled = hparams.cudnn_enabled
+        self.checkpoint_steps = hparams.decoder_checkpoint_steps
         self.attention_hidden = torch.tensor([])
         self.attention_cell = torch.tensor([])
         self.decoder_hidden = torch.tensor([])
@@ -56,6 +182,7 @@ class Decoder(nn.Module):
             hparams.attention_location_n_filters,
             hparams.attention_location_kernel_size,
             fp16_run=hparams.fp16_run,
+            window_size=hparams.attention_window_size,
         )
 
         self.decoder_rnn = nn.LSTMCell(
@@ -71,7 +198,7 @@ class Decoder(nn.Module):
 
         self.gate_layer = LinearNorm(
             hparams.decoder_rnn_dim + self.encoder_embedding_dim,
-            1,
+            hparams.n_frames_per_step_initial if self.per_frame_gate else 1,
             bias=True,
             w_init_gain="sigmoid",
         )
@@ -105,13 +232,24 @@ class Decoder(nn.Module):
         B = memory.size(0)
         MAX_TIME = memory.size(1)
 
-        self.attention_hidden = memory.data.new_zeros(B, self.attention_rnn_dim)
-        self.attention_cell = memory.data.new_zeros(B, self.attention_rnn_dim)
+        # NOTE: recurrent and attention states are kept in fp32 even when memory comes out of an autocast region.
+        self.attention_hidden = memory.data.new_zeros(
+            B, self.attention_rnn_dim, dtype=torch.float
+        )
+        self.attention_cell = memory.data.new_zeros(
+            B, self.attention_rnn_dim, dtype=torch.float
+        )
 
-        self.decoder_hidden = memory.data.new_zeros(B, self.decoder_rnn_dim)
-        self.decoder_cell = memory.data.new_zeros(B, self.decoder_rnn_dim)
-        self.attention_weights = memory.data.new_zeros(B, MAX_TIME)
-        self.attention_weights_cum = memory.data.new_zeros(B, MAX_TIME)
+        self.decoder_hidden = memory.data.new_zeros(
+            B, self.decoder_rnn_dim, dtype=torch.float
+        )
+        self.decoder_cell = memory.data.new_zeros(
+            B, self.decoder_rnn_dim, dtype=torch.float
+        )
+        self.attention_weights = memory.data.new_zeros(B, MAX_TIME, dtype=torch.float)
+        self.attention_weights_cum = memory.data.new_zeros(
+            B, MAX_TIME, dtype=torch.float
+        )
         self.attention_context = memory.data.new_zeros(B, self.encoder_embedding_dim)
 
         self.memory = memory
@@ -162,10 +300,9 @@ class Decoder(nn.Module):
         gate_outpust: gate output energies
         alignments:
         """
+        alignments = self.stack_alignments(alignments)
         # (T_out, B) -> (B, T_out)
-        alignments = torch.stack(alignments).transpose(0, 1)
-        # (T_out, B) -> (B, T_out)
-        gate_outputs = torch.stack(gate_outputs)
+        gate_outputs = torch.stack(gate_outputs).float()
         if len(gate_outputs.size()) > 1:
             gate_outputs = gate_outputs.transpose(0, 1)
         else:
@@ -178,6 +315,90 @@ class Decoder(nn.Module):
 
         return mel_outputs, gate_outputs, alignments
 
+    def compact_alignment(self, alignment):
+        """Reduce one step of attention weights (B, T_in) to what inference_alignments keeps."""
+        if self.inference_alignments == "none":
+            return None
+        if self.inference_alignments == "max":
+            return torch.max(alignment, 1)
+        if self.inference_alignments == "topk":
+            return torch.topk(
+                alignment, min(self.inference_alignments_topk, alignment.size(1)), 1
+            )
+        return alignment
+
+    def stack_alignments(self, alignments: list):
+        """Stack per-step alignments from decode or compact_alignment along the decoder time axis."""
+        if alignments[0] is None:
+            return None
+        if isinstance(alignments[0], torch.Tensor):
+            # (T_out, B, T_in) -> (B, T_out, T_in)
+            return torch.stack(alignments).transpose(0, 1)
+        return dict(
+            values=torch.stack([a.values for a in alignments]).transpose(0, 1),
+            indices=torch.stack([a.indices for a in alignments]).transpose(0, 1),
+        )
+
+    def frame_gates(self, gate_output):
+        """Gate energies for each of the n_frames_per_step_current frames of a step.
+
+        gate_output: (B, 1), or (B, n_frames_per_step_initial) with per_frame_gate
+        returns: (B, n_frames_per_step_current)
+        """
+        r = self.n_frames_per_step_current
+        if self.per_frame_gate:
+            return gate_output[:, :r]
+        return gate_output.expand(-1, r)
+
+    def step_budget(self, memory_lengths):
+        """Maximum number of decoder steps for each sequence, from its input length."""
+        return decoder_step_budget(
+            memory_lengths,
+            self.max_decoder_steps,
+            self.max_decoder_frames_per_token,
+            self.n_frames_per_step_current,
+        )
+
+    def stop_state(self, memory_lengths):
+        """Initial not_finished, mel_lengths, decoder_status, furthest_focus,
+        steps_since_advance and steps_at_end for update_stop_state."""
+        B = memory_lengths.size(0)
+        device = memory_lengths.device
+        return (
+            torch.ones([B], dtype=torch.bool, device=device),
+            torch.zeros([B], dtype=torch.int32, device=device),
+            torch.full([B], DECODER_FINISHED, dtype=torch.int32, device=device),
+            torch.full([B], -1, dtype=torch.long, device=device),
+            torch.zeros([B], dtype=torch.long, device=device),
+            torch.zeros([B], dtype=torch.long, device=device),
+        )
+
+    def advance_stop_state(
+        self, gate_output, alignment, memory_lengths, budget, steps, state
+    ):
+        """update_stop_state with the thresholds of the decoder."""
+        return update_stop_state(
+            gate_output,
+            alignment,
+            memory_lengths,
+            budget,
+            steps,
+            *state,
+            gate_threshold=self.gate_threshold,
+            max_attention_stall_frames=self.max_attention_stall_frames,
+            max_frames_after_attention_end=self.max_frames_after_attention_end,
+        )
+
+    def _rnn_fp32(
+        self, rnn: nn.LSTMCell, x, hidden, cell
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run an LSTMCell in full precision regardless of any enclosing autocast region."""
+        # NOTE(zach): When training with fp16_run == True, decoder_rnn seems to run into
+        # issues with NaNs in gradient, maybe due to vanishing gradients.
+        # NOTE: the recurrent state always stays in fp32 while the projections can run in bf16.
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return rnn(x.float(), (hidden.float(), cell.float()))
+
     def decode(self, decoder_input, attention_weights: Optional[torch.Tensor]):
         """Decoder step using stored states, attention and memory
         PARAMS
@@ -191,8 +412,8 @@ class Decoder(nn.Module):
         attention_weights:
         """
         cell_input = torch.cat((decoder_input, self.attention_context), -1)
-        self.attention_hidden, self.attention_cell = self.attention_rnn(
-            cell_input, (self.attention_hidden, self.attention_cell)
+        self.attention_hidden, self.attention_cell = self._rnn_fp32(
+            self.attention_rnn, cell_input, self.attention_hidden, self.attention_cell
         )
         self.attention_hidden = F.dropout(
             self.attention_hidden, self.p_attention_dropout, self.training
@@ -217,10 +438,11 @@ class Decoder(nn.Module):
             attention_weights,
         )
 
-        self.attention_weights_cum += self.attention_weights
+        # NOTE: out of place so that states saved at a checkpoint boundary are not modified.
+        self.attention_weights_cum = self.attention_weights_cum + self.attention_weights
         decoder_input = torch.cat((self.attention_hidden, self.attention_context), -1)
-        self.decoder_hidden, self.decoder_cell = self.decoder_rnn(
-            decoder_input, (self.decoder_hidden, self.decoder_cell)
+        self.decoder_hidden, self.decoder_cell = self._rnn_fp32(
+            self.decoder_rnn, decoder_input, self.decoder_hidden, self.decoder_cell
         )
         self.decoder_hidden = F.dropout(
             self.decoder_hidden, self.p_decoder_dropout, self.training
@@ -238,6 +460,73 @@ class Decoder(nn.Module):
         gate_prediction = self.gate_layer(decoder_hidden_attention_context)
         return decoder_output, gate_prediction, self.attention_weights
 
+    def _decode_segment(
+        self,
+        decoder_inputs,
+        teacher_forced: List[bool],
+        memory,
+        processed_memory,
+        mask,
+        attention_hidden,
+        attention_cell,
+        decoder_hidden,
+        decoder_cell,
+        attention_weights,
+        attention_weights_cum,
+        attention_context,
+        mel_output,
+    ):
+        """Teacher-forced decoder steps starting from an explicit state.
+
+        All inputs are arguments so the segment can be recomputed during
+        backward when activation checkpointing is enabled.
+
+        RETURNS
+        -------
+        mel_outputs: (T_segment, B, n_mel_channels * n_frames_per_step)
+        gate_outputs: (T_segment, B, n_frames_per_step)
+        alignments: (T_segment, B, T_in)
+        followed by the decoder state after the last step
+        """
+        self.memory = memory
+        self.processed_memory = processed_memory
+        self.mask = mask
+        self.attention_hidden = attention_hidden
+        self.attention_cell = attention_cell
+        self.decoder_hidden = decoder_hidden
+        self.decoder_cell = decoder_cell
+        self.attention_weights = attention_weights
+        self.attention_weights_cum = attention_weights_cum
+        self.attention_context = attention_context
+
+        mel_outputs, gate_outputs, alignments = [], [], []
+        for decoder_input, is_teacher_forced in zip(decoder_inputs, teacher_forced):
+            if not is_teacher_forced:
+                decoder_input = self.prenet(mel_output[:, -self.n_mel_channels :])
+            mel_output, gate_output, attention_weights = self.decode(
+                decoder_input, None
+            )
+            mel_output = mel_output[
+                :, 0 : self.n_mel_channels * self.n_frames_per_step_current
+            ]
+            mel_outputs += [mel_output]
+            gate_outputs += [self.frame_gates(gate_output)]
+            alignments += [attention_weights]
+
+        return (
+            torch.stack(mel_outputs),
+            torch.stack(gate_outputs),
+            torch.stack(alignments),
+            self.attention_hidden,
+            self.attention_cell,
+            self.decoder_hidden,
+            self.decoder_cell,
+            self.attention_weights,
+            self.attention_weights_cum,
+            self.attention_context,
+            mel_output,
+        )
+
     def forward(self, memory, decoder_inputs, memory_lengths):
         """Decoder forward pass for training
         PARAMS
@@ -253,133 +542,132 @@ class Decoder(nn.Module):
         alignments: sequence of attention weights from the decoder
         """
         B = memory.size(0)
-        decoder_inputs = rearrange(
-            decoder_inputs, "b m t -> t b m"
-        )  # n_frames_per_step not used anymore
+        r = self.n_frames_per_step_current
+        # NOTE: targets are padded to a multiple of r by TextMelCollate.
+        n_steps = decoder_inputs.size(2) // r
+        decoder_inputs = rearrange(decoder_inputs, "b m t -> t b m")
         decoder_input = self.get_go_frame(memory).unsqueeze(0)
-        decoder_inputs = torch.cat((decoder_input, decoder_inputs), dim=0)
+        # NOTE: each step emits r frames and is fed the last frame of the previous chunk,
+        # so only those frames go through the prenet.
+        decoder_inputs = torch.cat((decoder_input, decoder_inputs[r - 1 :: r]), dim=0)[
+            :n_steps
+        ]
         decoder_inputs = self.prenet(decoder_inputs)
 
         self.initialize_decoder_states(
             memory, mask=~get_mask_from_lengths(memory_lengths)
         )
 
-        mel_outputs = torch.empty(
-            B, 0, self.n_frames_per_step_current * self.n_mel_channels
+        # NOTE: drawn up front so that a recomputed segment makes the same choices.
+        teacher_forced = [
+            step == 0 or np.random.uniform(0.0, 1.0) <= self.p_teacher_forcing
+            for step in range(n_steps)
+        ]
+        state = (
+            self.attention_hidden,
+            self.attention_cell,
+            self.decoder_hidden,
+            self.decoder_cell,
+            self.attention_weights,
+            self.attention_weights_cum,
+            self.attention_context,
+            memory.data.new_zeros(B, self.n_mel_channels * r),
         )
-        if self.cudnn_enabled:
-            mel_outputs = mel_outputs.cuda()
-        gate_outputs, alignments = [], []
-        desired_output_frames = decoder_inputs.size(0) / self.n_frames_per_step_current
-        while mel_outputs.size(1) < desired_output_frames - 1:
-            if (
-                mel_outputs.size(1) == 0
-                or np.random.uniform(0.0, 1.0) <= self.p_teacher_forcing
-            ):
-                teacher_forced_frame = decoder_inputs[
-                    mel_outputs.size(1) * self.n_frames_per_step_current
-                ]
-
-                decoder_input = teacher_forced_frame
-            else:
+        memory_args = (self.memory, self.processed_memory, self.mask)
+        use_checkpoint = (
+            self.checkpoint_steps > 0 and self.training and torch.is_grad_enabled()
+        )
+        segment_steps = self.checkpoint_steps if use_checkpoint else max(n_steps, 1)
 
-                # NOTE(zach): we may need to concat these as we go to ensure that
-                # it's easy to retrieve the last n_frames_per_step_init frames.
-                to_concat = (
-                    self.prenet(
-                        mel_outputs[:, -1, -1 * self.n_frames_per_step_current :]
-                    ),
-                )
-                decoder_input = torch.cat(to_concat, dim=1)
-            # NOTE(zach): When training with fp16_run == True, decoder_rnn seems to run into
-            # issues with NaNs in gradient, maybe due to vanishing gradients.
-            # Disable half-precision for this call to work around the issue.
-            with autocast(enabled=False):
-                mel_output, gate_output, attention_weights = self.decode(
-                    decoder_input, None
-                )
-            mel_outputs = torch.cat(
-                [
-                    mel_outputs,
-                    mel_output[
-                        :, 0 : self.n_mel_channels * self.n_frames_per_step_current
-                    ].unsqueeze(1),
-                ],
-                dim=1,
+        mel_outputs, gate_outputs, alignments = [], [], []
+        for start in range(0, n_steps, segment_steps):
+            end = min(start + segment_steps, n_steps)
+            args = (
+                decoder_inputs[start:end],
+                teacher_forced[start:end],
+                *memory_args,
+                *state,
             )
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
-            alignments += [attention_weights]
-
+            if use_checkpoint:
+                outputs = checkpoint(self._decode_segment, *args, use_reentrant=False)
+            else:
+                outputs = self._decode_segment(*args)
+            mel_outputs.append(outputs[0])
+            gate_outputs.append(outputs[1])
+            alignments.append(outputs[2])
+            state = outputs[3:]
+
+        # (T_out, B, n_mel_channels * r) -> (B, T_out, n_mel_channels * r)
+        mel_outputs = torch.cat(mel_outputs).transpose(0, 1).contiguous()
+        # (T_out / r, B, r) -> (T_out, B)
+        gate_outputs = list(rearrange(torch.cat(gate_outputs), "t b r -> (t r) b"))
+        alignments = list(torch.cat(alignments))
         mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
             mel_outputs, gate_outputs, alignments
         )
 
         return mel_outputs, gate_outputs, alignments
 
-    def inference(self, memory, memory_lengths):
+    def inference(self, memory, memory_lengths, prenet_generators=None):
         """Decoder inference
         PARAMS
         ------
         memory: Encoder outputs
+        prenet_generators: optional random generators for the prenet dropout, one per sequence (see Prenet)
 
         RETURNS
         -------
         mel_outputs: mel outputs from the decoder
         gate_outputs: gate outputs from the decoder
         alignments: sequence of attention weights from the decoder
+        mel_lengths: output length in frames
+        decoder_status: DECODER_FINISHED if the gate fired, otherwise why decoding was cut short
         """
         decoder_input = self.get_go_frame(memory)
         self.initialize_decoder_states(
             memory, mask=~get_mask_from_lengths(memory_lengths)
         )
 
-        B = memory.size(0)
-        mel_outputs = torch.empty(
-            B, 0, self.n_frames_per_step_current * self.n_mel_channels
-        )
-        if self.cudnn_enabled:
-            mel_outputs = mel_outputs.cuda()
-        gate_outputs, alignments = [], []
-
-        mel_lengths = torch.zeros(
-            [memory.size(0)], dtype=torch.int32, device=memory.device
-        )
-        not_finished = torch.ones(
-            [memory.size(0)], dtype=torch.int32, device=memory.device
-        )
+        r = self.n_frames_per_step_current
+        mel_outputs, gate_outputs, alignments = [], [], []
+        # NOTE: a sequence whose attention fails would otherwise run for max_decoder_steps.
+        budget = self.step_budget(memory_lengths)
+        state = self.stop_state(memory_lengths)
 
         while True:
-            decoder_input = self.prenet(decoder_input)
+            decoder_input = self.prenet(decoder_input, prenet_generators)
             mel_output, gate_output, alignment = self.decode(decoder_input, None)
-            mel_output = mel_output[
-                :, 0 : self.n_mel_channels * self.n_frames_per_step_current
-            ].unsqueeze(1)
+            mel_output = mel_output[:, 0 : self.n_mel_channels * r]
+            gate_output = self.frame_gates(gate_output)
 
-            mel_outputs = torch.cat([mel_outputs, mel_output], dim=1)
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
-            alignments += [alignment]
+            mel_outputs += [mel_output]
+            gate_outputs += list(gate_output.transpose(0, 1))
+            alignments += [self.compact_alignment(alignment)]
 
-            dec = (
-                torch.le(torch.sigmoid(gate_output), self.gate_threshold)
-                .to(torch.int32)
-                .squeeze(1)
+            previous_status = state[2]
+            state = self.advance_stop_state(
+                gate_output, alignment, memory_lengths, budget, len(mel_outputs), state
             )
+            runaway = state[2] != previous_status
+            if runaway.any():
+                print(
+                    f"Warning! Stopped decoding {runaway.sum().item()} sequences with status {state[2][runaway].tolist()}"
+                )
 
-            not_finished = not_finished * dec
-            mel_lengths += not_finished
-
-            if torch.sum(not_finished) == 0:
-                break
-            if mel_outputs.shape[1] == self.max_decoder_steps:
-                print("Warning! Reached max decoder steps")
+            if not state[0].any():
                 break
 
-            decoder_input = mel_output[:, -1, -1 * self.n_mel_channels :]
+            # NOTE: the last frame of the chunk is fed back.
+            decoder_input = mel_output[:, -1 * self.n_mel_channels :]
+
+        # (T_out / r, B, n_mel_channels * r) -> (B, T_out / r, n_mel_channels * r)
+        mel_outputs = torch.stack(mel_outputs).transpose(0, 1).contiguous()
         mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
             mel_outputs, gate_outputs, alignments
         )
 
-        return mel_outputs, gate_outputs, alignments, mel_lengths
+        _, mel_lengths, decoder_status = state[:3]
+        return mel_outputs, gate_outputs, alignments, mel_lengths, decoder_status
 
     def inference_noattention(self, memory, attention_map):
         """Decoder inference
@@ -414,7 +702,7 @@ class Decoder(nn.Module):
             ].unsqueeze(1)
 
             mel_outputs = torch.cat([mel_outputs, mel_output], dim=1)
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
+            gate_outputs += list(self.frame_gates(gate_output).transpose(0, 1))
             alignments += [alignment]
 
             decoder_input = mel_output[:, -1, -1 * self.n_mel_channels :]
@@ -494,6 +782,11 @@ class Decoder(nn.Module):
         if device == "cuda" and self.cudnn_enabled:
             mel_outputs = mel_outputs.cuda()
         gate_outputs, alignments = [], []
+        memory_lengths = torch.full(
+            [B], memory.size(1), dtype=torch.long, device=memory.device
+        )
+        budget = self.step_budget(memory_lengths)
+        state = self.stop_state(memory_lengths)
 
         while True:
             if mel_outputs.size(1) < tf_until_idx:
@@ -519,12 +812,20 @@ class Decoder(nn.Module):
                 ],
                 dim=1,
             )
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
+            gate_output = self.frame_gates(gate_output)
+            gate_outputs += list(gate_output.transpose(0, 1))
             alignments += [attention_weights]
-            if torch.sigmoid(gate_output.data) > self.gate_threshold:
-                break
-            elif mel_outputs.size(1) == self.max_decoder_steps:
-                print("Warning! Reached max decoder steps")
+            state = self.advance_stop_state(
+                gate_output,
+                attention_weights,
+                memory_lengths,
+                budget,
+                mel_outputs.size(1),
+                state,
+            )
+            if (state[2] != DECODER_FINISHED).any():
+                print(f"Warning! Stopped decoding with status {state[2].tolist()}")
+            if not state[0].all():
                 break
 
         mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
@@ -532,8 +833,3 @@ class Decoder(nn.Module):
         )
 
         return mel_outputs, gate_outputs, alignments
-
-
-class DecoderForwardIsInfer(Decoder):
-    def forward(self, memory, memory_lengths):
-        return self.inference(memory, memory_lengths)
@@ -62,7 +62,9 @@ class Encoder(nn.Module):
             x, input_lengths, batch_first=True, enforce_sorted=False
         )
 
-        self.lstm.flatten_parameters()
+        # NOTE: dynamically quantized LSTMs have no flatten_parameters.
+        if hasattr(self.lstm, "flatten_parameters"):
+            self.lstm.flatten_parameters()
         outputs, _ = self.lstm(x)
 
         outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
@@ -85,9 +87,3 @@ class Encoder(nn.Module):
         outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
 
         return outputs
-
-
-# NOTE (Sam): for torchscipt compilation
-class EncoderForwardIsInfer(Encoder):
-    def forward(self, x, input_lengths):
-        return self.inference(x, input_lengths)
@@ -1,5 +1,6 @@
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import torch
 
 from ..common import Conv1d
@@ -13,6 +14,7 @@ class Postnet(nn.Module):
     def __init__(self, hparams):
         super(Postnet, self).__init__()
         self.dropout_rate = 0.5
+        self.checkpoint = hparams.postnet_checkpoint
         self.convolutions = nn.ModuleList()
 
         self.convolutions.append(
@@ -61,11 +63,39 @@ class Postnet(nn.Module):
             )
         )
 
+    def _layer(self, i: int, x):
+        x = self.convolutions[i](x)
+        if i < len(self.convolutions) - 1:
+            x = torch.tanh(x)
+        return F.dropout(x, self.dropout_rate, self.training)
+
+    def _checkpointed_layer(self, i: int, x):
+        batch_norm = self.convolutions[i][1]
+        momentum = batch_norm.momentum
+        calls = []
+
+        def run(x):
+            # NOTE: the layer runs a second time during backward. That pass must
+            # not update the BatchNorm running statistics again.
+            recompute = len(calls) > 0
+            calls.append(i)
+            if recompute:
+                batch_norm.momentum = 0.0
+            try:
+                return self._layer(i, x)
+            finally:
+                if recompute:
+                    batch_norm.momentum = momentum
+                    batch_norm.num_batches_tracked.sub_(1)
+
+        return checkpoint(run, x, use_reentrant=False)
+
     def forward(self, x):
-        for i, conv in enumerate(self.convolutions):
-            if i == len(self.convolutions) - 1:
-                x = F.dropout(conv(x), self.dropout_rate, self.training)
+        use_checkpoint = self.checkpoint and self.training and torch.is_grad_enabled()
+        for i in range(len(self.convolutions)):
+            if use_checkpoint:
+                x = self._checkpointed_layer(i, x)
             else:
-                x = F.dropout(torch.tanh(conv(x)), self.dropout_rate, self.training)
+                x = self._layer(i, x)
 
         return x
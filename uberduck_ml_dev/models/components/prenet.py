@@ -1,3 +1,6 @@
+from typing import List, Optional
+
+import torch
 from torch import nn
 from torch.nn import functional as F
 from ..common import LinearNorm
@@ -15,7 +18,17 @@ class Prenet(nn.Module):
         )
         self.dropout_rate = 0.5
 
-    def forward(self, x):
+    def forward(self, x, generators: Optional[List[torch.Generator]] = None):
+        """generators: optional random generators, one per row of x. The dropout mask
+        of each row is then drawn from its own generator, so it does not depend on
+        the other rows of the batch."""
         for linear in self.layers:
-            x = F.dropout(F.relu(linear(x)), p=self.dropout_rate, training=True)
+            x = F.relu(linear(x))
+            if generators is None:
+                x = F.dropout(x, p=self.dropout_rate, training=True)
+            else:
+                keep = 1.0 - self.dropout_rate
+                probs = torch.full(x.shape[1:], keep, dtype=x.dtype, device=x.device)
+                masks = [torch.bernoulli(probs, generator=g) for g in generators]
+                x = x * torch.stack(masks) / keep
         return x
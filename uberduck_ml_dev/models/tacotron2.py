@@ -1,11 +1,13 @@
 # TODO (Sam): unite the 5 different forward / inference methods in the decoder as well.
 # TODO (Sam): treat "gst" and "speaker_embedding" generically (e.g. x_encoding, y_encoding)
 # TODO (Sam): move to Hydra or more organized config
+import copy
+
 from torch import nn
 import numpy as np
 import torch
 from torch.nn import functional as F
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from speechbrain.pretrained import EncoderClassifier
 
@@ -15,8 +17,14 @@ from ..data.batch import Batch
 from .base import TTSModel
 from ..vendor.tfcompat.hparam import HParams
 from .base import DEFAULTS as MODEL_DEFAULTS
-from .components.decoders.tacotron2 import Decoder, DecoderForwardIsInfer
-from .components.encoders.tacotron2 import Encoder, EncoderForwardIsInfer
+from .common import STL, fold_batch_norm
+from .components.decoders.tacotron2 import (
+    Decoder,
+    DECODER_FINISHED,
+    decoder_step_budget,
+    update_stop_state,
+)
+from .components.encoders.tacotron2 import Encoder
 from .components.postnet import Postnet
 from .components.zero_network import ZeroNetwork
 
@@ -57,10 +65,26 @@ DEFAULTS = HParams(
     prenet_rms_dim=0,
     prenet_fms_kernel_size=1,
     max_decoder_steps=1000,
+    # NOTE: inference stops a sequence after input_length * max_decoder_frames_per_token frames,
+    # after its attention focus has not advanced for max_attention_stall_frames frames, or after it
+    # has stayed on the last encoder position for max_frames_after_attention_end frames without the
+    # gate firing. None disables a check. All are off by default, since they can cut off long pauses
+    # or slow speakers of existing checkpoints; e.g. 20, 100 and 50 catch runaway decoding.
+    max_decoder_frames_per_token=None,
+    max_attention_stall_frames=None,
+    max_frames_after_attention_end=None,
     gate_threshold=0.5,
+    # NOTE: predict a stop gate for each of the n_frames_per_step_initial frames of a decoder step
+    # so that inference with n_frames_per_step > 1 stops on the exact frame. Off by default since
+    # it changes the gate layer shape of checkpoints trained with n_frames_per_step_initial > 1.
+    per_frame_gate=False,
     p_attention_dropout=0.1,
     p_decoder_dropout=0.1,
     p_teacher_forcing=1.0,
+    # NOTE: activation checkpointing for training. Decoder states are stored every
+    # decoder_checkpoint_steps steps and segments are recomputed in backward; 0 disables.
+    # Around sqrt(T_out) minimizes memory, larger values trade memory for fewer recomputed states.
+    decoder_checkpoint_steps=0,
     pos_weight=None,
     # attention parameters
     attention_rnn_dim=1024,
@@ -68,10 +92,18 @@ DEFAULTS = HParams(
     # location layer parameters
     attention_location_n_filters=32,
     attention_location_kernel_size=31,
+    # NOTE: half-width of the windowed attention around the previous peak, None attends over
+    # the full input. Can be set at inference on models trained without it.
+    attention_window_size=None,
+    # NOTE: attention weights returned by inference, one of "full", "max", "topk" or "none"
+    # (see INFERENCE_ALIGNMENTS). The full (B, T_out, T_in) tensor is often larger than the mel.
+    inference_alignments="full",
+    inference_alignments_topk=4,
     # mel post-processing network parameters
     postnet_embedding_dim=512,
     postnet_kernel_size=5,
     postnet_n_convolutions=5,
+    postnet_checkpoint=False,
     n_speakers=1,
     speaker_embedding_dim=128,
     # reference encoder
@@ -152,6 +184,9 @@ class Tacotron2(TTSModel):
             self.spkr_lin = nn.Linear(
                 self.speaker_embedding_dim, self.encoder_embedding_dim
             )
+        # NOTE: set by freeze_for_inference.
+        self.frozen = False
+        self.speaker_conditioning = None
 
         self.gst_init(hparams)
         self.audio_encoder_init(hparams)
@@ -180,6 +215,68 @@ class Tacotron2(TTSModel):
             )
             print("Initialized Audio Encoder")
 
+    def set_current_frames_per_step(self, n_frames: int):
+        """Set the reduction factor r, the number of frames emitted per decoder step.
+
+        r can be changed during training (see reduction_window_schedule) but cannot
+        exceed n_frames_per_step_initial, which sizes the decoder projection.
+        """
+        if n_frames > self.n_frames_per_step_initial:
+            raise Exception(
+                f"n_frames_per_step {n_frames} exceeds n_frames_per_step_initial {self.n_frames_per_step_initial}"
+            )
+        self.n_frames_per_step_current = n_frames
+        self.decoder.set_current_frames_per_step(n_frames)
+
+    def freeze_for_inference(self, quantize: bool = False):
+        """Return an inference-only copy of the model.
+
+        BatchNorm is folded into the preceding convolutions of the encoder and
+        postnet, spkr_lin(speaker_embedding) is precomputed into a per-speaker
+        lookup table, and style token keys/values are cached. The copy skips the
+        speaker id range check in forward and must not be trained.
+
+        With quantize, the layers in quantized_layers() are also dynamically
+        quantized to int8 for CPU inference (see get_inference_agreement for
+        measuring the effect on outputs).
+        """
+        model = copy.deepcopy(self).eval()
+        model.requires_grad_(False)
+        fold_batch_norm(model.encoder.convolutions)
+        fold_batch_norm(model.postnet.convolutions)
+        if model.has_speaker_embedding and model.audio_encoder is None:
+            model.speaker_conditioning = nn.Embedding.from_pretrained(
+                model.spkr_lin(model.speaker_embedding.weight)
+            )
+        for module in model.modules():
+            if isinstance(module, STL):
+                module.cache_key_values()
+        if quantize:
+            torch.ao.quantization.quantize_dynamic(
+                model,
+                {
+                    name: torch.ao.quantization.default_dynamic_qconfig
+                    for name in model.quantized_layers()
+                },
+                dtype=torch.qint8,
+                inplace=True,
+            )
+        model.frozen = True
+        return model
+
+    def quantized_layers(self):
+        """Names of the layers quantized by freeze_for_inference(quantize=True):
+        the recurrent layers and the decoder projections that dominate CPU inference time."""
+        return [
+            "encoder.lstm",
+            "decoder.attention_rnn",
+            "decoder.decoder_rnn",
+            "decoder.linear_projection.linear_layer",
+        ] + [
+            f"decoder.prenet.layers.{i}.linear_layer"
+            for i in range(len(self.decoder.prenet.layers))
+        ]
+
     def mask_output(
         self, output_lengths, mel_outputs, mel_outputs_postnet, gate_predicted
     ):
@@ -190,9 +287,11 @@ class Tacotron2(TTSModel):
             mask = F.pad(mask, (0, mel_outputs.size(2) - mask.size(2)))
             mask = mask.permute(1, 0, 2)  # NOTE (Sam): replace with einops
 
-            mel_outputs.data.masked_fill_(mask, 0.0)
-            mel_outputs_postnet.data.masked_fill_(mask, 0.0)
-            gate_predicted.data.masked_fill_(mask[:, 0, :], 1e3)
+            # NOTE: out of place, since mel_outputs is saved (or recomputed under
+            # activation checkpointing) as the postnet input for backward.
+            mel_outputs = mel_outputs.masked_fill(mask, 0.0)
+            mel_outputs_postnet = mel_outputs_postnet.masked_fill(mask, 0.0)
+            gate_predicted = gate_predicted.masked_fill(mask[:, 0, :], 1e3)
 
         return output_lengths, mel_outputs, mel_outputs_postnet, gate_predicted
 
@@ -214,9 +313,11 @@ class Tacotron2(TTSModel):
         # NOTE (Sam): [0, mel_stop_index) tf, (mel_stop_index, mel_start_index) inf, (mel_start_index, max) tf
         mel_start_index: Optional[int] = 0,
         mel_stop_index: Optional[int] = 0,
+        # NOTE: one random generator per sequence for the prenet dropout in INFERENCE mode.
+        prenet_generators: Optional[List[torch.Generator]] = None,
     ):
 
-        if speaker_ids is not None:
+        if speaker_ids is not None and not self.frozen:
             if max(speaker_ids) >= self.n_speakers:
                 raise Exception("Speaker id out of range")
         if input_lengths is not None:
@@ -232,6 +333,8 @@ class Tacotron2(TTSModel):
             if self.audio_encoder is not None:
                 # NOTE (Sam): right now, audio_encoding is a mean of the audio encoder outputs and only works for a single speaker.
                 encoder_outputs += self.audio_encoder_lin(audio_encoding)
+            elif self.speaker_conditioning is not None:
+                encoder_outputs += self.speaker_conditioning(speaker_ids)[:, None]
             else:
                 # NOTE (Sam): its unclear where speaker_embedding adds a useful degree of freedom for training.
                 # It seems we could use a deeper embedding of the pre-trained encoding to get the same effect.
@@ -256,7 +359,10 @@ class Tacotron2(TTSModel):
                 gate_predicted,
                 alignments,
                 output_lengths,
-            ) = self.decoder.inference(encoder_outputs, input_lengths)
+                decoder_status,
+            ) = self.decoder.inference(
+                encoder_outputs, input_lengths, prenet_generators=prenet_generators
+            )
 
         if mode == DOUBLE_TEACHER_FORCED:
 
@@ -312,22 +418,272 @@ class Tacotron2(TTSModel):
             alignments=alignments,
             output_lengths=output_lengths,
         )
+        if mode == INFERENCE:
+            output["decoder_status"] = decoder_status
         return output
 
 
-# NOTE (Sam): I'm not sure if this is necessary for torchscript anymore since inference is now in forward.
-class Tacotron2ForwardIsInfer(Tacotron2):
-    def __init__(self, hparams):
-        super().__init__(hparams)
+# NOTE: decoder state passed between Tacotron2Inference.decode steps: attention_hidden,
+# attention_cell, decoder_hidden, decoder_cell, attention_weights, attention_weights_cum,
+# attention_context.
+DecoderState = Tuple[
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+    torch.Tensor,
+]
 
-        self.encoder = EncoderForwardIsInfer(hparams)
-        self.decoder = DecoderForwardIsInfer(hparams)
 
-    def forward(
+class Tacotron2Inference(nn.Module):
+    """TorchScript compatible Tacotron2 inference.
+
+    Covers the embedding, encoder, decoder loop with gate stopping and step
+    budgets, and postnet of a Tacotron2 in INFERENCE mode. Decoder state is
+    passed explicitly rather than stored on the module, so the module can be
+    compiled with torch.jit.script and saved with torch.jit.save. The saved file
+    loads with torch.jit.load alone.
+
+    Attention is computed over the full input (attention_window_size is not
+    used), no alignments are returned, and models with gst or an audio encoder
+    are not supported.
+    """
+
+    max_decoder_frames_per_token: Optional[float]
+    max_attention_stall_frames: Optional[int]
+    max_frames_after_attention_end: Optional[int]
+
+    def __init__(self, model: Tacotron2):
+        super().__init__()
+        if model.with_gst or model.audio_encoder is not None:
+            raise Exception(
+                "Tacotron2Inference does not support gst or audio encoder conditioning"
+            )
+        if not model.frozen:
+            model = model.freeze_for_inference()
+        decoder = model.decoder
+        attention = decoder.attention_layer
+
+        self.embedding = model.embedding
+        self.encoder_convolutions = model.encoder.convolutions
+        self.encoder_lstm = model.encoder.lstm
+        self.prenet = decoder.prenet
+        self.attention_rnn = decoder.attention_rnn
+        self.query_layer = attention.query_layer
+        self.memory_layer = attention.memory_layer
+        self.location_layer = attention.location_layer
+        self.v = attention.v
+        self.decoder_rnn = decoder.decoder_rnn
+        self.linear_projection = decoder.linear_projection
+        self.gate_layer = decoder.gate_layer
+        self.postnet_convolutions = model.postnet.convolutions
+        if model.speaker_conditioning is not None:
+            speaker_table = model.speaker_conditioning.weight
+        else:
+            speaker_table = torch.zeros(1, model.encoder_embedding_dim)
+        self.register_buffer("speaker_table", speaker_table.detach().clone())
+
+        self.n_speakers = model.n_speakers
+        self.mask_padding = model.mask_padding
+        self.n_mel_channels = decoder.n_mel_channels
+        self.n_frames_per_step = decoder.n_frames_per_step_current
+        self.per_frame_gate = decoder.per_frame_gate
+        self.attention_rnn_dim = decoder.attention_rnn_dim
+        self.decoder_rnn_dim = decoder.decoder_rnn_dim
+        self.encoder_embedding_dim = decoder.encoder_embedding_dim
+        self.score_mask_value = float(attention.score_mask_value)
+        self.gate_threshold = float(decoder.gate_threshold)
+        self.max_decoder_steps = decoder.max_decoder_steps
+        self.max_decoder_frames_per_token = (
+            None
+            if decoder.max_decoder_frames_per_token is None
+            else float(decoder.max_decoder_frames_per_token)
+        )
+        self.max_attention_stall_frames = decoder.max_attention_stall_frames
+        self.max_frames_after_attention_end = decoder.max_frames_after_attention_end
+        # NOTE: TorchScript cannot read module level globals.
+        self.decoder_finished = DECODER_FINISHED
+        self.eval()
+
+    def encode(self, input_text, input_lengths, speaker_ids):
+        x = self.embedding(input_text).transpose(1, 2)
+        # NOTE: zeroing the padding before each convolution matches running every item at its own length.
+        padding = ~get_mask_from_lengths(input_lengths, input_text.size(1))[:, None]
+        for conv in self.encoder_convolutions:
+            x = F.relu(conv(x.masked_fill(padding, 0.0)))
+        x = nn.utils.rnn.pack_padded_sequence(
+            x.transpose(1, 2),
+            input_lengths.cpu(),
+            batch_first=True,
+            enforce_sorted=False,
+        )
+        outputs, _ = self.encoder_lstm(x)
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
+        return outputs + self.speaker_table[speaker_ids][:, None]
+
+    def initial_state(self, memory) -> DecoderState:
+        B = memory.size(0)
+        T_in = memory.size(1)
+        return (
+            memory.new_zeros(B, self.attention_rnn_dim),
+            memory.new_zeros(B, self.attention_rnn_dim),
+            memory.new_zeros(B, self.decoder_rnn_dim),
+            memory.new_zeros(B, self.decoder_rnn_dim),
+            memory.new_zeros(B, T_in),
+            memory.new_zeros(B, T_in),
+            memory.new_zeros(B, self.encoder_embedding_dim),
+        )
+
+    def decode(
         self,
-        input_text,
-        input_lengths,
-        speaker_ids,
-        embedded_gst,
-    ):
-        return self.inference(input_text, input_lengths, speaker_ids, embedded_gst)
+        decoder_input,
+        state: DecoderState,
+        memory,
+        processed_memory,
+        mask,
+    ) -> Tuple[torch.Tensor, torch.Tensor, DecoderState]:
+        """One decoder step, same as Decoder.decode in eval mode.
+
+        returns: (mel_output, gate_output, state)
+        """
+        (
+            attention_hidden,
+            attention_cell,
+            decoder_hidden,
+            decoder_cell,
+            attention_weights,
+            attention_weights_cum,
+            attention_context,
+        ) = state
+        attention_hidden, attention_cell = self.attention_rnn(
+            torch.cat((decoder_input, attention_context), -1),
+            (attention_hidden, attention_cell),
+        )
+        attention_weights_cat = torch.stack(
+            (attention_weights, attention_weights_cum), dim=1
+        )
+        energies = self.v(
+            torch.tanh(
+                self.query_layer(attention_hidden.unsqueeze(1))
+                + self.location_layer(attention_weights_cat)
+                + processed_memory
+            )
+        ).squeeze(-1)
+        attention_weights = F.softmax(
+            energies.masked_fill(mask, self.score_mask_value), dim=1
+        )
+        attention_weights_cum = attention_weights_cum + attention_weights
+        attention_context = torch.bmm(attention_weights.unsqueeze(1), memory).squeeze(1)
+        decoder_hidden, decoder_cell = self.decoder_rnn(
+            torch.cat((attention_hidden, attention_context), -1),
+            (decoder_hidden, decoder_cell),
+        )
+        decoder_hidden_attention_context = torch.cat(
+            (decoder_hidden, attention_context), dim=1
+        )
+        mel_output = self.linear_projection(decoder_hidden_attention_context)
+        gate_output = self.gate_layer(decoder_hidden_attention_context)
+        state = (
+            attention_hidden,
+            attention_cell,
+            decoder_hidden,
+            decoder_cell,
+            attention_weights,
+            attention_weights_cum,
+            attention_context,
+        )
+        return mel_output, gate_output, state
+
+    def postnet(self, mel_outputs):
+        x = mel_outputs
+        n_convolutions = len(self.postnet_convolutions)
+        for i, conv in enumerate(self.postnet_convolutions):
+            x = conv(x)
+            if i < n_convolutions - 1:
+                x = torch.tanh(x)
+        return mel_outputs + x
+
+    def forward(self, input_text, input_lengths, speaker_ids):
+        """
+        input_text: (B, T_in) symbol ids
+        input_lengths: (B,)
+        speaker_ids: (B,), zeros for single speaker models
+
+        returns: (mel_outputs_postnet (B, n_mel_channels, T_out), mel_lengths (B,),
+        decoder_status (B,)) with the same meaning as in Tacotron2.forward
+        """
+        memory = self.encode(input_text, input_lengths, speaker_ids)
+        processed_memory = self.memory_layer(memory)
+        mask = ~get_mask_from_lengths(input_lengths, memory.size(1))
+        state = self.initial_state(memory)
+        B = memory.size(0)
+        r = self.n_frames_per_step
+        device = memory.device
+
+        budget = decoder_step_budget(
+            input_lengths,
+            self.max_decoder_steps,
+            self.max_decoder_frames_per_token,
+            r,
+        )
+        not_finished = torch.ones([B], dtype=torch.bool, device=device)
+        mel_lengths = torch.zeros([B], dtype=torch.int32, device=device)
+        decoder_status = torch.full(
+            [B], self.decoder_finished, dtype=torch.int32, device=device
+        )
+        furthest_focus = torch.full([B], -1, dtype=torch.long, device=device)
+        steps_since_advance = torch.zeros([B], dtype=torch.long, device=device)
+        steps_at_end = torch.zeros([B], dtype=torch.long, device=device)
+
+        decoder_input = memory.new_zeros(B, self.n_mel_channels)
+        mel_outputs: List[torch.Tensor] = []
+        while True:
+            mel_output, gate_output, state = self.decode(
+                self.prenet(decoder_input), state, memory, processed_memory, mask
+            )
+            mel_output = mel_output[:, : self.n_mel_channels * r]
+            if self.per_frame_gate:
+                gate_output = gate_output[:, :r]
+            else:
+                gate_output = gate_output.expand(-1, r)
+            mel_outputs.append(mel_output)
+
+            (
+                not_finished,
+                mel_lengths,
+                decoder_status,
+                furthest_focus,
+                steps_since_advance,
+                steps_at_end,
+            ) = update_stop_state(
+                gate_output,
+                state[4],
+                input_lengths,
+                budget,
+                len(mel_outputs),
+                not_finished,
+                mel_lengths,
+                decoder_status,
+                furthest_focus,
+                steps_since_advance,
+                steps_at_end,
+                self.gate_threshold,
+                self.max_attention_stall_frames,
+                self.max_frames_after_attention_end,
+            )
+            if not bool(not_finished.any()):
+                break
+            decoder_input = mel_output[:, -self.n_mel_channels :]
+
+        # (T_out / r, B, n_mel_channels * r) -> (B, n_mel_channels, T_out)
+        mel_outputs = torch.stack(mel_outputs, dim=1).reshape(
+            B, -1, self.n_mel_channels
+        )
+        mel_outputs = mel_outputs.transpose(1, 2)
+        mel_outputs_postnet = self.postnet(mel_outputs)
+        if self.mask_padding:
+            padding = ~get_mask_from_lengths(mel_lengths, mel_outputs.size(2))
+            mel_outputs_postnet = mel_outputs_postnet.masked_fill(padding[:, None], 0.0)
+        return mel_outputs_postnet, mel_lengths, decoder_status
@@ -1,16 +1,47 @@
 __all__ = []
 
 
-from ..data_loader import prepare_input_sequence
+import torch
 
+from ..e2e import tts
+from ..registry import get_registry, load_tacotron2
+from ..models.tacotron2 import Tacotron2
+from ..utils.audio import saturate_int16
 
-def _get_inference(model, vocoder, texts, speaker_ids, symbol_set, arpabet, cpu_run):
 
-    text_padded, input_lengths = prepare_input_sequence(
-        texts, cpu_run=cpu_run, arpabet=arpabet, symbol_set=symbol_set
+def _load_tacotron2(model_path, model_format, hparams, device, registry=None):
+    """Tacotron2 shared through the model registry. "D" checkpoints hold the state
+    dict under "model" or "state_dict", "OD" files are the bare state dict."""
+    if model_format == "D":
+        return load_tacotron2(model_path, hparams, device=device, registry=registry)
+    if registry is None:
+        registry = get_registry()
+
+    def loader():
+        model = Tacotron2(hparams)
+        model.from_pretrained(
+            model_dict=torch.load(model_path, map_location=device), device=device
+        )
+        return model.eval()
+
+    config = dict(
+        model="tacotron2",
+        model_format=model_format,
+        hparams=hparams.values(),
+        device=device,
+    )
+    return registry.get(model_path, config, loader)
+
+
+def _get_inference(model, vocoder, texts, speaker_ids, symbol_set, arpabet, cpu_run):
+    """int16 audio of the first of texts."""
+    audio = tts(
+        texts[:1],
+        model,
+        "cpu" if cpu_run else "cuda",
+        vocoder,
+        arpabet=arpabet,
+        symbol_set=symbol_set,
+        speaker_ids=speaker_ids[:1],
     )
-    # Note (SAM): None is for GST... temporary solution
-    input_ = text_padded, input_lengths, speaker_ids, None
-    output = model.inference(input_)
-    audio = vocoder.infer(output[1][:1])
-    return audio
+    return saturate_int16(audio[0])
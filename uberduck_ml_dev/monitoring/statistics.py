@@ -1,4 +1,8 @@
-__all__ = ["get_alignment_metrics"]
+__all__ = [
+    "get_alignment_metrics",
+    "get_inference_agreement",
+    "multi_resolution_stft_distance",
+]
 
 import torch
 from ..utils.utils import get_mask_from_lengths
@@ -44,3 +48,80 @@ def get_alignment_metrics(
     output["max"] = maxes
 
     return output
+
+
+def get_inference_agreement(reference, output, input_lengths, gate_tolerance=1):
+    """Compare two Tacotron2 INFERENCE outputs for the same inputs, e.g. of a
+    quantized model against the fp32 model it was built from.
+
+    reference, output: Tacotron2.forward output dicts with full alignments.
+    Returns mel_l1, the mean absolute difference of mel_outputs_postnet over the
+    frames both produced; diagonalness and reference_diagonalness from
+    get_alignment_metrics; and gate_stop_agreement, the fraction of sequences
+    that stopped for the same reason within gate_tolerance frames of each other.
+    """
+    reference_lengths = reference["output_lengths"].long()
+    output_lengths = output["output_lengths"].long()
+    lengths = torch.minimum(reference_lengths, output_lengths)
+    n_frames = min(
+        reference["mel_outputs_postnet"].size(2), output["mel_outputs_postnet"].size(2)
+    )
+    mask = get_mask_from_lengths(lengths, max_len=n_frames)[:, None]
+    difference = (
+        reference["mel_outputs_postnet"][..., :n_frames]
+        - output["mel_outputs_postnet"][..., :n_frames]
+    ).abs()
+    mel_l1 = (difference * mask).sum() / (mask.sum() * difference.size(1)).clamp(min=1)
+
+    def diagonalness(o):
+        alignments = o["alignments"]
+        # NOTE: alignments are per decoder step, which is n_frames_per_step frames.
+        r = o["mel_outputs_postnet"].size(2) // alignments.size(1)
+        steps = torch.div(o["output_lengths"].long() + r - 1, r, rounding_mode="floor")
+        return get_alignment_metrics(
+            alignments, input_lengths=input_lengths, output_lengths=steps
+        )["diagonalness"]
+
+    stop_agreement = ((reference_lengths - output_lengths).abs() <= gate_tolerance) & (
+        reference["decoder_status"] == output["decoder_status"]
+    )
+
+    return dict(
+        mel_l1=mel_l1,
+        diagonalness=diagonalness(output),
+        reference_diagonalness=diagonalness(reference),
+        gate_stop_agreement=stop_agreement.float().mean(),
+    )
+
+
+def multi_resolution_stft_distance(
+    audio,
+    reference,
+    resolutions=((512, 128, 512), (1024, 256, 1024), (2048, 512, 2048)),
+):
+    """Spectral convergence plus log STFT magnitude L1 between audio and reference
+    (B, T) waveforms, averaged over (n_fft, hop_length, win_length) resolutions."""
+    distance = 0.0
+    for n_fft, hop_length, win_length in resolutions:
+        window = torch.hann_window(win_length, device=audio.device)
+
+        def magnitude(x):
+            return (
+                torch.stft(
+                    x.float(),
+                    n_fft,
+                    hop_length,
+                    win_length,
+                    window,
+                    return_complex=True,
+                )
+                .abs()
+                .clamp(min=1e-7)
+            )
+
+        x = magnitude(audio)
+        y = magnitude(reference)
+        spectral_convergence = torch.norm(y - x) / torch.norm(y)
+        log_magnitude = (y.log() - x.log()).abs().mean()
+        distance = distance + spectral_convergence + log_magnitude
+    return distance / len(resolutions)
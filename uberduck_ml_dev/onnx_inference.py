@@ -0,0 +1,530 @@
+"""ONNX export of the Tacotron2 + HiFi-GAN pipeline and onnxruntime drivers.
+
+Requires the optional onnx and onnxruntime packages (pip install uberduck_ml_dev[onnx]).
+The exported graphs have dynamic batch and time axes. The autoregressive
+decoder loop runs in OnnxTacotron2 around the exported single step graph.
+"""
+
+__all__ = [
+    "Tacotron2EncoderGraph",
+    "DecoderStepGraph",
+    "PostnetGraph",
+    "export_tacotron2_encoder",
+    "export_decoder_step",
+    "export_postnet",
+    "export_hifigan_generator",
+    "export_tacotron2",
+    "OnnxTacotron2",
+    "OnnxHiFiGan",
+]
+
+import copy
+import json
+import os
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .models.tacotron2 import Tacotron2
+from .vocoders.hifigan import Generator, HiFiGanGenerator
+from .models.components.decoders.tacotron2 import (
+    DECODER_FINISHED,
+    decoder_step_budget,
+    update_stop_state,
+)
+
+OPSET_VERSION = 14
+ENCODER_FILE = "encoder.onnx"
+DECODER_STEP_FILE = "decoder_step.onnx"
+POSTNET_FILE = "postnet.onnx"
+CONFIG_FILE = "config.json"
+DECODER_STATE = [
+    "attention_hidden",
+    "attention_cell",
+    "decoder_hidden",
+    "decoder_cell",
+    "attention_weights",
+    "attention_weights_cum",
+    "attention_context",
+]
+
+
+def _frozen_copy(model: Tacotron2):
+    if model.frozen:
+        return copy.deepcopy(model)
+    return model.freeze_for_inference()
+
+
+def _unidirectional_lstm(lstm: nn.LSTM, suffix: str):
+    """One direction of a single layer bidirectional LSTM as its own module."""
+    single = nn.LSTM(lstm.input_size, lstm.hidden_size, 1, batch_first=True)
+    for name in ["weight_ih_l0", "weight_hh_l0", "bias_ih_l0", "bias_hh_l0"]:
+        getattr(single, name).data.copy_(getattr(lstm, name + suffix).data)
+    return single
+
+
+class Tacotron2EncoderGraph(nn.Module):
+    """Embedding, encoder and speaker/gst conditioning of a frozen Tacotron2.
+
+    The packed BiLSTM of Encoder is replaced by two unidirectional LSTMs over
+    the padded batch, the backward one on each sequence reversed within its
+    length, which gives the same outputs and exports to ONNX.
+    """
+
+    def __init__(self, model: Tacotron2):
+        super().__init__()
+        if model.audio_encoder is not None:
+            raise Exception("ONNX export does not support audio encoder conditioning")
+        model = _frozen_copy(model)
+        self.embedding = model.embedding
+        self.convolutions = model.encoder.convolutions
+        self.forward_lstm = _unidirectional_lstm(model.encoder.lstm, "")
+        self.backward_lstm = _unidirectional_lstm(model.encoder.lstm, "_reverse")
+        self.memory_layer = model.decoder.attention_layer.memory_layer
+        self.gst_lin = model.gst_lin if model.with_gst else None
+        if model.speaker_conditioning is not None:
+            speaker_table = model.speaker_conditioning.weight
+        else:
+            speaker_table = torch.zeros(1, model.encoder_embedding_dim)
+        self.register_buffer("speaker_table", speaker_table.detach().clone())
+
+    def forward(self, input_text, input_lengths, speaker_ids, embedded_gst=None):
+        """returns: memory (B, T_in, D), processed_memory (B, T_in, attention_dim)
+        and mask (B, T_in), True at padding."""
+        positions = torch.arange(input_text.size(1), device=input_text.device)[None]
+        lengths = input_lengths[:, None]
+        mask = positions >= lengths
+        x = self.embedding(input_text).transpose(1, 2)
+        for conv in self.convolutions:
+            x = F.relu(conv(x.masked_fill(mask[:, None], 0.0)))
+        x = x.transpose(1, 2)
+        reverse = torch.where(mask, positions, lengths - 1 - positions)[..., None]
+        forward_outputs, _ = self.forward_lstm(x)
+        backward_outputs, _ = self.backward_lstm(
+            torch.gather(x, 1, reverse.expand(-1, -1, x.size(2)))
+        )
+        backward_outputs = torch.gather(
+            backward_outputs, 1, reverse.expand(-1, -1, backward_outputs.size(2))
+        )
+        memory = torch.cat((forward_outputs, backward_outputs), 2)
+        memory = memory.masked_fill(mask[..., None], 0.0)
+        memory = memory + self.speaker_table[speaker_ids][:, None]
+        if self.gst_lin is not None:
+            memory = memory + self.gst_lin(embedded_gst)
+        return memory, self.memory_layer(memory), mask
+
+
+class DecoderStepGraph(nn.Module):
+    """The prenet and one Decoder.decode step of a frozen Tacotron2.
+
+    Decoder state is passed in and returned explicitly (see DECODER_STATE).
+    Prenet dropout, which Tacotron2 keeps at inference, takes its masks as
+    inputs so that the step graph is deterministic.
+    """
+
+    def __init__(self, model: Tacotron2):
+        super().__init__()
+        model = _frozen_copy(model)
+        decoder = model.decoder
+        # NOTE: the windowed attention branch depends on the input length, which is
+        # fixed at export time, so the step graph always attends over the full input.
+        decoder.attention_layer.window_size = None
+        self.decoder = decoder
+        self.n_mel_channels = decoder.n_mel_channels
+        self.n_frames_per_step = decoder.n_frames_per_step_current
+
+    def forward(
+        self,
+        decoder_input,
+        prenet_mask_0,
+        prenet_mask_1,
+        attention_hidden,
+        attention_cell,
+        decoder_hidden,
+        decoder_cell,
+        attention_weights,
+        attention_weights_cum,
+        attention_context,
+        memory,
+        processed_memory,
+        mask,
+    ):
+        """returns: mel_output (B, n_mel_channels * r), gate_output (B, r) and the new decoder state."""
+        decoder = self.decoder
+        x = decoder_input
+        for linear, prenet_mask in zip(
+            decoder.prenet.layers, [prenet_mask_0, prenet_mask_1]
+        ):
+            x = F.relu(linear(x)) * prenet_mask
+        decoder.attention_hidden = attention_hidden
+        decoder.attention_cell = attention_cell
+        decoder.decoder_hidden = decoder_hidden
+        decoder.decoder_cell = decoder_cell
+        decoder.attention_weights = attention_weights
+        decoder.attention_weights_cum = attention_weights_cum
+        decoder.attention_context = attention_context
+        decoder.memory = memory
+        decoder.processed_memory = processed_memory
+        decoder.mask = mask
+        mel_output, gate_output, _ = decoder.decode(x, None)
+        mel_output = mel_output[:, : self.n_mel_channels * self.n_frames_per_step]
+        gate_output = decoder.frame_gates(gate_output)
+        return (mel_output, gate_output) + tuple(
+            getattr(decoder, name) for name in DECODER_STATE
+        )
+
+
+class PostnetGraph(nn.Module):
+    def __init__(self, model: Tacotron2):
+        super().__init__()
+        model = _frozen_copy(model)
+        self.postnet = model.postnet
+
+    def forward(self, mel_outputs):
+        return mel_outputs + self.postnet(mel_outputs)
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes):
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            args,
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=OPSET_VERSION,
+        )
+
+
+def export_tacotron2_encoder(model: Tacotron2, path: str):
+    graph = Tacotron2EncoderGraph(model).eval()
+    input_text = torch.randint(1, graph.embedding.num_embeddings, (2, 8))
+    args = (input_text, torch.LongTensor([8, 5]), torch.LongTensor([0, 0]))
+    input_names = ["input_text", "input_lengths", "speaker_ids"]
+    dynamic_axes = {
+        "input_text": {0: "batch", 1: "input_time"},
+        "input_lengths": {0: "batch"},
+        "speaker_ids": {0: "batch"},
+        "memory": {0: "batch", 1: "input_time"},
+        "processed_memory": {0: "batch", 1: "input_time"},
+        "mask": {0: "batch", 1: "input_time"},
+    }
+    if graph.gst_lin is not None:
+        args += (torch.zeros(2, 1, graph.gst_lin.in_features),)
+        input_names.append("embedded_gst")
+        dynamic_axes["embedded_gst"] = {0: "batch"}
+    _export(
+        graph,
+        args,
+        path,
+        input_names,
+        ["memory", "processed_memory", "mask"],
+        dynamic_axes,
+    )
+
+
+def export_decoder_step(model: Tacotron2, path: str):
+    graph = DecoderStepGraph(model).eval()
+    decoder = graph.decoder
+    B, T_in = 2, 8
+    memory = torch.zeros(B, T_in, decoder.encoder_embedding_dim)
+    args = (
+        torch.zeros(B, decoder.n_mel_channels),
+        torch.ones(B, decoder.prenet_dim),
+        torch.ones(B, decoder.prenet_dim),
+        torch.zeros(B, decoder.attention_rnn_dim),
+        torch.zeros(B, decoder.attention_rnn_dim),
+        torch.zeros(B, decoder.decoder_rnn_dim),
+        torch.zeros(B, decoder.decoder_rnn_dim),
+        torch.zeros(B, T_in),
+        torch.zeros(B, T_in),
+        torch.zeros(B, decoder.encoder_embedding_dim),
+        memory,
+        decoder.attention_layer.memory_layer(memory),
+        torch.zeros(B, T_in, dtype=torch.bool),
+    )
+    input_names = (
+        ["decoder_input", "prenet_mask_0", "prenet_mask_1"]
+        + DECODER_STATE
+        + ["memory", "processed_memory", "mask"]
+    )
+    output_names = ["mel_output", "gate_output"] + [
+        f"next_{name}" for name in DECODER_STATE
+    ]
+    dynamic_axes = {name: {0: "batch"} for name in input_names + output_names}
+    for name in [
+        "attention_weights",
+        "attention_weights_cum",
+        "next_attention_weights",
+        "next_attention_weights_cum",
+        "memory",
+        "processed_memory",
+        "mask",
+    ]:
+        dynamic_axes[name][1] = "input_time"
+    _export(graph, args, path, input_names, output_names, dynamic_axes)
+
+
+def export_postnet(model: Tacotron2, path: str):
+    graph = PostnetGraph(model).eval()
+    dynamic_axes = {
+        "mel_outputs": {0: "batch", 2: "output_time"},
+        "mel_outputs_postnet": {0: "batch", 2: "output_time"},
+    }
+    _export(
+        graph,
+        (torch.zeros(2, model.n_mel_channels, 16),),
+        path,
+        ["mel_outputs"],
+        ["mel_outputs_postnet"],
+        dynamic_axes,
+    )
+
+
+def export_hifigan_generator(generator: nn.Module, path: str):
+    """Export a HiFi-GAN Generator or HiFiGanGenerator, with weight norm removed,
+    mapping mel (B, n_mel_channels, T) to audio (B, 1, T * hop_size) in [-1, 1]."""
+    if isinstance(generator, HiFiGanGenerator):
+        generator = generator.vocoder
+    # NOTE: modules with weight norm cannot be deep copied, so the copy is rebuilt from the state dict.
+    state_dict = generator.state_dict()
+    weight_norm = any(k.endswith("weight_g") for k in state_dict)
+    exported = Generator(generator.h)
+    if not weight_norm:
+        exported.remove_weight_norm()
+    exported.load_state_dict(state_dict)
+    if weight_norm:
+        exported.remove_weight_norm()
+    exported.eval()
+    n_mel_channels = exported.conv_pre.in_channels
+    dynamic_axes = {
+        "mel": {0: "batch", 2: "output_time"},
+        "audio": {0: "batch", 2: "samples"},
+    }
+    _export(
+        exported,
+        (torch.zeros(1, n_mel_channels, 16),),
+        path,
+        ["mel"],
+        ["audio"],
+        dynamic_axes,
+    )
+
+
+def export_tacotron2(model: Tacotron2, directory: str):
+    """Export the encoder, decoder step and postnet graphs of model to directory,
+    together with the config.json that OnnxTacotron2 needs to run them."""
+    model = _frozen_copy(model)
+    os.makedirs(directory, exist_ok=True)
+    export_tacotron2_encoder(model, os.path.join(directory, ENCODER_FILE))
+    export_decoder_step(model, os.path.join(directory, DECODER_STEP_FILE))
+    export_postnet(model, os.path.join(directory, POSTNET_FILE))
+    decoder = model.decoder
+    config = dict(
+        n_mel_channels=decoder.n_mel_channels,
+        n_frames_per_step=decoder.n_frames_per_step_current,
+        attention_rnn_dim=decoder.attention_rnn_dim,
+        decoder_rnn_dim=decoder.decoder_rnn_dim,
+        encoder_embedding_dim=decoder.encoder_embedding_dim,
+        prenet_dim=decoder.prenet_dim,
+        prenet_dropout_rate=decoder.prenet.dropout_rate,
+        gate_threshold=decoder.gate_threshold,
+        max_decoder_steps=decoder.max_decoder_steps,
+        max_decoder_frames_per_token=decoder.max_decoder_frames_per_token,
+        max_attention_stall_frames=decoder.max_attention_stall_frames,
+        max_frames_after_attention_end=decoder.max_frames_after_attention_end,
+        mask_padding=model.mask_padding,
+        with_gst=model.with_gst,
+    )
+    with open(os.path.join(directory, CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def _session(path, sess_options=None, providers=None):
+    import onnxruntime as ort
+
+    return ort.InferenceSession(
+        path,
+        sess_options=sess_options,
+        providers=providers or ["CPUExecutionProvider"],
+    )
+
+
+class OnnxTacotron2:
+    """Tacotron2 inference with onnxruntime on the graphs written by export_tacotron2.
+
+    The decoder loop binds preallocated buffers to the step graph, swapping
+    the input and output state buffers after every step, and writes mel
+    frames directly into the output array. Stopping follows Decoder.inference:
+    the gate, the per-sequence step budget, and the attention stall and
+    overrun checks.
+    """
+
+    def __init__(self, directory, sess_options=None, providers=None, seed=None):
+        with open(os.path.join(directory, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.encoder = _session(
+            os.path.join(directory, ENCODER_FILE), sess_options, providers
+        )
+        self.decoder_step = _session(
+            os.path.join(directory, DECODER_STEP_FILE), sess_options, providers
+        )
+        self.postnet = _session(
+            os.path.join(directory, POSTNET_FILE), sess_options, providers
+        )
+        self.rng = np.random.default_rng(seed)
+
+    def prenet_masks(self, masks, uniform):
+        p = self.config["prenet_dropout_rate"]
+        for mask in masks:
+            if p == 0:
+                mask.fill(1.0)
+                continue
+            self.rng.random(dtype=np.float32, out=uniform)
+            np.multiply(uniform >= p, 1.0 / (1.0 - p), out=mask)
+
+    def encode(self, input_text, input_lengths, speaker_ids, embedded_gst=None):
+        inputs = dict(
+            input_text=input_text.astype(np.int64),
+            input_lengths=input_lengths.astype(np.int64),
+            speaker_ids=speaker_ids.astype(np.int64),
+        )
+        if self.config["with_gst"]:
+            inputs["embedded_gst"] = embedded_gst.astype(np.float32)
+        return self.encoder.run(None, inputs)
+
+    def __call__(self, input_text, input_lengths, speaker_ids, embedded_gst=None):
+        """
+        input_text: (B, T_in) int array of symbol ids
+        input_lengths: (B,)
+        speaker_ids: (B,), zeros for single speaker models
+
+        returns: mel_outputs_postnet (B, n_mel_channels, T_out) float32,
+        mel_lengths (B,) int32 and decoder_status (B,) int32, as in Tacotron2.forward
+        """
+        import onnxruntime as ort
+
+        config = self.config
+        n_mel_channels = config["n_mel_channels"]
+        r = config["n_frames_per_step"]
+        input_lengths = np.asarray(input_lengths).astype(np.int64)
+        memory, processed_memory, mask = self.encode(
+            np.asarray(input_text),
+            input_lengths,
+            np.asarray(speaker_ids),
+            embedded_gst,
+        )
+        B, T_in = mask.shape
+        state_shapes = dict(
+            attention_hidden=(B, config["attention_rnn_dim"]),
+            attention_cell=(B, config["attention_rnn_dim"]),
+            decoder_hidden=(B, config["decoder_rnn_dim"]),
+            decoder_cell=(B, config["decoder_rnn_dim"]),
+            attention_weights=(B, T_in),
+            attention_weights_cum=(B, T_in),
+            attention_context=(B, config["encoder_embedding_dim"]),
+        )
+        states = [
+            {name: np.zeros(shape, np.float32) for name, shape in state_shapes.items()}
+            for _ in range(2)
+        ]
+        budget = decoder_step_budget(
+            torch.from_numpy(input_lengths),
+            config["max_decoder_steps"],
+            config["max_decoder_frames_per_token"],
+            r,
+        )
+        max_steps = int(budget.max())
+        mel_outputs = np.zeros((max_steps, B, n_mel_channels * r), np.float32)
+        gate_output = np.zeros((B, r), np.float32)
+        decoder_input = np.zeros((B, n_mel_channels), np.float32)
+        prenet_masks = [
+            np.ones((B, config["prenet_dim"]), np.float32) for _ in range(2)
+        ]
+        uniform = np.zeros((B, config["prenet_dim"]), np.float32)
+
+        # NOTE: OrtValues on CPU share memory with the numpy arrays they wrap.
+        binding = self.decoder_step.io_binding()
+        for name, x in [
+            ("memory", memory),
+            ("processed_memory", processed_memory),
+            ("mask", mask),
+            ("decoder_input", decoder_input),
+            ("prenet_mask_0", prenet_masks[0]),
+            ("prenet_mask_1", prenet_masks[1]),
+        ]:
+            binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(x))
+        binding.bind_ortvalue_output(
+            "gate_output", ort.OrtValue.ortvalue_from_numpy(gate_output)
+        )
+        state_values = [
+            {name: ort.OrtValue.ortvalue_from_numpy(x) for name, x in state.items()}
+            for state in states
+        ]
+
+        stop_state = (
+            torch.ones(B, dtype=torch.bool),
+            torch.zeros(B, dtype=torch.int32),
+            torch.full([B], DECODER_FINISHED, dtype=torch.int32),
+            torch.full([B], -1, dtype=torch.long),
+            torch.zeros(B, dtype=torch.long),
+            torch.zeros(B, dtype=torch.long),
+        )
+        step = 0
+        while True:
+            current, following = state_values[step % 2], state_values[(step + 1) % 2]
+            for name in DECODER_STATE:
+                binding.bind_ortvalue_input(name, current[name])
+                binding.bind_ortvalue_output(f"next_{name}", following[name])
+            binding.bind_ortvalue_output(
+                "mel_output", ort.OrtValue.ortvalue_from_numpy(mel_outputs[step])
+            )
+            self.prenet_masks(prenet_masks, uniform)
+            self.decoder_step.run_with_iobinding(binding)
+            step += 1
+
+            stop_state = update_stop_state(
+                torch.from_numpy(gate_output),
+                torch.from_numpy(states[step % 2]["attention_weights"]),
+                torch.from_numpy(input_lengths),
+                budget,
+                step,
+                *stop_state,
+                gate_threshold=config["gate_threshold"],
+                max_attention_stall_frames=config["max_attention_stall_frames"],
+                max_frames_after_attention_end=config["max_frames_after_attention_end"],
+            )
+            not_finished = stop_state[0].numpy()
+            if not not_finished.any():
+                break
+            np.copyto(decoder_input, mel_outputs[step - 1, :, -n_mel_channels:])
+
+        mel_lengths = stop_state[1].numpy()
+        decoder_status = stop_state[2].numpy()
+        # (T_out / r, B, n_mel_channels * r) -> (B, n_mel_channels, T_out)
+        mel_outputs = (
+            mel_outputs[:step].transpose(1, 0, 2).reshape(B, -1, n_mel_channels)
+        )
+        mel_outputs = np.ascontiguousarray(mel_outputs.transpose(0, 2, 1))
+        (mel_outputs_postnet,) = self.postnet.run(None, dict(mel_outputs=mel_outputs))
+        if config["mask_padding"]:
+            padding = np.arange(mel_outputs_postnet.shape[2]) >= mel_lengths[:, None]
+            mel_outputs_postnet *= ~padding[:, None]
+        return mel_outputs_postnet, mel_lengths, decoder_status
+
+
+class OnnxHiFiGan:
+    """HiFi-GAN inference with onnxruntime on a graph written by export_hifigan_generator."""
+
+    def __init__(self, path, sess_options=None, providers=None):
+        self.session = _session(path, sess_options, providers)
+
+    def __call__(self, mel, max_wav_value=32768):
+        """mel: (B, n_mel_channels, T) -> int16 audio (B, T * hop_size), as HiFiGanGenerator.infer."""
+        (audio,) = self.session.run(None, dict(mel=np.asarray(mel, np.float32)))
+        audio = audio[:, 0] * max_wav_value
+        # NOTE: clip after scaling, 1.0 * 32768 would wrap around to -32768.
+        return np.clip(audio, -32768, 32767).astype(np.int16)
@@ -0,0 +1,215 @@
+__all__ = [
+    "ModelRegistry",
+    "config_hash",
+    "model_nbytes",
+    "get_registry",
+    "load_tacotron2",
+    "load_hifigan",
+]
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+
+from .models.tacotron2 import Tacotron2, DEFAULTS as TACOTRON2_DEFAULTS
+from .vocoders.hifigan import HiFiGanGenerator
+
+
+def config_hash(config):
+    """Stable hash of a model config: a dict, HParams, or the path of a JSON config file."""
+    if hasattr(config, "values") and not isinstance(config, dict):
+        config = config.values()
+    if isinstance(config, str) and os.path.isfile(config):
+        with open(config, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode()).hexdigest()
+
+
+def _tensors_nbytes(value, seen):
+    if torch.is_tensor(value):
+        key = (value.data_ptr(), value.numel(), value.dtype)
+        if key in seen:
+            return 0
+        seen.add(key)
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensors_nbytes(v, seen) for v in value)
+    if isinstance(value, dict):
+        return sum(_tensors_nbytes(v, seen) for v in value.values())
+    return 0
+
+
+def model_nbytes(model):
+    """Bytes held by the tensors of a model's state dict (shared tensors are counted once)."""
+    return _tensors_nbytes(model.state_dict(), set())
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models keyed by checkpoint path and config hash.
+
+    Models are loaded lazily on the first get, and concurrent gets of a model that is
+    being loaded wait for that load instead of starting another. When memory_budget
+    (bytes, as counted by model_nbytes) is set, the least recently used models are
+    evicted to keep the resident models within it; the most recently loaded model is
+    always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._loading = {}
+        self._hits = 0
+        self._misses = 0
+        self._deduplicated = 0
+        self._evictions = 0
+        self._load_seconds = 0.0
+
+    @staticmethod
+    def key(checkpoint, config):
+        return (os.path.abspath(checkpoint), config_hash(config))
+
+    def get(self, checkpoint, config, loader):
+        """Return the model for (checkpoint, config), calling loader() to load it on a miss."""
+        key = self.key(checkpoint, config)
+        with self._lock:
+            if key in self._models:
+                self._hits += 1
+                self._models.move_to_end(key)
+                return self._models[key]["model"]
+            if key in self._loading:
+                self._deduplicated += 1
+                future = self._loading[key]
+                owner = False
+            else:
+                self._misses += 1
+                future = Future()
+                self._loading[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+
+        start = time.perf_counter()
+        try:
+            model = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        load_seconds = time.perf_counter() - start
+        with self._lock:
+            self._models[key] = dict(
+                model=model,
+                nbytes=model_nbytes(model),
+                load_seconds=load_seconds,
+                checkpoint=key[0],
+            )
+            self._load_seconds += load_seconds
+            del self._loading[key]
+            self._evict()
+        future.set_result(model)
+        return model
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        while len(self._models) > 1 and self.resident_bytes > self.memory_budget:
+            self._models.popitem(last=False)
+            self._evictions += 1
+
+    @property
+    def resident_bytes(self):
+        return sum(entry["nbytes"] for entry in self._models.values())
+
+    def __len__(self):
+        return len(self._models)
+
+    def evict(self, checkpoint=None):
+        """Drop the models loaded from checkpoint, or every model when checkpoint is None."""
+        with self._lock:
+            for key in list(self._models):
+                if checkpoint is None or key[0] == os.path.abspath(checkpoint):
+                    del self._models[key]
+                    self._evictions += 1
+
+    def metrics(self):
+        with self._lock:
+            requests = self._hits + self._misses + self._deduplicated
+            return dict(
+                hits=self._hits,
+                misses=self._misses,
+                deduplicated=self._deduplicated,
+                evictions=self._evictions,
+                hit_rate=(self._hits + self._deduplicated) / requests
+                if requests
+                else 0.0,
+                load_seconds=self._load_seconds,
+                mean_load_seconds=self._load_seconds / self._misses
+                if self._misses
+                else 0.0,
+                resident=len(self._models),
+                resident_bytes=self.resident_bytes,
+                memory_budget=self.memory_budget,
+                models=[
+                    dict(
+                        checkpoint=entry["checkpoint"],
+                        nbytes=entry["nbytes"],
+                        load_seconds=entry["load_seconds"],
+                    )
+                    for entry in self._models.values()
+                ],
+            )
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry():
+    """The process-wide registry. Its memory budget is read from the
+    UBERDUCK_MODEL_MEMORY_BUDGET environment variable (bytes), unbounded if unset."""
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            budget = os.environ.get("UBERDUCK_MODEL_MEMORY_BUDGET")
+            _REGISTRY = ModelRegistry(memory_budget=int(budget) if budget else None)
+        return _REGISTRY
+
+
+def load_tacotron2(checkpoint, hparams=None, device="cpu", registry=None):
+    """Tacotron2 loaded from checkpoint in eval mode, shared through the registry."""
+    hparams = hparams or TACOTRON2_DEFAULTS
+    if registry is None:
+        registry = get_registry()
+
+    def loader():
+        model = Tacotron2(hparams)
+        model.from_pretrained(warm_start_path=checkpoint, device=device)
+        return model.eval()
+
+    config = dict(model="tacotron2", hparams=hparams.values(), device=device)
+    return registry.get(checkpoint, config, loader)
+
+
+def load_hifigan(config, checkpoint, cudnn_enabled=False, registry=None):
+    """HiFiGanGenerator for config and checkpoint, shared through the registry."""
+    if registry is None:
+        registry = get_registry()
+    return registry.get(
+        checkpoint,
+        dict(
+            model="hifigan",
+            config=config_hash(config),
+            cudnn_enabled=bool(cudnn_enabled),
+        ),
+        lambda: HiFiGanGenerator(config, checkpoint, cudnn_enabled=cudnn_enabled),
+    )
@@ -0,0 +1,208 @@
+__all__ = ["SynthesisCache", "model_fingerprint"]
+
+
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .text.util import clean_text
+
+
+_FINGERPRINTS = weakref.WeakKeyDictionary()
+
+
+def _update_hash(digest, value):
+    if torch.is_tensor(value):
+        if value.is_quantized:
+            value = value.int_repr()
+        digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _update_hash(digest, v)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            digest.update(str(k).encode())
+            _update_hash(digest, v)
+    else:
+        digest.update(repr(value).encode())
+
+
+def model_fingerprint(model):
+    """sha1 of a model's state dict, computed once per model object."""
+    if model not in _FINGERPRINTS:
+        digest = hashlib.sha1()
+        _update_hash(digest, model.state_dict())
+        _FINGERPRINTS[model] = digest.hexdigest()
+    return _FINGERPRINTS[model]
+
+
+def _module_settings(module):
+    """Scalar attributes of module and its submodules, i.e. the settings such as
+    gate_threshold or attention window_size that change the output of a model but
+    are not in its state dict."""
+    settings = {}
+    for name, submodule in module.named_modules():
+        for attribute, value in vars(submodule).items():
+            if attribute == "training" or attribute.startswith("_"):
+                continue
+            if isinstance(value, (bool, int, float, str, type(None))):
+                settings[f"{name}.{attribute}" if name else attribute] = value
+    return settings
+
+
+class SynthesisCache:
+    """Content-addressed cache of synthesized int16 audio, in front of e2e.tts_batch.
+
+    Results are keyed by a hash of the cleaned text, symbol set, speaker id, the
+    fingerprints of the text-to-mel model and vocoder, the settings of the decoder
+    (see _module_settings) and the inference parameters.
+    An in-memory LRU tier holds up to memory_budget bytes of audio; with cache_dir,
+    every result is also written to disk, where the least recently used files beyond
+    disk_budget bytes are deleted. Disk hits are promoted to memory.
+    """
+
+    def __init__(self, cache_dir=None, memory_budget=64 << 20, disk_budget=1 << 30):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._bytes_saved = 0
+        self._memory_evictions = 0
+        self._disk_evictions = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = [
+                entry for entry in os.scandir(cache_dir) if entry.name.endswith(".npy")
+            ]
+            for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+                self._disk[entry.name[: -len(".npy")]] = entry.stat().st_size
+                self._disk_bytes += entry.stat().st_size
+
+    @staticmethod
+    def key(
+        text,
+        speaker_id,
+        model,
+        vocoder,
+        symbol_set,
+        text_cleaner=("english_cleaners",),
+        **params,
+    ):
+        """Cache key of one line. params are the other settings the audio depends on,
+        e.g. bucket_length."""
+        decoder = getattr(model, "decoder", None)
+        description = dict(
+            text=clean_text(text, list(text_cleaner)),
+            speaker_id=int(speaker_id),
+            symbol_set=symbol_set,
+            model=model_fingerprint(model),
+            vocoder=model_fingerprint(vocoder),
+            decoder=_module_settings(decoder) if decoder is not None else None,
+            **params,
+        )
+        serialized = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """int16 audio (N,) for key, or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                audio = self._memory[key]
+                self._bytes_saved += audio.nbytes
+                return audio
+            if key not in self._disk:
+                self._misses += 1
+                return None
+            self._disk.move_to_end(key)
+        try:
+            audio = torch.from_numpy(np.load(self._path(key)))
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._disk_hits += 1
+            self._bytes_saved += audio.nbytes
+            self._put_memory(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        """Store int16 audio (N,) under key."""
+        audio = audio.detach().cpu().short()
+        with self._lock:
+            self._put_memory(key, audio)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        # NOTE: write then rename, so concurrent readers never see a partial file.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, audio.numpy())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path) - self._disk.pop(key, 0)
+            self._disk[key] = os.path.getsize(path)
+            while len(self._disk) > 1 and self._disk_bytes > self.disk_budget:
+                evicted, nbytes = self._disk.popitem(last=False)
+                self._disk_bytes -= nbytes
+                self._disk_evictions += 1
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+    def _put_memory(self, key, audio):
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        if audio.nbytes > self.memory_budget:
+            return
+        self._memory[key] = audio
+        self._memory_bytes += audio.nbytes
+        while self._memory_bytes > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+            self._memory_evictions += 1
+
+    def skip(self, n=1):
+        """Record n lines that were synthesized without the cache because their
+        result is not deterministic."""
+        with self._lock:
+            self._uncacheable += n
+
+    def metrics(self):
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            lookups = hits + self._misses
+            return dict(
+                hits=hits,
+                memory_hits=self._memory_hits,
+                disk_hits=self._disk_hits,
+                misses=self._misses,
+                uncacheable=self._uncacheable,
+                hit_rate=hits / lookups if lookups else 0.0,
+                bytes_saved=self._bytes_saved,
+                memory_bytes=self._memory_bytes,
+                disk_bytes=self._disk_bytes,
+                memory_evictions=self._memory_evictions,
+                disk_evictions=self._disk_evictions,
+            )
@@ -19,6 +19,7 @@ __all__ = [
     "cleaned_text_to_sequence",
     "text_to_sequence",
     "sequence_to_text",
+    "chunk_text",
     "BATCH_CLEANERS",
     "CLEANERS",
     "text_to_sequence_for_editts",
@@ -362,6 +363,54 @@ def sequence_to_text(sequence, symbol_set=DEFAULT_SYMBOLS):
     return result.replace("}{", " ")
 
 
+_sentence_end_re = re.compile(r"(?<=[.!?])\s+")
+_clause_end_re = re.compile(r"(?<=[,;:])\s+")
+
+
+def chunk_text(
+    text,
+    max_tokens=150,
+    cleaner_names=["english_cleaners"],
+    symbol_set=DEFAULT_SYMBOLS,
+):
+    """Split text into chunks of at most max_tokens symbols for synthesis.
+
+    The text is cleaned first (so e.g. the period of "Dr." is not a sentence end),
+    then split at sentence ends (. ! ?). Sentences over the budget are split at clause
+    ends (, ; :), packing consecutive clauses into a chunk while they fit, and clauses
+    still over the budget are split between words the same way.
+
+    Returns (chunk, boundary) pairs, where boundary is "sentence", "clause" or "word":
+    the kind of break that follows the chunk.
+    """
+
+    def n_tokens(chunk):
+        return len(text_to_sequence(chunk, [], symbol_set=symbol_set))
+
+    chunks = []
+    for sentence in _sentence_end_re.split(clean_text(text, cleaner_names).strip()):
+        if not sentence:
+            continue
+        pieces = [(sentence, "sentence")]
+        for pattern, boundary in ((_clause_end_re, "clause"), (_whitespace_re, "word")):
+            split = []
+            for piece, end in pieces:
+                if n_tokens(piece) <= max_tokens:
+                    split.append((piece, end))
+                    continue
+                packed = []
+                for part in pattern.split(piece):
+                    if packed and n_tokens(f"{packed[-1]} {part}") <= max_tokens:
+                        packed[-1] = f"{packed[-1]} {part}"
+                    else:
+                        packed.append(part)
+                split.extend((chunk, boundary) for chunk in packed[:-1])
+                split.append((packed[-1], end))
+            pieces = split
+        chunks.extend(pieces)
+    return chunks
+
+
 def text_to_sequence_for_editts(text, cleaner_names, symbol_set=GRAD_TTS_SYMBOLS):
     sequence = []
     emphases = []
@@ -1,21 +1,27 @@
-__all__ = ["TTSTrainer", "DEFAULTS", "config", "DEFAULTS"]
+__all__ = ["TTSTrainer", "PRECISIONS", "DEFAULTS", "config", "DEFAULTS"]
 
 
 import os
 from pathlib import Path
 from pprint import pprint
 
+from contextlib import nullcontext
+
 import torch
 import torch.distributed as dist
+from torch.cuda.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel as DDP
 from tensorboardX import SummaryWriter
 import numpy as np
 import time
 
 from ..models.common import MelSTFT
-from ..vocoders.hifigan import HiFiGanGenerator
+from ..registry import load_hifigan
 from ..models.base import DEFAULTS as MODEL_DEFAULTS
 from ..vendor.tfcompat.hparam import HParams
 
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
 # Note (Sam): keeping TTS specific parameters out of here actually -this shall be the pure trainer class.
 class TTSTrainer:
 
@@ -40,6 +46,7 @@ class TTSTrainer:
         self.learning_rate = hparams.learning_rate
         self.debug = hparams.debug
         self.batch_size = hparams.batch_size
+        self.reduction_window_schedule = hparams.reduction_window_schedule
         self.sample_inference_speaker_ids = hparams.sample_inference_speaker_ids
         self.weight_decay = hparams.weight_decay
         self.warm_start_name = hparams.warm_start_name
@@ -54,9 +61,18 @@ class TTSTrainer:
         self.lr_decay_rate = hparams.lr_decay_rate
         self.lr_decay_min = hparams.lr_decay_min
 
-        # NOTE (Sam): these are deprecated.
         self.distributed_run = hparams.distributed_run
+        self.distributed_backend = hparams.distributed_backend
+        self.distributed_init_method = hparams.distributed_init_method
+        self.ddp_bucket_cap_mb = hparams.ddp_bucket_cap_mb
+        # NOTE (Sam): this is deprecated.
         self.fp16_run = hparams.fp16_run
+        self.precision = hparams.precision
+        if self.precision not in PRECISIONS:
+            raise Exception(
+                f"precision must be one of {PRECISIONS}, got {self.precision}"
+            )
+        self.grad_accumulation_steps = hparams.grad_accumulation_steps
 
         torch.manual_seed(self.seed)
 
@@ -66,6 +82,10 @@ class TTSTrainer:
             self.device = "cuda"
         else:
             self.device = "cpu"
+        if self.precision == "fp16" and self.device != "cuda":
+            raise ValueError(
+                f"precision fp16 requires device cuda, got {self.device}; use bf16 instead"
+            )
         self.writer = SummaryWriter(self.log_dir)
         if not hasattr(self, "debug"):
             self.debug = False
@@ -86,13 +106,65 @@ class TTSTrainer:
             raise Exception(
                 "Rank and world size must be provided when distributed training"
             )
+        # NOTE: gloo runs on CPU, so the same code path can be tested as several processes on one machine.
+        backend = self.distributed_backend
+        if backend is None:
+            backend = (
+                "nccl" if self.device == "cuda" and dist.is_nccl_available() else "gloo"
+            )
         dist.init_process_group(
-            "nccl",
-            init_method="tcp://localhost:54321",
+            backend,
+            init_method=self.distributed_init_method,
             rank=self.rank,
             world_size=self.world_size,
         )
-        torch.cuda.set_device(self.rank)
+        if self.device == "cuda":
+            torch.cuda.set_device(self.rank)
+
+    def wrap_distributed(self, model):
+        """Wrap the model for data parallel training.
+
+        Gradients are all-reduced in buckets of ddp_bucket_cap_mb, overlapping
+        communication with the backward pass.
+        """
+        if not self.distributed_run:
+            return model
+        return DDP(
+            model,
+            device_ids=[self.rank] if self.device == "cuda" else None,
+            bucket_cap_mb=self.ddp_bucket_cap_mb,
+        )
+
+    def cleanup_distributed(self):
+        """Wait for every rank, then destroy the process group.
+
+        Tensors passed to collectives, e.g. by reduce_tensor, must still be referenced
+        when this is called.
+        """
+        # NOTE: a gloo thread that drops the last reference to a tensor created in
+        # Python needs the GIL to free it, while destroy_process_group joins the gloo
+        # threads holding the GIL. The threads drop their references some time after
+        # a collective completes, so they must not be the last ones.
+        if self.distributed_run and dist.is_initialized():
+            dist.barrier()
+            dist.destroy_process_group()
+
+    def autocast(self):
+        """Mixed precision region for the forward pass and loss.
+
+        bf16 works on CPU and GPU without loss scaling. fp16 is GPU only and
+        relies on the scaler returned by grad_scaler. Numerically sensitive
+        ops (decoder LSTM cells, attention softmax) opt out inside the model.
+        """
+        if self.precision == "fp32":
+            return nullcontext()
+        return torch.autocast(
+            device_type="cuda" if self.device == "cuda" else "cpu",
+            dtype=torch.bfloat16 if self.precision == "bf16" else torch.float16,
+        )
+
+    def grad_scaler(self):
+        return GradScaler(enabled=self.precision == "fp16")
 
     def save_checkpoint(self, checkpoint_name, **kwargs):
         if self.rank is not None and self.rank != 0:
@@ -142,9 +214,10 @@ class TTSTrainer:
             assert kwargs["hifigan_config"], "hifigan_config must be set"
             assert kwargs["hifigan_checkpoint"], "hifigan_checkpoint must be set"
             cudnn_enabled = bool(kwargs["cudnn_enabled"])
-            hifigan = HiFiGanGenerator(
-                config=kwargs["hifigan_config"],
-                checkpoint=kwargs["hifigan_checkpoint"],
+            # NOTE: the vocoder is loaded once and shared through the model registry.
+            hifigan = load_hifigan(
+                kwargs["hifigan_config"],
+                kwargs["hifigan_checkpoint"],
                 cudnn_enabled=cudnn_enabled,
             )
             audio = hifigan.infer(mel)
@@ -185,17 +258,23 @@ class TTSTrainer:
 
 DEFAULTS = HParams(
     grad_clip_thresh=1.0,
+    # NOTE: gradual training. Each window applies for the first until_step optimizer steps
+    # (None for the rest of training), e.g.
     # reduction_window_schedule=[
-    #     {"until_step": 10000, "batch_size": 16, "n_frames_per_step": 1},
-    #     {"until_step": 50000, "batch_size": 16, "n_frames_per_step": 1},
-    #     {"until_step": 60000, "batch_size": 16, "n_frames_per_step": 1},
-    #     {"until_step": 70000, "batch_size": 16, "n_frames_per_step": 1},
+    #     {"until_step": 10000, "batch_size": 32, "n_frames_per_step": 3},
+    #     {"until_step": 50000, "batch_size": 24, "n_frames_per_step": 2},
     #     {"until_step": None, "batch_size": 16, "n_frames_per_step": 1},
     # ],
+    # None trains with batch_size and n_frames_per_step_initial throughout.
+    reduction_window_schedule=None,
     batch_size=16,
     decay_start=15000,
     decay_rate=8000,
     fp16_run=False,
+    # NOTE: one of PRECISIONS; bf16 autocast also runs on CPU, fp16 requires cuda.
+    precision="fp32",
+    # NOTE: effective batch size is batch_size * grad_accumulation_steps * world_size.
+    grad_accumulation_steps=1,
     steps_per_sample=100,
     weight_decay=1e-6,
     sample_inference_speaker_ids=None,
@@ -207,6 +286,12 @@ DEFAULTS = HParams(
     warm_start_name=None,
     ignore_layers=None,
     distributed_run=False,
+    # NOTE: None selects nccl on GPU and gloo on CPU.
+    distributed_backend=None,
+    distributed_init_method="tcp://localhost:54321",
+    # NOTE: None launches one process per GPU.
+    distributed_world_size=None,
+    ddp_bucket_cap_mb=25,
     num_workers=1,
     pin_memory=True,
     lr_decay_start=15000,
@@ -1,13 +1,13 @@
 __all__ = ["Tacotron2Loss", "Tacotron2Trainer", "config", "DEFAULTS"]
 
 from random import randint
+from contextlib import nullcontext
 import time
 import numpy as np
 import torch
 
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from torch.cuda.amp import GradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from speechbrain.pretrained import EncoderClassifier
 
@@ -62,6 +62,12 @@ class Tacotron2Trainer(TTSTrainer):
         self.lr_decay_start = self.hparams.lr_decay_start
         self.lr_decay_rate = self.hparams.lr_decay_rate
         self.lr_decay_min = self.hparams.lr_decay_min
+        self.n_frames_per_step_initial = self.hparams.n_frames_per_step_initial
+        for window in self.reduction_window_schedule or []:
+            if window["n_frames_per_step"] > self.n_frames_per_step_initial:
+                raise Exception(
+                    f"reduction_window_schedule n_frames_per_step {window['n_frames_per_step']} exceeds n_frames_per_step_initial {self.n_frames_per_step_initial}"
+                )
         # NOTE (Sam): there is a lot of ambiguity in how to name and initialize audio / speaker encoder and torchmoji
         self.has_audio_encoder = self.hparams.audio_encoder_path is not None
 
@@ -128,6 +134,10 @@ class Tacotron2Trainer(TTSTrainer):
         self.log("GateLoss/train", self.global_step, scalar=gate_loss)
         self.log("GradNorm", self.global_step, scalar=grad_norm.item())
         self.log("LearningRate", self.global_step, scalar=self.learning_rate)
+        self.log("BatchSize", self.global_step, scalar=self.batch_size)
+        self.log(
+            "NFramesPerStep", self.global_step, scalar=model.n_frames_per_step_current
+        )
         self.log(
             "StepDurationSeconds",
             self.global_step,
@@ -405,15 +415,56 @@ class Tacotron2Trainer(TTSTrainer):
             include_f0=include_f0,  # unused
             cudnn_enabled=self.cudnn_enabled,
         )
-        sampler = None
-        train_loader = DataLoader(
+        if self.distributed_run:
+            sampler = DistributedSampler(
+                train_set,
+                num_replicas=self.world_size,
+                rank=self.rank,
+                shuffle=True,
+                seed=self.seed,
+            )
+        else:
+            sampler = None
+        train_loader = self.build_train_loader(train_set, sampler, collate_fn)
+        return train_set, val_set, train_loader, sampler, collate_fn
+
+    def build_train_loader(self, train_set, sampler, collate_fn):
+        return DataLoader(
             train_set,
             batch_size=self.batch_size,
             shuffle=(sampler is None),
             sampler=sampler,
             collate_fn=collate_fn,
         )
-        return train_set, val_set, train_loader, sampler, collate_fn
+
+    def reduction_window(self, global_step: int):
+        """Batch size and n_frames_per_step for the reduction_window_schedule entry covering global_step."""
+        if not self.reduction_window_schedule:
+            return self.hparams.batch_size, self.n_frames_per_step_initial
+        for window in self.reduction_window_schedule:
+            if window["until_step"] is None or global_step < window["until_step"]:
+                break
+        return window["batch_size"], window["n_frames_per_step"]
+
+    def set_reduction_window(self, model, collate_fn):
+        """Switch to the reduction window for the current global_step.
+
+        Returns True if the batch size or n_frames_per_step changed, in which case
+        the rest of the epoch must be drawn from a new train loader.
+        """
+        batch_size, n_frames_per_step = self.reduction_window(self.global_step)
+        if (
+            batch_size == self.batch_size
+            and n_frames_per_step == collate_fn.n_frames_per_step
+        ):
+            return False
+        print(
+            f"Reduction window at step {self.global_step}: batch_size {batch_size}, n_frames_per_step {n_frames_per_step}"
+        )
+        self.batch_size = batch_size
+        collate_fn.set_frames_per_step(n_frames_per_step)
+        model.set_current_frames_per_step(n_frames_per_step)
+        return True
 
     def train(
         self,
@@ -424,12 +475,17 @@ class Tacotron2Trainer(TTSTrainer):
 
         train_start_time = time.perf_counter()
         print("start train", train_start_time)
-        train_set, val_set, train_loader, sampler, collate_fn = self.initialize_loader()
+        self.init_distributed()
+        self.batch_size, n_frames_per_step = self.reduction_window(self.global_step)
+        train_set, val_set, train_loader, sampler, collate_fn = self.initialize_loader(
+            n_frames_per_step=n_frames_per_step
+        )
         criterion = Tacotron2Loss(
             pos_weight=self.pos_weight
         )  # keep higher than 5 to make clips not stretch on
 
         model = Tacotron2(self.hparams)
+        model.set_current_frames_per_step(n_frames_per_step)
         if self.device == "cuda" and self.cudnn_enabled:
             model = model.cuda()
             # NOTE (Sam): can I just call self.cuda() here?
@@ -442,95 +498,162 @@ class Tacotron2Trainer(TTSTrainer):
         )
         start_epoch = 0
 
-        # NOTE (Sam): distributed_run and fp16_run code deprecated and to be removed.
         if self.warm_start_name:
             model, optimizer, start_epoch = self.warm_start(model, optimizer)
+            # NOTE: the restored global_step may fall in a later reduction window.
+            self.set_reduction_window(model, collate_fn)
+        # NOTE: the wrapped model is only used for the training forward pass so that gradients are all-reduced.
+        # Logging, sampling and checkpointing use the underlying model.
+        parallel_model = self.wrap_distributed(model)
+        grad_scaler = self.grad_scaler()
 
         start_time, previous_start_time = time.perf_counter(), time.perf_counter()
         for epoch in range(start_epoch, self.epochs):
             if self.distributed_run:
                 sampler.set_epoch(epoch)
-            for batch_idx, batch in enumerate(train_loader):
-                self.global_step += 1
-
-                # Learning Rate decay, can be disabled if lr_decay_start is == 0 or None.
-                if (self.global_step > self.lr_decay_start) and (
-                    self.lr_decay_start not in [0, None]
-                ):
-                    learning_rate = self.learning_rate * (
-                        np.exp(-self.global_step / self.lr_decay_rate)
-                    )
-                    learning_rate = max(self.lr_decay_min, learning_rate)
-                    self.learning_rate = learning_rate
-                    for param_group in optimizer.param_groups:
-                        param_group["lr"] = learning_rate
-
-                model.zero_grad()
-
-                # NOTE (Sam): Could call subsets directly in function arguments since model_input is only reused in logging.
-                model_input = batch.subset(
-                    [
-                        "text_int_padded",
-                        "input_lengths",
-                        "speaker_ids",
-                        "gst",
-                        "mel_padded",
-                        "output_lengths",
-                        "audio_encodings",
-                    ]
-                )
-                model_output = model(
-                    input_text=model_input["text_int_padded"],
-                    input_lengths=model_input["input_lengths"],
-                    speaker_ids=model_input["speaker_ids"],
-                    embedded_gst=model_input["gst"],
-                    targets=model_input["mel_padded"],
-                    audio_encoding=model_input["audio_encodings"],
-                    output_lengths=model_input["output_lengths"],
-                )
-                target = batch.subset(["gate_target", "mel_padded"])
-                mel_loss, gate_loss, mel_loss_batch, gate_loss_batch = criterion(
-                    model_output=model_output, target=target
-                )
-                loss = mel_loss + gate_loss
-
-                reduced_mel_loss = mel_loss.item()
-                reduced_gate_loss = gate_loss.item()
-                reduced_gate_loss_batch = gate_loss_batch.detach()
-                reduced_mel_loss_batch = mel_loss_batch.detach()
-
-                reduced_loss = reduced_mel_loss + reduced_gate_loss
-                loss.backward()
-                grad_norm = torch.nn.utils.clip_grad_norm(
-                    model.parameters(), self.grad_clip_thresh
-                )
-                optimizer.step()
-
-                step_duration_seconds = time.perf_counter() - start_time
-                # NOTE (Sam): need to unify names to match forward
-                self.log_training(
-                    model,
-                    X=model_input,
-                    y_pred=model_output,
-                    y=target,
-                    loss=reduced_loss,
-                    mel_loss=reduced_mel_loss,
-                    gate_loss=reduced_gate_loss,
-                    mel_loss_batch=reduced_mel_loss_batch,
-                    gate_loss_batch=reduced_gate_loss_batch,
-                    grad_norm=grad_norm,
-                    step_duration_seconds=step_duration_seconds,
+            # NOTE: the order of the epoch is drawn up front, so that after a reduction window switch
+            # the epoch continues over its remaining samples on a loader with the new batch size.
+            epoch_indices = (
+                list(sampler)
+                if sampler is not None
+                else torch.randperm(len(train_set)).tolist()
+            )
+            while epoch_indices:
+                train_loader = self.build_train_loader(
+                    train_set, epoch_indices, collate_fn
                 )
-                previous_start_time = start_time
-                start_time = time.perf_counter()
-                log_str = f"epoch: {epoch}/{self.epochs} | batch: {batch_idx}/{len(train_loader)} | loss: {reduced_loss:.3f} | mel: {reduced_mel_loss:.3f} | gate: {reduced_gate_loss:.3f} | t: {start_time - previous_start_time:.3f}s | w: {(time.perf_counter() - train_start_time)/(60*60):.3f}h"
-                if self.distributed_run:
-                    log_str += f" | rank: {self.rank}"
-                print(log_str)
+                for batch_idx, batch in enumerate(train_loader):
+                    # NOTE: the optimizer steps once every grad_accumulation_steps micro-batches, so the effective batch size
+                    # is batch_size * grad_accumulation_steps * world_size while memory is bounded by batch_size.
+                    step_start_idx = (
+                        batch_idx - batch_idx % self.grad_accumulation_steps
+                    )
+                    micro_batches = min(
+                        self.grad_accumulation_steps, len(train_loader) - step_start_idx
+                    )
+                    is_last_micro_batch = (
+                        batch_idx == step_start_idx + micro_batches - 1
+                    )
 
-                interrupt = interrupt_condition()
-                if interrupt:
-                    interrupt_action()
+                    if batch_idx == step_start_idx:
+                        self.global_step += 1
+
+                        # Learning Rate decay, can be disabled if lr_decay_start is == 0 or None.
+                        if (self.global_step > self.lr_decay_start) and (
+                            self.lr_decay_start not in [0, None]
+                        ):
+                            learning_rate = self.learning_rate * (
+                                np.exp(-self.global_step / self.lr_decay_rate)
+                            )
+                            learning_rate = max(self.lr_decay_min, learning_rate)
+                            self.learning_rate = learning_rate
+                            for param_group in optimizer.param_groups:
+                                param_group["lr"] = learning_rate
+
+                        model.zero_grad()
+                        mel_loss_step, gate_loss_step = 0.0, 0.0
+
+                    # NOTE (Sam): Could call subsets directly in function arguments since model_input is only reused in logging.
+                    model_input = batch.subset(
+                        [
+                            "text_int_padded",
+                            "input_lengths",
+                            "speaker_ids",
+                            "gst",
+                            "mel_padded",
+                            "output_lengths",
+                            "audio_encodings",
+                        ]
+                    )
+                    # NOTE: DDP only all-reduces gradients on the last micro-batch of an optimizer step.
+                    sync_context = (
+                        parallel_model.no_sync()
+                        if self.distributed_run and not is_last_micro_batch
+                        else nullcontext()
+                    )
+                    with sync_context:
+                        with self.autocast():
+                            model_output = parallel_model(
+                                input_text=model_input["text_int_padded"],
+                                input_lengths=model_input["input_lengths"],
+                                speaker_ids=model_input["speaker_ids"],
+                                embedded_gst=model_input["gst"],
+                                targets=model_input["mel_padded"],
+                                audio_encoding=model_input["audio_encodings"],
+                                output_lengths=model_input["output_lengths"],
+                            )
+                            target = batch.subset(["gate_target", "mel_padded"])
+                            (
+                                mel_loss,
+                                gate_loss,
+                                mel_loss_batch,
+                                gate_loss_batch,
+                            ) = criterion(model_output=model_output, target=target)
+                            loss = mel_loss + gate_loss
+                        # NOTE: dividing by the number of micro-batches makes the accumulated gradient the gradient of the mean loss.
+                        grad_scaler.scale(loss / micro_batches).backward()
+
+                    mel_loss_step += mel_loss.detach() / micro_batches
+                    gate_loss_step += gate_loss.detach() / micro_batches
+                    if not is_last_micro_batch:
+                        continue
+
+                    if self.distributed_run:
+                        # NOTE: the reduced tensors are kept until cleanup_distributed, see there.
+                        reduced_tensors = (
+                            reduce_tensor(mel_loss_step, self.world_size),
+                            reduce_tensor(gate_loss_step, self.world_size),
+                        )
+                        reduced_mel_loss = reduced_tensors[0].item()
+                        reduced_gate_loss = reduced_tensors[1].item()
+                    else:
+                        reduced_mel_loss = mel_loss_step.item()
+                        reduced_gate_loss = gate_loss_step.item()
+                    # NOTE: per-speaker losses are logged from the local shard since the speakers differ across ranks.
+                    reduced_gate_loss_batch = gate_loss_batch.detach()
+                    reduced_mel_loss_batch = mel_loss_batch.detach()
+
+                    reduced_loss = reduced_mel_loss + reduced_gate_loss
+                    grad_scaler.unscale_(optimizer)
+                    grad_norm = torch.nn.utils.clip_grad_norm(
+                        model.parameters(), self.grad_clip_thresh
+                    )
+                    grad_scaler.step(optimizer)
+                    grad_scaler.update()
+
+                    step_duration_seconds = time.perf_counter() - start_time
+                    # NOTE (Sam): need to unify names to match forward
+                    self.log_training(
+                        model,
+                        X=model_input,
+                        y_pred=model_output,
+                        y=target,
+                        loss=reduced_loss,
+                        mel_loss=reduced_mel_loss,
+                        gate_loss=reduced_gate_loss,
+                        mel_loss_batch=reduced_mel_loss_batch,
+                        gate_loss_batch=reduced_gate_loss_batch,
+                        grad_norm=grad_norm,
+                        step_duration_seconds=step_duration_seconds,
+                    )
+                    previous_start_time = start_time
+                    start_time = time.perf_counter()
+                    log_str = f"epoch: {epoch}/{self.epochs} | batch: {batch_idx}/{len(train_loader)} | loss: {reduced_loss:.3f} | mel: {reduced_mel_loss:.3f} | gate: {reduced_gate_loss:.3f} | t: {start_time - previous_start_time:.3f}s | w: {(time.perf_counter() - train_start_time)/(60*60):.3f}h"
+                    if self.distributed_run:
+                        log_str += f" | rank: {self.rank}"
+                    print(log_str)
+
+                    interrupt = interrupt_condition()
+                    if interrupt:
+                        interrupt_action()
+
+                    if self.set_reduction_window(model, collate_fn):
+                        epoch_indices = epoch_indices[
+                            (batch_idx + 1) * train_loader.batch_size :
+                        ]
+                        break
+                else:
+                    epoch_indices = []
 
             if epoch % self.epochs_per_checkpoint == 0:
                 self.save_checkpoint(
@@ -557,6 +680,8 @@ class Tacotron2Trainer(TTSTrainer):
                 self.loss.append(reduced_loss)
                 continue
 
+        self.cleanup_distributed()
+
     def validate(self, **kwargs):
         val_start_time = time.perf_counter()
         model = kwargs["model"]
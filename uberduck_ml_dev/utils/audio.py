@@ -19,6 +19,8 @@ __all__ = [
     "resample",
     "get_audio_max",
     "to_int16",
+    "saturate_int16",
+    "audio_to_wav",
 ]
 
 
@@ -346,3 +348,20 @@ def get_audio_max(*audios):
 def to_int16(audio, max_wav_value=32768):
     audio = audio * max_wav_value
     return audio.astype(np.int16)
+
+
+import io
+
+
+def saturate_int16(audio):
+    """Float audio tensor on the int16 scale -> int16 numpy array. Samples are
+    rounded and clamped, so a full-scale sample (32768.0) saturates instead of
+    wrapping to -32768."""
+    return audio.detach().cpu().round().clamp(-32768, 32767).short().numpy()
+
+
+def audio_to_wav(audio, sampling_rate):
+    """int16 audio (N,) -> bytes of a 16-bit PCM wav file."""
+    buffer = io.BytesIO()
+    write(buffer, sampling_rate, audio)
+    return buffer.getvalue()
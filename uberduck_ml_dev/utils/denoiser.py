@@ -19,55 +19,103 @@ normalize = (32768.0 / np.max(np.abs(audio_denoised))) ** 0.9
 audio_denoised = audio_denoised * normalize
 """
 
+import os
 import sys
 import torch
 from ..models.common import STFT
+from .utils import get_mask_from_lengths
 
 
 class Denoiser(torch.nn.Module):
-    """WaveGlow denoiser, adapted for HiFi-GAN"""
+    """WaveGlow denoiser, adapted for HiFi-GAN.
+
+    Runs on the device of the vocoder. The bias spectrum is the spectrum of the
+    vocoder output for a zero (mode="zeros") or random (mode="normal") mel. It is
+    saved next to the vocoder checkpoint, or in cache_dir, and loaded from there on
+    later constructions for the same checkpoint, mode and STFT parameters.
+    """
 
     def __init__(
-        self, hifigan, filter_length=1024, n_overlap=4, win_length=1024, mode="zeros"
+        self,
+        hifigan,
+        filter_length=1024,
+        n_overlap=4,
+        win_length=1024,
+        mode="zeros",
+        cache_dir=None,
     ):
         super(Denoiser, self).__init__()
+        if mode not in ("zeros", "normal"):
+            raise Exception("Mode {} if not supported".format(mode))
+        hop_length = int(filter_length / n_overlap)
+        device = torch.device(hifigan.device)
         self.stft = STFT(
             filter_length=filter_length,
-            hop_length=int(filter_length / n_overlap),
+            hop_length=hop_length,
+            win_length=win_length,
+            device=device.type,
+            rank=device.index or 0,
+        )
+
+        key = dict(
+            mode=mode,
+            filter_length=filter_length,
+            hop_length=hop_length,
             win_length=win_length,
-            device=torch.device("cpu"),
         )
+        cache_path = None
+        if isinstance(hifigan.checkpoint, str):
+            cache_path = os.path.join(
+                cache_dir or os.path.dirname(os.path.abspath(hifigan.checkpoint)),
+                f"{os.path.basename(hifigan.checkpoint)}.denoiser_{mode}.pt",
+            )
+            key["checkpoint_mtime"] = os.path.getmtime(hifigan.checkpoint)
+        bias_spec = None
+        if cache_path is not None and os.path.exists(cache_path):
+            cached = torch.load(cache_path, map_location=device)
+            if cached["key"] == key:
+                bias_spec = cached["bias_spec"]
+        if bias_spec is None:
+            bias_spec = self.bias_spectrum(hifigan, mode)
+            if cache_path is not None:
+                try:
+                    torch.save(dict(key=key, bias_spec=bias_spec.cpu()), cache_path)
+                except OSError:
+                    print(f"Could not save the denoiser bias spectrum to {cache_path}")
+
+        self.register_buffer("bias_spec", bias_spec.to(device))
 
+    @torch.no_grad()
+    def bias_spectrum(self, hifigan, mode):
         if mode == "zeros":
             mel_input = torch.zeros((1, 80, 88))
-        elif mode == "normal":
-            mel_input = torch.randn((1, 80, 88))
         else:
-            raise Exception("Mode {} if not supported".format(mode))
-
-        with torch.no_grad():
-            bias_audio = (
-                hifigan.vocoder.forward(mel_input.to(hifigan.device))
-                .view(1, -1)
-                .float()
-            )
-            bias_spec, _ = self.stft.transform(bias_audio.cpu())
-
-        self.register_buffer("bias_spec", bias_spec[:, :, 0][:, :, None])
+            mel_input = torch.randn((1, 80, 88))
+        bias_audio = (
+            hifigan.vocoder.forward(mel_input.to(hifigan.device)).view(1, -1).float()
+        )
+        bias_spec, _ = self.stft.transform(bias_audio)
+        return bias_spec[:, :, 0][:, :, None]
 
-    def forward(self, audio, strength=10):
+    @torch.no_grad()
+    def forward(self, audio, strength=10, lengths=None):
         """
         Strength is the amount of bias you want to be removed from the final audio.
         Note: A higher strength may remove too much information in the original audio.
 
-        :param audio: Audio data
+        :param audio: Audio data (B, T), on the device of the vocoder
         :param strength: Amount of bias removal. Recommended range 10 - 50
-        :return: Denoised audio
+        :param lengths: Optional lengths (B,) of the audio in samples. Samples past
+            them are zero in the output.
+        :return: Denoised audio (B, 1, T)
         :rtype: tensor
         """
 
-        audio_spec, audio_angles = self.stft.transform(audio.cpu())
+        audio_spec, audio_angles = self.stft.transform(audio)
         audio_spec_denoised = audio_spec - self.bias_spec * strength
         audio_spec_denoised = torch.clamp(audio_spec_denoised, 0.0)
-        audio_denoised = self.stft.inverse(audio_spec_denoised.cpu(), audio_angles)
+        audio_denoised = self.stft.inverse(audio_spec_denoised, audio_angles)
+        if lengths is not None:
+            mask = get_mask_from_lengths(lengths, max_len=audio_denoised.size(2))
+            audio_denoised = audio_denoised * mask[:, None]
         return audio_denoised
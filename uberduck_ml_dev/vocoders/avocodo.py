@@ -7,6 +7,10 @@ __all__ = [
     "MultiPeriodDiscriminator",
     "DiscriminatorS",
     "MultiScaleDiscriminator",
+    "MultiCoMBDiscriminator",
+    "MultiSubBandDiscriminator",
+    "PQMF",
+    "avocodo_discriminator_outputs",
     "feature_loss",
     "discriminator_loss",
     "generator_loss",
@@ -664,6 +668,21 @@ def generator_loss(disc_outputs):
     return loss, gen_losses
 
 
+def avocodo_discriminator_outputs(combd, sbd, y, y_hat):
+    """Outputs of a MultiCoMBDiscriminator and a MultiSubBandDiscriminator for real
+    audio y and generated audio y_hat, both (B, 1, T), as the (y_d_rs, y_d_gs,
+    fmap_rs, fmap_gs) that the losses above take.
+
+    Generators without lower resolution outputs, such as the multi-band HiFi-GAN
+    Generator, are judged at the lower resolutions on the first PQMF band of y_hat.
+    """
+    x2_hat = combd.pqmf_2(y_hat)[:, :1, :]
+    x1_hat = combd.pqmf_4(y_hat)[:, :1, :]
+    y_d_rs, y_d_gs, fmap_rs, fmap_gs = combd(y, y_hat, x2_hat, x1_hat)
+    y_s_rs, y_s_gs, fmap_s_rs, fmap_s_gs = sbd(y, y_hat)
+    return y_d_rs + y_s_rs, y_d_gs + y_s_gs, fmap_rs + fmap_s_rs, fmap_gs + fmap_s_gs
+
+
 #
 
 
@@ -771,7 +790,10 @@ class SubBandDiscriminator(torch.nn.Module):
 # adapted from
 # https://github.com/kan-bayashi/ParallelWaveGAN/tree/master/parallel_wavegan
 class PQMF(torch.nn.Module):
-    def __init__(self, N=4, taps=62, cutoff=0.15, beta=9.0):
+    # NOTE: with centered, the filters are centered at taps / 2 as in ParallelWaveGAN,
+    # which synthesis needs for near perfect reconstruction. The default keeps the
+    # filters that the discriminators were trained with.
+    def __init__(self, N=4, taps=62, cutoff=0.15, beta=9.0, centered=False):
         super(PQMF, self).__init__()
 
         self.N = N
@@ -782,12 +804,11 @@ class PQMF(torch.nn.Module):
         QMF = sig.firwin(taps + 1, cutoff, window=("kaiser", beta))
         H = np.zeros((N, len(QMF)))
         G = np.zeros((N, len(QMF)))
+        center = taps / 2 if centered else (taps - 1) / 2
         for k in range(N):
             constant_factor = (
-                (2 * k + 1)
-                * (np.pi / (2 * N))
-                * (np.arange(taps + 1) - ((taps - 1) / 2))
-            )  # TODO: (taps - 1) -> taps
+                (2 * k + 1) * (np.pi / (2 * N)) * (np.arange(taps + 1) - center)
+            )
             phase = (-1) ** k * np.pi / 4
             H[k] = 2 * QMF * np.cos(constant_factor + phase)
 
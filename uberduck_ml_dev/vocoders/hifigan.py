@@ -3,6 +3,8 @@ __all__ = [
     "ResBlock1",
     "ResBlock2",
     "Generator",
+    "InferenceGenerator",
+    "quantize_generator",
     "DiscriminatorP",
     "MultiPeriodDiscriminator",
     "DiscriminatorS",
@@ -12,6 +14,7 @@ __all__ = [
     "generator_loss",
     "LRELU_SLOPE",
     "AttrDict",
+    "MULTIBAND_DEFAULTS",
     "build_env",
     "init_weights",
     "apply_weight_norm",
@@ -22,6 +25,7 @@ __all__ = [
 """ from https://github.com/jik876/hifi-gan """
 
 import argparse
+import contextlib
 import json
 import datetime as dt
 import numpy as np
@@ -33,6 +37,8 @@ import torch.nn as nn
 from torch.nn import Conv1d, ConvTranspose1d, AvgPool1d, Conv2d
 from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
 
+from .avocodo import PQMF
+
 # NOTE(zach): This is config_v1 from https://github.com/jik876/hifi-gan.
 DEFAULTS = {
     "resblock": "1",
@@ -66,6 +72,19 @@ DEFAULTS = {
     },
 }
 
+# NOTE: multi-band generation. conv_post emits subbands channels at 1 / subbands
+# of the sample rate, which PQMF synthesis combines, so the upsample_rates multiply
+# to hop_size / subbands and the most expensive full rate stage is skipped.
+MULTIBAND_DEFAULTS = dict(
+    DEFAULTS,
+    subbands=4,
+    upsample_rates=[8, 4, 2],
+    upsample_kernel_sizes=[16, 8, 4],
+    pqmf_taps=62,
+    pqmf_cutoff=0.142,
+    pqmf_beta=9.0,
+)
+
 
 class HiFiGanGenerator(nn.Module):
     def __init__(self, config, checkpoint, cudnn_enabled=False):
@@ -73,19 +92,28 @@ class HiFiGanGenerator(nn.Module):
         self.config = config
         self.checkpoint = checkpoint
         self.device = "cuda" if torch.cuda.is_available() and cudnn_enabled else "cpu"
+        self.quantized = False
         self.vocoder = self.load_checkpoint().eval()
-        self.vocoder.remove_weight_norm()
+        if not self.quantized:
+            self.vocoder.remove_weight_norm()
 
     @torch.no_grad()
     def load_checkpoint(self):
         h = self.load_config()
         vocoder = Generator(h)
-        vocoder.load_state_dict(
-            torch.load(
-                self.checkpoint,
-                map_location="cuda" if self.device == "cuda" else "cpu",
-            )["generator"]
+        checkpoint = torch.load(
+            self.checkpoint,
+            map_location="cuda" if self.device == "cuda" else "cpu",
         )
+        if "quantization" in checkpoint:
+            # NOTE: quantized checkpoints are written by exec/quantize_hifigan.py and only run on CPU.
+            self.quantized = True
+            self.device = "cpu"
+            vocoder = quantize_generator(vocoder, [], **checkpoint["quantization"])
+            with _quantized_engine(checkpoint["quantization"]["engine"]):
+                vocoder.load_state_dict(checkpoint["generator"])
+            return vocoder
+        vocoder.load_state_dict(checkpoint["generator"])
         if self.device == "cuda":
             vocoder = vocoder.cuda()
         return vocoder
@@ -103,6 +131,8 @@ class HiFiGanGenerator(nn.Module):
 
     @torch.no_grad()
     def infer(self, mel, max_wav_value=32768):
+        if self.quantized:
+            mel = mel.cpu()
         audio = (
             self.vocoder.forward(mel).cpu().squeeze().clamp(-1, 1).numpy()
             * max_wav_value
@@ -280,9 +310,19 @@ class Generator(torch.nn.Module):
             ):
                 self.resblocks.append(resblock(h, ch, k, d))
 
-        self.conv_post = weight_norm(Conv1d(ch, 1, 7, 1, padding=3))
+        self.subbands = h.get("subbands", 1)
+        self.conv_post = weight_norm(Conv1d(ch, self.subbands, 7, 1, padding=3))
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
+        self.pqmf = None
+        if self.subbands > 1:
+            self.pqmf = PQMF(
+                N=self.subbands,
+                taps=h.pqmf_taps,
+                cutoff=h.pqmf_cutoff,
+                beta=h.pqmf_beta,
+                centered=True,
+            )
 
     def forward(self, x):
         x = self.conv_pre(x)
@@ -299,6 +339,8 @@ class Generator(torch.nn.Module):
         x = F.leaky_relu(x)
         x = self.conv_post(x)
         x = torch.tanh(x)
+        if self.pqmf is not None:
+            x = self.pqmf.synthesis(x)
 
         return x
 
@@ -311,6 +353,240 @@ class Generator(torch.nn.Module):
         remove_weight_norm(self.conv_post)
 
 
+def _folded_weight(conv):
+    """Weight of conv with weight norm, if any, folded in."""
+    if hasattr(conv, "weight_g"):
+        v = conv.weight_v.detach()
+        norm = v.flatten(1).norm(dim=1).view(-1, *([1] * (v.dim() - 1)))
+        return conv.weight_g.detach() * v / norm
+    return conv.weight.detach()
+
+
+def _conv2d(conv, scale=1.0):
+    """Conv1d or ConvTranspose1d as the equivalent 2D convolution over (B, C, 1, T),
+    with its input scaled by scale."""
+    kernel_size = (1, conv.kernel_size[0])
+    stride = (1, conv.stride[0])
+    padding = (0, conv.padding[0])
+    if isinstance(conv, ConvTranspose1d):
+        conv2d = nn.ConvTranspose2d(
+            conv.in_channels, conv.out_channels, kernel_size, stride, padding=padding
+        )
+    else:
+        conv2d = nn.Conv2d(
+            conv.in_channels,
+            conv.out_channels,
+            kernel_size,
+            stride,
+            padding=padding,
+            dilation=(1, conv.dilation[0]),
+        )
+    conv2d.weight.data.copy_(_folded_weight(conv).unsqueeze(2) * scale)
+    conv2d.bias.data.copy_(conv.bias.detach())
+    return conv2d
+
+
+def _grouped_conv2d(convs):
+    """Convolutions with equal channels and dilation but different kernel sizes as
+    one grouped 2D convolution, with the smaller kernels zero padded to the largest."""
+    kernel_size = max(c.kernel_size[0] for c in convs)
+    dilation = convs[0].dilation[0]
+    channels = convs[0].out_channels
+    conv2d = nn.Conv2d(
+        channels * len(convs),
+        channels * len(convs),
+        (1, kernel_size),
+        padding=(0, get_padding(kernel_size, dilation)),
+        dilation=(1, dilation),
+        groups=len(convs),
+    )
+    conv2d.weight.data.zero_()
+    for i, c in enumerate(convs):
+        offset = (kernel_size - c.kernel_size[0]) // 2
+        conv2d.weight.data[
+            i * channels : (i + 1) * channels,
+            :,
+            0,
+            offset : offset + c.kernel_size[0],
+        ] = _folded_weight(c)
+    conv2d.bias.data.copy_(torch.cat([c.bias.detach() for c in convs]))
+    return conv2d
+
+
+class _ResBlockGroup(nn.Module):
+    """ResBlocks of one MRF stage with the same dilations, evaluated together on
+    their concatenated channels. Returns the sum of the ResBlock outputs."""
+
+    def __init__(self, resblocks):
+        super().__init__()
+        self.n = len(resblocks)
+        if isinstance(resblocks[0], ResBlock1):
+            layers = zip(
+                zip(*[r.convs1 for r in resblocks]), zip(*[r.convs2 for r in resblocks])
+            )
+        else:
+            layers = ((convs, None) for convs in zip(*[r.convs for r in resblocks]))
+        self.convs1 = nn.ModuleList()
+        self.convs2 = nn.ModuleList()
+        for convs1, convs2 in layers:
+            self.convs1.append(_grouped_conv2d(convs1))
+            self.convs2.append(
+                nn.Identity() if convs2 is None else _grouped_conv2d(convs2)
+            )
+        self.resblock1 = isinstance(resblocks[0], ResBlock1)
+
+    def forward(self, x):
+        if self.n > 1:
+            x = x.repeat(1, self.n, 1, 1)
+        for c1, c2 in zip(self.convs1, self.convs2):
+            xt = F.leaky_relu(x, LRELU_SLOPE)
+            xt = c1(xt)
+            if self.resblock1:
+                xt = F.leaky_relu(xt, LRELU_SLOPE)
+                xt = c2(xt)
+            x = xt + x
+        if self.n == 1:
+            return x
+        xs = x.chunk(self.n, 1)
+        x = xs[0]
+        for xt in xs[1:]:
+            x = x + xt
+        return x
+
+
+class _PQMFSynthesis(nn.Module):
+    def __init__(self, pqmf):
+        super().__init__()
+        self.pqmf = pqmf
+
+    def forward(self, x):
+        return self.pqmf.synthesis(x)
+
+
+class InferenceGenerator(nn.Module):
+    """HiFi-GAN Generator specialized for inference, built from a trained Generator.
+
+    Weight norm is folded into the convolutions and the 1 / num_kernels average of
+    each multi-receptive-field (MRF) stage into the convolution that follows it.
+    With fuse_mrf (off by default), the parallel ResBlocks of an MRF stage that
+    share dilations run as one grouped convolution per layer instead of one per
+    ResBlock. This cuts kernel launches, which can help on GPU at small batch
+    sizes, but zero pads the kernels to the largest size, so it does more work and
+    is about half as fast on CPU. The inference_generator benchmarks of
+    exec.benchmark_micro report the time and convolution launches of both.
+    Convolutions are 2D over (B, C, 1, T), so that channels_last can be used.
+    """
+
+    def __init__(self, generator, channels_last=False, fuse_mrf=False):
+        super().__init__()
+        if isinstance(generator, HiFiGanGenerator):
+            generator = generator.vocoder
+        self.h = generator.h
+        self.num_kernels = generator.num_kernels
+        self.memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+        # NOTE: leaky_relu commutes with a positive scale, so the MRF average is
+        # folded into the weights of the next upsampling (or output) convolution.
+        scale = 1.0 / self.num_kernels
+        self.conv_pre = _conv2d(generator.conv_pre)
+        self.ups = nn.ModuleList(
+            [
+                _conv2d(up, 1.0 if i == 0 else scale)
+                for i, up in enumerate(generator.ups)
+            ]
+        )
+        self.mrfs = nn.ModuleList()
+        for i in range(len(generator.ups)):
+            resblocks = generator.resblocks[
+                i * self.num_kernels : (i + 1) * self.num_kernels
+            ]
+            groups = {}
+            for j, r in enumerate(resblocks):
+                convs = r.convs1 if isinstance(r, ResBlock1) else r.convs
+                key = tuple(c.dilation[0] for c in convs) if fuse_mrf else j
+                groups.setdefault(key, []).append(r)
+            self.mrfs.append(
+                nn.ModuleList([_ResBlockGroup(g) for g in groups.values()])
+            )
+        self.conv_post = _conv2d(generator.conv_post, scale)
+        self.synthesis = None
+        if generator.pqmf is not None:
+            self.synthesis = _PQMFSynthesis(generator.pqmf)
+        self.to(memory_format=self.memory_format)
+        self.requires_grad_(False)
+        self.eval()
+
+    @classmethod
+    def from_checkpoint(cls, config, checkpoint, channels_last=False, fuse_mrf=False):
+        return cls(
+            HiFiGanGenerator(config, checkpoint),
+            channels_last=channels_last,
+            fuse_mrf=fuse_mrf,
+        )
+
+    def forward(self, x):
+        """mel (B, num_mels, T) -> audio (B, 1, T * hop_size) in [-1, 1], as Generator."""
+        x = x.unsqueeze(2).contiguous(memory_format=self.memory_format)
+        x = self.conv_pre(x)
+        for up, mrf in zip(self.ups, self.mrfs):
+            x = F.leaky_relu(x, LRELU_SLOPE)
+            x = up(x)
+            xs = None
+            for group in mrf:
+                xs = group(x) if xs is None else xs + group(x)
+            x = xs
+        x = F.leaky_relu(x)
+        x = self.conv_post(x)
+        x = torch.tanh(x)[:, :, 0]
+        if self.synthesis is not None:
+            x = self.synthesis(x)
+        return x
+
+    @torch.no_grad()
+    def infer(self, mel, max_wav_value=32768):
+        """mel (B, num_mels, T) -> int16 audio (B, T * hop_size) on the device of mel."""
+        audio = self.forward(mel)[:, 0] * max_wav_value
+        return audio.clamp_(-max_wav_value, max_wav_value - 1).to(torch.int16)
+
+
+@contextlib.contextmanager
+def _quantized_engine(engine):
+    previous = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def quantize_generator(generator, mels, channels_last=True, engine="fbgemm"):
+    """Post-training static int8 quantization of a HiFi-GAN Generator.
+
+    The InferenceGenerator of generator is quantized, with activation ranges
+    calibrated on mels, an iterable of (B, num_mels, T) tensors. conv_post, tanh
+    and PQMF synthesis stay in float. Returns an fx GraphModule with the Generator
+    forward. Requires torch>=1.13.
+    """
+    # NOTE: imported here so that the rest of the module works on older torch.
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = InferenceGenerator(generator, channels_last=channels_last)
+    qconfig_mapping = (
+        get_default_qconfig_mapping(engine)
+        .set_module_name("conv_post", None)
+        .set_object_type(torch.tanh, None)
+        .set_module_name("synthesis", None)
+    )
+    example_inputs = (torch.zeros(1, model.conv_pre.in_channels, 16),)
+    with _quantized_engine(engine), torch.no_grad():
+        model = prepare_fx(model, qconfig_mapping, example_inputs)
+        for mel in mels:
+            model(mel)
+        return convert_fx(model)
+
+
 class DiscriminatorP(torch.nn.Module):
     def __init__(self, period, kernel_size=5, stride=3, use_spectral_norm=False):
         super(DiscriminatorP, self).__init__()